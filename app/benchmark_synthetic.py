@@ -0,0 +1,98 @@
+import argparse
+import time
+import numpy as np
+from lib_frame_geometry import FrameGeometry
+from lib_image_processing import ImageProcessor
+from lib_process_lines import LineProcessor, LineSet
+from lib_session_recording import SessionRecorder
+from lib_synthetic_track import TrackRenderer, parse_map
+
+LINE_COUNT_BUCKETS = (0, 5, 10, 20, 40, 80, 160)
+
+
+def benchmark_resolutions(track_map, args):
+    """ImageProcessor and LineProcessor time of the same poses at every resolution"""
+    print('resolution   image p50  image p90  lines p50  lines p90  hough lines')
+    for resolution in args.resolutions:
+        width, height = (int(size) for size in resolution.split('x'))
+        renderer = make_renderer(track_map, (height, width), args)
+        poses = renderer.get_random_poses(args.frames)
+        image_processor = ImageProcessor(10, 5, 7, 65, reuse_buffers=True)
+        line_processor = LineProcessor()
+        image_times, line_times, line_counts = [], [], []
+        for x, y, heading in poses:
+            frame, tape_paths = renderer.render(x, y, heading)
+            start_time = time.perf_counter()
+            edges, houghlines = image_processor.get_edges_and_houghlines(frame, rotate_180=True)
+            image_time = time.perf_counter()
+            line_processor.analyze_frame(FrameGeometry.of(edges), edges, houghlines, edges_rotated_180=True)
+            image_times.append(image_time - start_time)
+            line_times.append(time.perf_counter() - image_time)
+            line_counts.append(0 if houghlines is None else len(houghlines))
+        image_p50, image_p90 = np.percentile(image_times, (50, 90)) * 1000
+        lines_p50, lines_p90 = np.percentile(line_times, (50, 90)) * 1000
+        print(f'{resolution:>10} {image_p50:9.2f}ms {image_p90:8.2f}ms {lines_p50:8.2f}ms {lines_p90:8.2f}ms {np.mean(line_counts):12.1f}')
+
+def benchmark_line_counts(track_map, args):
+    """Time of merging the hough lines against their number, lower hough thresholds find more lines"""
+    renderer = make_renderer(track_map, (480, 640), args)
+    poses = renderer.get_random_poses(args.frames)
+    line_processor = LineProcessor()
+    geometry = FrameGeometry(640, 480)
+    line_counts, merge_times = [], []
+    for threshold in (65, 45, 30, 20):
+        image_processor = ImageProcessor(10, 5, 7, threshold, reuse_buffers=True)
+        for x, y, heading in poses:
+            frame, tape_paths = renderer.render(x, y, heading)
+            edges, houghlines = image_processor.get_edges_and_houghlines(frame, rotate_180=True)
+            lines = LineSet.from_houghlines(houghlines)
+            start_time = time.perf_counter()
+            line_processor._merge_line_set(lines, geometry)
+            merge_times.append(time.perf_counter() - start_time)
+            line_counts.append(len(lines))
+    line_counts, merge_times = np.array(line_counts), np.array(merge_times)
+    print('hough lines   frames  merge p50  merge p90')
+    for low, high in zip(LINE_COUNT_BUCKETS, LINE_COUNT_BUCKETS[1:] + (np.inf,)):
+        in_bucket = (line_counts >= low) & (line_counts < high)
+        if in_bucket.any():
+            merge_p50, merge_p90 = np.percentile(merge_times[in_bucket], (50, 90)) * 1000
+            print(f'{f"{low}-{high}":>11} {np.count_nonzero(in_bucket):8} {merge_p50:8.3f}ms {merge_p90:8.3f}ms')
+
+def write_corpus(track_map, args):
+    """A session of frames at random poses on the tape for replay_session.py, with the ground truth tape paths next to it"""
+    width, height = (int(size) for size in args.resolutions[0].split('x'))
+    renderer = make_renderer(track_map, (height, width), args)
+    recorder = SessionRecorder(args.corpus, (height, width, 3), args.frames)
+    ground_truth = []
+    for i, (x, y, heading) in enumerate(renderer.get_random_poses(args.frames)):
+        frame, tape_paths = renderer.render(x, y, heading)
+        recorder.record(frame, 1 + i / 30)
+        ground_truth.append(tape_paths)
+    recorder.close()
+    np.savez(args.corpus.removesuffix('.npy') + '_ground_truth.npz', *ground_truth)
+    print(f'Wrote {args.frames} frames of {args.resolutions[0]} to {args.corpus}')
+
+def make_renderer(track_map, frame_shape, args) -> TrackRenderer:
+    return TrackRenderer(track_map, frame_shape, tape_width=args.tape_width, noise=args.noise,
+                         lighting_gradient=args.lighting_gradient, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the line processing on synthetic frames of a map')
+    parser.add_argument('--map', default='website/cool-maps/test.txt', help='map file in the format of parse-map.js')
+    parser.add_argument('--frames', type=int, default=50, help='frames per measurement (default: 50)')
+    parser.add_argument('--resolutions', nargs='+', default=['320x240', '640x480', '1280x960'])
+    parser.add_argument('--tape-width', type=float, default=0.5, help='in map units, the frame is 8 units wide')
+    parser.add_argument('--noise', type=float, default=6.0)
+    parser.add_argument('--lighting-gradient', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', help='write a session of the first resolution to this .npy file instead')
+    args = parser.parse_args()
+
+    with open(args.map) as file:
+        track_map = parse_map(file.read())
+    if args.corpus is not None:
+        write_corpus(track_map, args)
+    else:
+        benchmark_resolutions(track_map, args)
+        benchmark_line_counts(track_map, args)
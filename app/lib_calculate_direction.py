@@ -1,7 +1,9 @@
-from math import asin, cos, pi, sin, sqrt
-from lib_process_lines import Line, LineSegment, _get_intersection_point
+from math import cos, pi, sin
+from lib_frame_geometry import FrameGeometry
+from lib_process_lines import Line, LineSegment, SegmentSet, _get_intersection_point
 from lib_vector2d import Vector2D
 from os import getpid
+import numpy as np
 
 STATE_FOLLOWING_LINE = 0
 STATE_I_SEE_INTERSECTION = 1
@@ -48,28 +50,24 @@ class DirectionCalculator:
         #print(f'After: {self}')
 
 
-    def get_direction_vector(self, tape_paths: 'dict[LineSegment, Line]', frame) -> Vector2D:
-        target_path, target_line = self.decide_target(frame, tape_paths)
+    def get_direction_vector(self, tape_paths: SegmentSet, geometry: FrameGeometry) -> Vector2D:
+        target_path, target_line, _ = self.decide_target(geometry, tape_paths)
         if(target_path is None):
             return Vector2D(0, 0)
-        displacement_vector = self._get_displacement_vector_from_center(target_line, frame)
+        displacement_vector = self._get_displacement_vector_from_center(target_line, geometry)
         line_direction_vector = target_path.get_direction_vector()
-        direction_vector = self._get_direction_to_go(displacement_vector, line_direction_vector, frame)
+        direction_vector = self._get_direction_to_go(displacement_vector, line_direction_vector, geometry)
         return direction_vector
 
 
-    def _get_direction_to_go(self, displacement_vector: Vector2D, direction_vector: Vector2D, image_frame) -> Vector2D:
+    def _get_direction_to_go(self, displacement_vector: Vector2D, direction_vector: Vector2D, geometry: FrameGeometry) -> Vector2D:
         distance_from_center = displacement_vector.get_length()
         #Avoid dividing by zero when displacement vector has length zero
 
         displacement_vector = displacement_vector.normalize()
         direction_vector = direction_vector.normalize()
 
-        frame_width = image_frame.shape[1]
-        frame_height = image_frame.shape[0]
-        diagonal = sqrt((frame_width / 2) ** 2 + (frame_height / 2) ** 2)
-
-        displacement_vector_weight = distance_from_center / diagonal
+        displacement_vector_weight = distance_from_center / geometry.diagonal
         direction_vector_weight = 1 - displacement_vector_weight
 
         velocity_vector = direction_vector_weight * direction_vector + displacement_vector_weight * displacement_vector
@@ -78,16 +76,12 @@ class DirectionCalculator:
         return velocity_vector
 
 
-    def _get_displacement_vector_from_center(self, line: Line, frame) -> Vector2D:
+    def _get_displacement_vector_from_center(self, line: Line, geometry: FrameGeometry) -> Vector2D:
         rho, theta = line.rho, line.theta
-
-        frame_width = frame.shape[1]
-        frame_height = frame.shape[0]
-        center = Vector2D(frame_width / 2, -1 * frame_height / 2)
-        diagonal = center.get_length()
+        diagonal = geometry.diagonal
+        gamma = geometry.gamma
 
         displacement_angle = pi - theta
-        gamma = asin((frame_height / 2) / diagonal)
         displacement_length = (diagonal - (rho / sin(pi / 2 - theta + gamma))) * sin(pi / 2 - theta + gamma)
 
         x_coord = displacement_length * cos(displacement_angle)
@@ -96,8 +90,8 @@ class DirectionCalculator:
         return Vector2D(x_coord, y_coord)
 
 
-    def decide_target(self, original_frame, tape_paths) -> 'tuple[LineSegment, Line]':
-        self._update_state(original_frame, tape_paths)
+    def decide_target(self, geometry: FrameGeometry, tape_paths: SegmentSet) -> 'tuple[LineSegment, Line, int]':
+        self._update_state(geometry, tape_paths)
         state = self._stable_state
         target_path = None
         target_line = None
@@ -113,7 +107,7 @@ class DirectionCalculator:
             #some input has to go here if we wanna be able to get out of this state
             target_path, target_line = self._decide_target_from_stopped()
         elif state == STATE_TURN180:
-            target_path, target_line = self._decide_target_from_turning_180(original_frame)
+            target_path, target_line = self._decide_target_from_turning_180(geometry)
         elif state == STATE_LINE_LOST:
             target_path, target_line, current_node = self._decide_target_from_lost()
 
@@ -123,16 +117,16 @@ class DirectionCalculator:
         return target_path, target_line, current_node
 
 
-    def _update_state(self, frame, tape_paths_and_lines):
-        parallel_line_centers = list(set(tape_paths_and_lines.values()))
-        count_paths = len(list(tape_paths_and_lines.keys()))
+    def _update_state(self, geometry: FrameGeometry, tape_paths: SegmentSet):
+        parallel_line_centers = tape_paths.get_distinct_lines()
+        count_paths = len(tape_paths)
         current_state = self._stable_state
         next_state = None
 
         if current_state == STATE_FOLLOWING_LINE:
-            next_state = self._get_next_state_from_following(count_paths, parallel_line_centers, frame)
+            next_state = self._get_next_state_from_following(count_paths, parallel_line_centers, geometry)
         elif current_state == STATE_I_SEE_INTERSECTION:
-            next_state = self._get_next_state_from_seeing_intersection(count_paths, parallel_line_centers, frame)
+            next_state = self._get_next_state_from_seeing_intersection(count_paths, parallel_line_centers, geometry)
         elif current_state == STATE_TURNING:
             next_state = self._get_next_state_from_turning(count_paths)
         elif current_state == STATE_STOPPED:
@@ -148,12 +142,12 @@ class DirectionCalculator:
         self._stable_state = self._get_stable_state(next_state)
 
     
-    def _get_next_state_from_following(self, path_count, parallel_line_centers: list, frame):
+    def _get_next_state_from_following(self, path_count, parallel_line_centers: list, geometry: FrameGeometry):
         next_state = None
         if path_count > 1:
             if len(parallel_line_centers) >= 2:
                 intersection_red = _get_intersection_point(parallel_line_centers[0], parallel_line_centers[1])
-                if intersection_red[1] > frame.shape[0]*self._REACT_TO_INTERSECTION_THRESHOLD:
+                if intersection_red[1] > geometry.height*self._REACT_TO_INTERSECTION_THRESHOLD:
                     next_state = STATE_TURNING
                     self._turning_just_initiated = True
                 else:
@@ -166,11 +160,11 @@ class DirectionCalculator:
             next_state = STATE_LINE_LOST
         return next_state
 
-    def _get_next_state_from_seeing_intersection(self, path_count, parallel_line_centers, frame):
+    def _get_next_state_from_seeing_intersection(self, path_count, parallel_line_centers, geometry: FrameGeometry):
         next_state = None
         if path_count > 1:
             intersection_red = _get_intersection_point(parallel_line_centers[0], parallel_line_centers[1])
-            if intersection_red[1] > frame.shape[0]*self._REACT_TO_INTERSECTION_THRESHOLD:
+            if intersection_red[1] > geometry.height*self._REACT_TO_INTERSECTION_THRESHOLD:
                 next_state = STATE_TURNING
                 self._turning_just_initiated = True
             else:
@@ -240,16 +234,16 @@ class DirectionCalculator:
         return self._stable_state
 
 
-    def _decide_target_from_following(self, tape_paths_and_lines):
+    def _decide_target_from_following(self, tape_paths: SegmentSet):
         target_path = None
         target_line = None
-        paths = list(tape_paths_and_lines.keys())
+        paths = tape_paths
         if(len(paths) == 1): # stable state
             target_path = paths[0]
-            target_line = tape_paths_and_lines.get(target_path)
+            target_line = target_path.line
         if(len(paths) > 1): # transient state
-            target_path = self._get_most_like('back', tape_paths_and_lines).flip()
-            target_line = tape_paths_and_lines.get(target_path)
+            target_path = self._get_most_like('back', tape_paths).flip()
+            target_line = target_path.line
         if(len(paths) == 0): # transient state
             target_path = self._last_target
             target_line = self._last_line
@@ -257,34 +251,34 @@ class DirectionCalculator:
         return target_path, target_line
 
     
-    def _decide_target_from_seeing_intersection(self, tape_paths_and_lines):
+    def _decide_target_from_seeing_intersection(self, tape_paths: SegmentSet):
         target_path = None
         target_line = None
-        paths = list(tape_paths_and_lines.keys())
+        paths = tape_paths
         if(len(paths) > 1): # stable state
-            target_path = self._get_most_like('back', tape_paths_and_lines).flip()
-            target_line = tape_paths_and_lines.get(target_path)
+            target_path = self._get_most_like('back', tape_paths).flip()
+            target_line = target_path.line
         if(len(paths) <= 1): # transient state
             target_path = self._last_target
             target_line = self._last_line
         return target_path, target_line
 
 
-    def _decide_target_from_turning(self, tape_paths_and_lines):
+    def _decide_target_from_turning(self, tape_paths: SegmentSet):
         target_path = None
         target_line = None
         current_node = None
-        paths = list(tape_paths_and_lines.keys())
+        paths = tape_paths
         if(len(paths) > 1): # stable state
             if self._turning_just_initiated:
                 if len(self._path_plan) != 0:
                     instruction = self._path_plan.pop(0)
-                    target_path = self._get_most_like(instruction['choose'], tape_paths_and_lines)
-                    target_line = tape_paths_and_lines.get(target_path)
+                    target_path = self._get_most_like(instruction['choose'], tape_paths)
+                    target_line = target_path.line if target_path is not None else None
                     current_node = instruction['nodeId']
             else:
-                target_path = self._update_target(self._last_target, tape_paths_and_lines) if self._last_target is not None else None
-                target_line = tape_paths_and_lines.get(target_path)
+                target_path = self._update_target(self._last_target, tape_paths) if self._last_target is not None else None
+                target_line = target_path.line if target_path is not None else None
         if(len(paths) <= 1): # transient state
             target_path = self._last_target
             target_line = self._last_line
@@ -295,13 +289,12 @@ class DirectionCalculator:
         return None, None
 
 
-    def _decide_target_from_turning_180(self, original_frame):
-        frame_width = original_frame.shape[1]
-        frame_height = original_frame.shape[0]
-        center = (int(frame_width / 2), int(frame_height / 2))
-        center_left = (0, int(frame_height / 2))
-        center_to_left = LineSegment(center, center_left)
-        horizontal_line = Line(frame_height / 2, pi / 2)
+    def _decide_target_from_turning_180(self, geometry: FrameGeometry):
+        center_x, center_y = geometry.center
+        center = (int(center_x), int(center_y))
+        center_left = (0, int(center_y))
+        horizontal_line = Line(center_y, pi / 2)
+        center_to_left = LineSegment(center, center_left, horizontal_line)
         return center_to_left, horizontal_line
 
 
@@ -313,31 +306,32 @@ class DirectionCalculator:
         return None, None, current_node
 
 
-    def _get_most_like(self, turning_direction: str, tape_paths_and_lines: 'dict[LineSegment, Line]') -> LineSegment:
-        for path in list(tape_paths_and_lines.keys()):
-            angle = path.get_direction_vector().get_angle()
-            if ((turning_direction == 'right' and angle >= -pi/4 and angle <= pi/4)
-                    or (turning_direction == 'left' and ((angle >= 3*pi/4) or (angle <= -3*pi/4)))
-                    or (turning_direction == 'straight' and angle >= -3*pi/4 and angle <= -pi/4)
-                    or (turning_direction == 'back' and angle >= pi/4 and angle <= 3*pi/4)):
-                return path
-        
+    def _get_most_like(self, turning_direction: str, tape_paths: SegmentSet) -> LineSegment:
+        angles = tape_paths.get_direction_angles()
+        if turning_direction == 'right':
+            is_like = (angles >= -pi/4) & (angles <= pi/4)
+        elif turning_direction == 'left':
+            is_like = (angles >= 3*pi/4) | (angles <= -3*pi/4)
+        elif turning_direction == 'straight':
+            is_like = (angles >= -3*pi/4) & (angles <= -pi/4)
+        elif turning_direction == 'back':
+            is_like = (angles >= pi/4) & (angles <= 3*pi/4)
+        else:
+            return None
+        like_indices = np.flatnonzero(is_like)
+        if len(like_indices) > 0:
+            return tape_paths[int(like_indices[0])]
+
         #print('your map sucks')
 
 
-    def _update_target(self, old_target: LineSegment, tape_paths_and_lines: 'dict[LineSegment, Line]') -> LineSegment:
-        min_angle_dif = 2*pi
-        min_angle_path = None
-        for path in list(tape_paths_and_lines.keys()):
-            angle_path = path.get_direction_vector().get_angle()
-            angle_old = old_target.get_direction_vector().get_angle()
-            angle_dif = abs(angle_old-angle_path)
-            if angle_dif > pi:
-                angle_dif = 2*pi - angle_dif
-            if angle_dif < min_angle_dif: 
-                min_angle_dif = angle_dif
-                min_angle_path = path
-        return min_angle_path
+    def _update_target(self, old_target: LineSegment, tape_paths: SegmentSet) -> LineSegment:
+        if len(tape_paths) == 0:
+            return None
+        angle_old = old_target.get_direction_vector().get_angle()
+        angle_difs = np.abs(angle_old - tape_paths.get_direction_angles())
+        angle_difs = np.where(angle_difs > pi, 2*pi - angle_difs, angle_difs)
+        return tape_paths[int(np.argmin(angle_difs))]
 
     def __str__(self):
         return (f'process id: {getpid()}, ' + \
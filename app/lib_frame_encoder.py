@@ -0,0 +1,93 @@
+import time
+import cv2 as cv
+from lib_lines_display import ALL_LAYERS
+
+VARIANT_FULL = 'full'
+VARIANT_THUMBNAIL = 'thumbnail'
+VARIANT_PLAIN = 'plain' # without the overlay, the browser draws it from the telemetry
+
+
+class FrameEncoder:
+    """JPEG encodes the variants of a frame that somebody watches, each variant once per frame.
+
+    A variant is a scale of the camera frame and the overlay layers drawn on it. The quality, and below min_quality the resolution
+    of every variant, goes down while encoding takes more than cpu_budget seconds per frame or
+    the viewers get more than bandwidth_budget bytes per second, and back up when both are well
+    below their budget.
+    """
+    def __init__(self, variants={VARIANT_FULL: (0.5, ALL_LAYERS),
+                                 VARIANT_THUMBNAIL: (0.2, ALL_LAYERS),
+                                 VARIANT_PLAIN: (0.25, frozenset())},
+                 cpu_budget=0.01, bandwidth_budget=2_000_000,
+                 min_quality=30, max_quality=85, quality_step=5, min_resolution=0.5, adapt_interval=10):
+        self._VARIANTS = variants
+        self._CPU_BUDGET = cpu_budget
+        self._BANDWIDTH_BUDGET = bandwidth_budget
+        self._MIN_QUALITY = min_quality
+        self._MAX_QUALITY = max_quality
+        self._QUALITY_STEP = quality_step
+        self._MIN_RESOLUTION = min_resolution
+        self._ADAPT_INTERVAL = adapt_interval
+        self.quality = max_quality
+        self.resolution = 1.0 # multiplier of the scale of every variant
+        self._load = 0.0 # smoothed fraction of the budget that is used
+        self._frame_interval = 1 / 30 # smoothed time between two encoded frames
+        self._last_encode_time = None
+        self._frames_since_adapt = 0
+
+    def get_variants(self) -> 'list[str]':
+        return list(self._VARIANTS)
+
+    def encode(self, render, viewers: 'dict[str, int]') -> 'dict[str, bytes]':
+        """Encodes the variants with at least one viewer.
+
+        render(scale, layers) returns the frame to encode, scale times the size of the camera frame.
+        It is called once for the largest variant with the same layers, the smaller ones are
+        scaled down from it.
+        """
+        variants = [variant for variant, count in viewers.items() if count > 0 and variant in self._VARIANTS]
+        if len(variants) == 0:
+            return {}
+        start_time = time.perf_counter()
+        variants.sort(key=lambda variant: self._VARIANTS[variant][0], reverse=True)
+        rendered_frames = {} # layers -> (scale, frame)
+        frames_encoded = {}
+        for variant in variants:
+            scale, layers = self._VARIANTS[variant]
+            scale *= self.resolution
+            if layers not in rendered_frames:
+                rendered_frames[layers] = (scale, render(scale, layers))
+            rendered_scale, image = rendered_frames[layers]
+            if scale != rendered_scale:
+                image = cv.resize(image, None, fx=scale/rendered_scale, fy=scale/rendered_scale,
+                                  interpolation=cv.INTER_AREA)
+            ret, buffer = cv.imencode('.jpg', image, [cv.IMWRITE_JPEG_QUALITY, self.quality])
+            frames_encoded[variant] = buffer.tobytes()
+        sent_bytes = sum(len(frames_encoded[variant]) * viewers[variant] for variant in variants)
+        self._adapt(time.perf_counter() - start_time, sent_bytes)
+        return frames_encoded
+
+    def _adapt(self, encode_time, sent_bytes):
+        now = time.monotonic()
+        if self._last_encode_time is not None:
+            self._frame_interval += 0.1 * (now - self._last_encode_time - self._frame_interval)
+        self._last_encode_time = now
+        load = max(encode_time / self._CPU_BUDGET,
+                   sent_bytes / self._frame_interval / self._BANDWIDTH_BUDGET)
+        self._load += 0.2 * (load - self._load)
+        # give the smoothed load time to follow the last change
+        self._frames_since_adapt += 1
+        if self._frames_since_adapt < self._ADAPT_INTERVAL:
+            return
+        self._frames_since_adapt = 0
+        if self._load > 1:
+            # lower the quality first, the resolution only when the quality is as low as it goes
+            if self.quality > self._MIN_QUALITY:
+                self.quality = max(self.quality - self._QUALITY_STEP, self._MIN_QUALITY)
+            else:
+                self.resolution = max(self.resolution * 0.9, self._MIN_RESOLUTION)
+        elif self._load < 0.5:
+            if self.resolution < 1:
+                self.resolution = min(self.resolution / 0.9, 1.0)
+            else:
+                self.quality = min(self.quality + self._QUALITY_STEP, self._MAX_QUALITY)
@@ -0,0 +1,93 @@
+from math import asin, pi, sqrt
+import numpy as np
+
+THETA_STEP = pi / 180 # angular resolution of cv.HoughLines
+
+
+class FrameGeometry:
+    """Everything about a frame that only depends on its shape.
+
+    Use FrameGeometry.of(frame) to get the geometry, it is only built once per frame shape.
+    """
+    def __init__(self, width: int, height: int) -> 'FrameGeometry':
+        self.width = width
+        self.height = height
+        self.max_x = width - 1
+        self.max_y = height - 1
+        self.center = (width / 2, height / 2)
+        self.diagonal = sqrt((width / 2) ** 2 + (height / 2) ** 2) # from the center to a corner
+        self.gamma = asin((height / 2) / self.diagonal) # angle of the diagonal with the x axis
+
+        # trigonometry of every theta bin HoughLines can output, including pi
+        theta_bins = np.arange(round(pi / THETA_STEP) + 1) * THETA_STEP
+        self._cos_table = np.cos(theta_bins)
+        self._sin_table = np.sin(theta_bins)
+        self._tan_table = np.tan(theta_bins - pi/2)
+
+    @classmethod
+    def of(cls, frame) -> 'FrameGeometry':
+        height, width = frame.shape[0], frame.shape[1]
+        geometry = _geometries.get((width, height))
+        if geometry is None:
+            geometry = _geometries[(width, height)] = cls(width, height)
+        return geometry
+
+    def get_trigonometry(self, thetas) -> 'tuple[np.ndarray, np.ndarray, np.ndarray]':
+        """Returns cos(theta), sin(theta) and tan(theta - pi/2).
+
+        Looked up in the tables when every theta is on a Hough bin, computed otherwise.
+        """
+        bins = np.rint(thetas * (1 / THETA_STEP))
+        if len(thetas) > 0 and np.abs(thetas - bins * THETA_STEP).max() < 1e-6:
+            bins = bins.astype(np.intp)
+            return self._cos_table[bins], self._sin_table[bins], self._tan_table[bins]
+        with np.errstate(divide='ignore'):
+            return np.cos(thetas), np.sin(thetas), np.tan(thetas - pi/2)
+
+    def get_rotated_rhos(self, rhos, thetas) -> 'np.ndarray':
+        """rho of the lines in the frame rotated by 180 degrees, their theta stays the same.
+
+        The rotation maps (x, y) to (max_x - x, max_y - y), which makes rho = max_x*cos(theta) + max_y*sin(theta) - rho.
+        """
+        cos, sin, _ = self.get_trigonometry(thetas)
+        return self.max_x*cos + self.max_y*sin - rhos
+
+    def get_frame_intersection_points(self, rhos, thetas) -> 'np.ndarray':
+        """Finds where each line crosses the border of the frame.
+
+        Returns an (N, 2, 2) array with the two frame intersection points of every
+        line, NaN where a line does not cross the frame. When a line passes close to
+        a corner more than two candidates survive the rounding, in which case the
+        two furthest apart are used.
+        """
+        cos, sin, slopes = self.get_trigonometry(thetas)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            x_intercepts = np.trunc(rhos*cos - rhos*sin/slopes)
+            y_intercepts = np.trunc(rhos*sin - rhos*cos*slopes)
+            zeros = np.zeros_like(rhos)
+            # left, right, top and bottom side of the frame
+            candidates = np.stack([
+                np.stack([zeros, y_intercepts], axis=-1),
+                np.stack([zeros + self.max_x, np.trunc(slopes*self.max_x + y_intercepts)], axis=-1),
+                np.stack([x_intercepts, zeros], axis=-1),
+                np.stack([np.trunc(1/slopes*self.max_y + x_intercepts), zeros + self.max_y], axis=-1)
+            ], axis=1)
+            in_frame = ((candidates[:, :, 0] >= 0) & (candidates[:, :, 0] <= self.max_x)
+                        & (candidates[:, :, 1] >= 0) & (candidates[:, :, 1] <= self.max_y))
+        candidates[~in_frame] = np.nan
+        firsts, seconds = _CANDIDATE_PAIRS
+        pair_lengths = np.linalg.norm(
+            candidates[:, firsts] - candidates[:, seconds], axis=-1)
+        pair_lengths[~(pair_lengths > 0)] = -1 # missing or identical points
+        best_pairs = np.argmax(pair_lengths, axis=1)
+        rows = np.arange(len(rhos))
+        points = np.stack([candidates[rows, firsts[best_pairs]],
+                           candidates[rows, seconds[best_pairs]]], axis=1)
+        points[pair_lengths[rows, best_pairs] < 0] = np.nan
+        return points
+
+
+_geometries: 'dict[tuple[int, int], FrameGeometry]' = {}
+
+_CANDIDATE_PAIRS = tuple(np.array(indices) for indices in zip(
+    *[(i, j) for i in range(4) for j in range(i + 1, 4)]))
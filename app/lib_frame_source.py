@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+import cv2 as cv
+
+
+class FrameSource:
+    """Reads a cv.VideoCapture on its own thread and always hands out the newest frame.
+
+    The grabbed frames go into a small ring buffer together with their capture timestamp
+    (time.monotonic), so the camera never waits for the processing and the processing
+    never gets a frame that has been sitting in the camera queue. Frames that are
+    replaced before anybody read them are counted in dropped_frames.
+    """
+    def __init__(self, capture: cv.VideoCapture, buffer_size=2):
+        self._capture = capture
+        self._ring: list[tuple] = [None] * buffer_size
+        self._grabbed_count = 0 # number of the newest frame, 0 before the first one
+        self._read_count = 0 # number of the newest frame that has been handed out
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.dropped_frames = 0
+
+    def start(self) -> 'FrameSource':
+        self._running = True
+        self._thread = threading.Thread(target=self._grab_frames, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def release(self):
+        self.stop()
+        self._capture.release()
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def read(self, timeout=None) -> 'tuple[bool, object, float]':
+        """Waits for a frame newer than the last one read.
+
+        Returns (success, frame, timestamp) like cv.VideoCapture.read, plus the
+        capture time. success is False when the source stopped or timed out.
+        """
+        with self._condition:
+            has_new_frame = self._condition.wait_for(
+                lambda: self._grabbed_count > self._read_count or not self._running, timeout)
+            if not has_new_frame or self._grabbed_count == self._read_count:
+                return False, None, None
+            self.dropped_frames += self._grabbed_count - self._read_count - 1
+            self._read_count = self._grabbed_count
+            frame, timestamp = self._ring[self._grabbed_count % len(self._ring)]
+            return True, frame, timestamp
+
+    async def read_async(self, timeout=None) -> 'tuple[bool, object, float]':
+        """Same as read, without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.read, timeout)
+
+    def _grab_frames(self):
+        while self._running and self._capture.isOpened():
+            ret_read, frame = self._capture.read()
+            timestamp = time.monotonic()
+            if not ret_read:
+                # end of a video file, start it over
+                self._capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+                continue
+            with self._condition:
+                self._grabbed_count += 1
+                self._ring[self._grabbed_count % len(self._ring)] = (frame, timestamp)
+                self._condition.notify_all()
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
@@ -1,33 +1,189 @@
+from math import sqrt
 import cv2 as cv
 import numpy as np
 
+_FULL_FRAME = (slice(None), slice(None))
+
 class ImageProcessor:
-    def __init__(self, blur=10, block_size=5, c=3, threshold=65):
+    """Finds the edges and hough lines of camera frames.
+
+    Only the roi (x, y, width, height) of the camera frame is processed, after scaling it by
+    scale. The kernel sizes (blur and block_size) are in camera pixels and get scaled along.
+    The edges and lines are always returned in the coordinates of the whole camera frame.
+
+    threshold is the number of hough votes at scale 1 and gets scaled by sqrt(scale). Scaling it
+    by scale itself lets through so many short lines that the wrong ones get merged and paired:
+    on synthetic frames at scale 0.5, 54% of the frames had no tape path instead of 10%, with
+    sqrt(scale) 11%. The edges come back 1/scale pixels thick, so a LineProcessor for them needs
+    the same edge_scale.
+    """
+    def __init__(self, blur=10, block_size=5, c=3, threshold=65, reuse_buffers=False, roi=None, scale=1.0):
         self._BLUR = blur
         self._BLOCK_SIZE = block_size
         self._C = c
-        self._THRESHOLD = threshold
+        self._THRESHOLD = max(round(threshold*sqrt(scale)), 1)
+        self._REUSE_BUFFERS = reuse_buffers
+        self._ROI = roi
+        self._SCALE = scale
+        self._MEDIAN_KSIZE = 2*round(blur*scale)+1
+        self._BLOCK_KSIZE = max(2*round((block_size+1)*scale)+1, 3)
+        self._buffers: dict[tuple[str, tuple[int, ...]], np.ndarray] = {}
+
+    def __getstate__(self):
+        # the buffers are only scratch space, no need to send them to another process
+        state = self.__dict__.copy()
+        state['_buffers'] = {}
+        return state
+
+    def get_edges_and_houghlines(self, camera_frame, rotate_180=False):
+        """Finds the edges and hough lines of the camera frame.
 
-    def get_edges_and_houghlines(self, camera_frame):
-        processed_frame = self._process_frame(camera_frame)
+        With rotate_180 the hough lines are returned as if the camera frame had been rotated by
+        180 degrees. Neither the camera frame nor the edges are rotated, only the lines are, so
+        the edges stay the camera's, for LineProcessor.analyze_frame with edges_rotated_180.
+
+        With reuse_buffers the returned edges are one of the processor's buffers, the next call
+        overwrites them, so they have to be copied to be kept past it.
+        """
+        processed_frame = self._process_frame(
+            self._to_processing_space(camera_frame, 'scaled_frame', cv.INTER_AREA))
         edges, lines = self._find_edges_and_houghlines(processed_frame)
+        edges, lines = self._to_camera_space(edges, lines, camera_frame.shape[:2])
+        if rotate_180 and lines is not None:
+            lines = _rotate_houghlines_180(lines, edges.shape)
         return edges, lines
 
-    def _process_frame(self, camera_frame):
-        processed_frame = cv.cvtColor(camera_frame, cv.COLOR_BGR2GRAY)
-        processed_frame = cv.medianBlur(processed_frame, 2*self._BLUR+1)
+    def get_houghlines(self, edges, rotate_180=False):
+        """The hough lines of edges get_edges_and_houghlines returned before, e.g. recorded ones"""
+        houghlines = self._find_houghlines(edges)
+        if rotate_180 and houghlines is not None:
+            houghlines = _rotate_houghlines_180(houghlines, edges.shape)
+        return houghlines
+
+    def get_edges_and_houghlines_in_strips(self, camera_frame, strip_mask, theta_ranges, rotate_180=False):
+        """Same as get_edges_and_houghlines, but only the edges inside strip_mask are kept
+        and only lines with a theta inside one of the (min_theta, max_theta) ranges are searched for.
+        The strip mask is in the orientation of the camera frame, like the edges, the rotation
+        does not change theta. The returned edges are a reused buffer in the same way.
+        """
+        frame_shape = strip_mask.shape
+        strip_mask = self._to_processing_space(strip_mask, 'scaled_strip_mask', cv.INTER_NEAREST)
+        processing_shape = strip_mask.shape
+        edges = self._get_zeroed_buffer('strip_edges', processing_shape)
+        houghlines = None
+        x, y, width, height = cv.boundingRect(strip_mask)
+        if width > 0 and height > 0:
+            # the blur, threshold and canny kernels look this far outside of the strips
+            border = self._MEDIAN_KSIZE // 2 + self._BLOCK_KSIZE // 2 + 2
+            region = (slice(max(y - border, 0), min(y + height + border, processing_shape[0])),
+                      slice(max(x - border, 0), min(x + width + border, processing_shape[1])))
+            processed_region = self._process_frame(
+                self._to_processing_space(camera_frame, 'scaled_frame', cv.INTER_AREA), region)
+            region_edges = self._find_edges(processed_region,
+                                            dst=self._get_buffer('edges', processing_shape, region))
+            cv.bitwise_and(region_edges, strip_mask[region], dst=edges[region])
+
+            houghlines = [self._find_houghlines(edges, min_theta, max_theta)
+                          for min_theta, max_theta in theta_ranges]
+            houghlines = [lines for lines in houghlines if lines is not None]
+            houghlines = np.concatenate(houghlines) if len(houghlines) > 0 else None
+        edges, houghlines = self._to_camera_space(edges, houghlines, frame_shape)
+        if rotate_180 and houghlines is not None:
+            houghlines = _rotate_houghlines_180(houghlines, frame_shape)
+        return edges, houghlines
+
+    def _process_frame(self, camera_frame, region=_FULL_FRAME):
+        """region is a pair of slices, only that part of the camera frame is processed"""
+        frame_shape = camera_frame.shape[:2]
+        processed_frame = cv.cvtColor(
+            camera_frame[region], cv.COLOR_BGR2GRAY,
+            dst=self._get_buffer('gray', frame_shape, region))
+        processed_frame = cv.medianBlur(
+            processed_frame, self._MEDIAN_KSIZE,
+            dst=self._get_buffer('blurred', frame_shape, region))
         processed_frame = cv.adaptiveThreshold(
             processed_frame,
             255,
             cv.ADAPTIVE_THRESH_GAUSSIAN_C,
             cv.THRESH_BINARY,
-            2*(self._BLOCK_SIZE+1)+1,
-            self._C)
+            self._BLOCK_KSIZE,
+            self._C,
+            dst=self._get_buffer('thresholded', frame_shape, region))
         return processed_frame
 
     def _find_edges_and_houghlines(self, processed_frame):
-        edges = cv.Canny(processed_frame, 50, 150, apertureSize = 3)
-        houghlines = cv.HoughLines(edges, 1, np.pi/180, self._THRESHOLD)
+        edges = self._find_edges(processed_frame,
+                                 dst=self._get_buffer('edges', processed_frame.shape))
+        houghlines = self._find_houghlines(edges)
         return edges, houghlines
 
-    
\ No newline at end of file
+    def _find_edges(self, processed_frame, dst=None):
+        return cv.Canny(processed_frame, 50, 150, edges=dst, apertureSize = 3)
+
+    def _find_houghlines(self, edges, min_theta=0, max_theta=np.pi):
+        return cv.HoughLines(edges, 1, np.pi/180, self._THRESHOLD,
+                             min_theta=min_theta, max_theta=max_theta)
+
+    def _get_roi(self, frame_shape) -> 'tuple[int, int, int, int]':
+        if self._ROI is None:
+            return 0, 0, frame_shape[1], frame_shape[0]
+        return self._ROI
+
+    def _to_processing_space(self, image, buffer_name, interpolation):
+        """Crops the roi out of a camera sized image and scales it"""
+        x, y, width, height = self._get_roi(image.shape)
+        image = image[y:y+height, x:x+width]
+        if self._SCALE == 1:
+            return image
+        size = (round(width*self._SCALE), round(height*self._SCALE))
+        return cv.resize(image, size, interpolation=interpolation,
+                         dst=self._get_buffer(buffer_name, (size[1], size[0]) + image.shape[2:]))
+
+    def _to_camera_space(self, edges, houghlines, frame_shape):
+        """Maps edges and hough lines found in the scaled roi back to the whole camera frame.
+
+        A pixel x of the scaled roi covers the camera pixels around (x + 0.5)/scale - 0.5 + roi_x,
+        which makes rho = rho/scale + offset_x*cos(theta) + offset_y*sin(theta).
+        """
+        if self._ROI is None and self._SCALE == 1:
+            return edges, houghlines
+        x, y, width, height = self._get_roi(frame_shape)
+        camera_edges = self._get_zeroed_buffer('camera_edges', frame_shape)
+        cv.resize(edges, (width, height), interpolation=cv.INTER_NEAREST,
+                  dst=camera_edges[y:y+height, x:x+width])
+        if houghlines is not None:
+            rhos, thetas = houghlines[:, 0, 0], houghlines[:, 0, 1]
+            offset_x = x + 0.5/self._SCALE - 0.5
+            offset_y = y + 0.5/self._SCALE - 0.5
+            houghlines = houghlines.copy()
+            houghlines[:, 0, 0] = rhos/self._SCALE + offset_x*np.cos(thetas) + offset_y*np.sin(thetas)
+        return camera_edges, houghlines
+
+    def _get_buffer(self, name, shape, region=_FULL_FRAME):
+        """Destination array for an OpenCV call, or None to let OpenCV allocate one"""
+        if not self._REUSE_BUFFERS:
+            return None
+        buffer = self._buffers.get((name, shape))
+        if buffer is None:
+            buffer = self._buffers[(name, shape)] = np.empty(shape, dtype=np.uint8)
+        return buffer[region]
+
+    def _get_zeroed_buffer(self, name, shape):
+        buffer = self._get_buffer(name, shape)
+        if buffer is None:
+            return np.zeros(shape, dtype=np.uint8)
+        buffer.fill(0)
+        return buffer
+
+
+def _rotate_houghlines_180(houghlines, frame_shape):
+    """Hough lines of the same frame rotated by 180 degrees.
+
+    The rotation maps (x, y) to (max_x - x, max_y - y), so theta stays the same and
+    rho becomes max_x*cos(theta) + max_y*sin(theta) - rho.
+    """
+    max_y, max_x = frame_shape[0] - 1, frame_shape[1] - 1
+    rhos, thetas = houghlines[:, 0, 0], houghlines[:, 0, 1]
+    rotated_houghlines = houghlines.copy()
+    rotated_houghlines[:, 0, 0] = max_x*np.cos(thetas) + max_y*np.sin(thetas) - rhos
+    return rotated_houghlines
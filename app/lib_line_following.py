@@ -1,11 +1,12 @@
 import time
-import cv2 as cv
-import numpy as np
 from lib_vector2d import Vector2D
-from lib_lines_display import display_all_lines, display_boxes_around_merged_lines, display_center_of_parallel_lines, display_direction_to_go, display_displacement_and_direction_vectors, display_merged_lines_segments, display_merged_parallel_lines, display_tape_paths
-from lib_calculate_direction import DirectionCalculator
-from lib_process_lines import LineProcessor
+from lib_lines_display import ALL_LAYERS, render_overlay
+from lib_calculate_direction import STATE_LINE_LOST, DirectionCalculator
+from lib_frame_geometry import FrameGeometry
+from lib_process_lines import FrameAnalysis, LineProcessor, LineSet
 from lib_image_processing import ImageProcessor
+from lib_line_tracking import LineTracker
+from lib_shared_frames import SharedFrameRing
 
 frames = 0
 start = time.time()
@@ -14,51 +15,128 @@ start = time.time()
 def get_processed_frame_and_direction_vector(original_frame,
         image_processor: ImageProcessor,
         line_processor: LineProcessor,
-        direction_calculator: DirectionCalculator):
+        direction_calculator: DirectionCalculator,
+        line_tracker: LineTracker = None,
+        overlay_layers=ALL_LAYERS,
+        overlay_scale=1.0):
+    """Processes a frame and renders the overlay layers on a copy of it, which is returned as 'frame'"""
     start_time = time.time()
     #print(direction_calculator)
+    processed_frame_info = _process_frame(original_frame, image_processor, line_processor,
+                                          direction_calculator, line_tracker)
+    processed_frame_info['frame'] = render_overlay(
+        original_frame, processed_frame_info['analysis'], processed_frame_info['overlay'],
+        overlay_layers, overlay_scale)
+    print(f'Inner time: {(time.time() - start_time)}')
+    return processed_frame_info
+
+
+def _process_frame(original_frame,
+        image_processor: ImageProcessor,
+        line_processor: LineProcessor,
+        direction_calculator: DirectionCalculator,
+        line_tracker: LineTracker = None):
+    analysis = analyze_camera_frame(original_frame, image_processor, line_processor, line_tracker,
+                                    line_lost=direction_calculator._stable_state == STATE_LINE_LOST)
+    processed_frame_info = decide_direction(original_frame, analysis, direction_calculator)
+    processed_frame_info['line_tracker'] = line_tracker
+    return processed_frame_info
+
+
+def analyze_camera_frame(original_frame,
+        image_processor: ImageProcessor,
+        line_processor: LineProcessor,
+        line_tracker: LineTracker = None,
+        line_lost=False) -> FrameAnalysis:
+    """The pixel heavy part of processing a frame, the camera frame itself is left as it is.
+
+    Without a line tracker it does not depend on earlier frames, so frames can be analyzed in parallel,
+    with one analyze_planned_frame can do that.
+    """
+    # original_frame = original_frame[:,30:]
+    # original_frame = cv.rotate(original_frame, cv.ROTATE_90_CLOCKWISE)
+    # the camera is mounted upside down, the lines are rotated instead of the camera frame
+    geometry = FrameGeometry.of(original_frame)
+    if line_tracker is None:
+        edges, houghlines = image_processor.get_edges_and_houghlines(
+            original_frame, rotate_180=True)
+    else:
+        edges, houghlines = line_tracker.get_edges_and_houghlines(
+            image_processor, original_frame, geometry, line_lost=line_lost, rotate_180=True)
+    analysis = line_processor.analyze_frame(geometry, edges, houghlines, edges_rotated_180=True)
+    if line_tracker is not None:
+        line_tracker.update(analysis.merged_lines)
+    return analysis
+
+
+def analyze_planned_frame(original_frame,
+        image_processor: ImageProcessor,
+        line_processor: LineProcessor,
+        line_tracker: LineTracker,
+        search_lines: 'LineSet | None') -> FrameAnalysis:
+    """analyze_camera_frame for a search line_tracker.plan_search planned beforehand.
+
+    Only the settings of the tracker are used, it is not updated, that is left to whoever
+    planned the search, in the order the frames were captured.
+    """
+    geometry = FrameGeometry.of(original_frame)
+    edges, houghlines = line_tracker.search(
+        image_processor, original_frame, geometry, search_lines, rotate_180=True)
+    return line_processor.analyze_frame(geometry, edges, houghlines, edges_rotated_180=True)
+
+
+def decide_direction(original_frame, analysis: FrameAnalysis,
+        direction_calculator: DirectionCalculator):
+    """The stateful part of processing a frame, frames have to go through it in capture order.
+
+    Nothing is drawn, the vectors and text to draw are returned as 'overlay', for render_overlay.
+    """
     global frames
     global start
     frames += 1
-    # original_frame = original_frame[:,30:]
-    # original_frame = cv.rotate(original_frame, cv.ROTATE_90_CLOCKWISE)
-    original_frame = cv.flip(original_frame, -1)
-    edges, houghlines = image_processor.get_edges_and_houghlines(original_frame)
-    tape_paths = line_processor.get_tape_paths(original_frame, edges, houghlines)
+    geometry = FrameGeometry.of(original_frame)
+    tape_paths = analysis.tape_paths
     velocity_vector = Vector2D(0, 0)
     current_node = None
-
-    if isinstance(houghlines, np.ndarray):
-        lines = line_processor._get_from_houghlines(houghlines)
-        merged_lines = line_processor._merge_lines(lines, original_frame)
-        merged_lines_segments = line_processor._get_tape_boundaries(merged_lines, edges)
-        parallel_line_centers = line_processor._get_centers_of_parallel_line_pairs(merged_lines)
-        tape_paths = line_processor._get_tape_paths_and_lines(parallel_line_centers, merged_lines_segments, original_frame)
-        display_all_lines(lines, original_frame)
-        display_merged_parallel_lines(merged_lines, original_frame)
-        display_boxes_around_merged_lines(merged_lines, original_frame, edges)
-        display_merged_lines_segments(merged_lines_segments, original_frame)
-        display_center_of_parallel_lines(parallel_line_centers, original_frame)
-        display_tape_paths(tape_paths, original_frame)
+    displacement_vector, direction_vector = None, None
 
     target_segment, target_line, current_node = direction_calculator.decide_target(
-                                                            original_frame,
+                                                            geometry,
                                                             tape_paths)
     if target_segment is not None:
-        displacement_vector = direction_calculator._get_displacement_vector_from_center(target_line, original_frame)
+        displacement_vector = direction_calculator._get_displacement_vector_from_center(target_line, geometry)
         direction_vector = target_segment.get_direction_vector()
-        velocity_vector = direction_calculator._get_direction_to_go(displacement_vector, direction_vector, original_frame)
-        display_displacement_and_direction_vectors(displacement_vector, direction_vector, original_frame)
-        display_direction_to_go(velocity_vector, original_frame)
+        velocity_vector = direction_calculator._get_direction_to_go(displacement_vector, direction_vector, geometry)
 
-    cv.putText(original_frame, f'Frame: #{frames}, fps: {(frames / (time.time() - start)):.2f}', (0,50), cv.FONT_HERSHEY_SIMPLEX, 1, (0,69,255), 2, cv.LINE_AA)
-    cv.putText(original_frame, f'Stable: {direction_calculator.get_state_string(direction_calculator._stable_state)}', (0,80), cv.FONT_HERSHEY_SIMPLEX, 1, (0,255,0), 2, cv.LINE_AA)
-    cv.putText(original_frame, f'Incoming: {direction_calculator.get_state_string(direction_calculator._last_incoming_state)} x{direction_calculator._same_incoming_states_count}', (0,110), cv.FONT_HERSHEY_SIMPLEX, 1, (0,0,255), 2, cv.LINE_AA)
+    stable_state = direction_calculator.get_state_string(direction_calculator._stable_state)
+    incoming_state = f'{direction_calculator.get_state_string(direction_calculator._last_incoming_state)} x{direction_calculator._same_incoming_states_count}'
+    text = [
+        (f'Frame: #{frames}, fps: {(frames / (time.time() - start)):.2f}', (0,69,255)),
+        (f'Stable: {stable_state}', (0,255,0)),
+        (f'Incoming: {incoming_state}', (0,0,255))
+    ]
 
-    print(f'Inner time: {(time.time() - start_time)}')
     return {
-        'frame': original_frame,
         'velocity_vector': (-velocity_vector.x, -velocity_vector.y),
         'current_node': current_node,
-        'direction_calculator': direction_calculator
-    }
\ No newline at end of file
+        'direction_calculator': direction_calculator,
+        'analysis': analysis,
+        'overlay': {
+            'displacement_vector': displacement_vector,
+            'direction_vector': direction_vector,
+            'direction_to_go': velocity_vector,
+            'stable_state': stable_state,
+            'incoming_state': incoming_state,
+            'text': text
+        }
+    }
+
+
+def process_shared_frame(frame_ring: SharedFrameRing, slot: int,
+        image_processor: ImageProcessor,
+        line_processor: LineProcessor,
+        direction_calculator: DirectionCalculator,
+        line_tracker: LineTracker = None):
+    """Processes the frame in a slot of frame_ring, without rendering the overlay"""
+    return _process_frame(frame_ring.get_frame(slot), image_processor, line_processor,
+                          direction_calculator, line_tracker)
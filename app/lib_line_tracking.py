@@ -0,0 +1,195 @@
+from math import pi
+import cv2 as cv
+import numpy as np
+from lib_frame_geometry import THETA_STEP, FrameGeometry
+from lib_image_processing import ImageProcessor
+from lib_process_lines import LineSet
+
+
+class LineTracker:
+    """Keeps an alpha-beta filtered estimate of every merged line between frames.
+
+    While every track is confident, edges and hough lines are only searched for in
+    narrow strips around the predicted lines and in a theta window around their angles.
+    The whole frame is searched again when a track gets lost, when the line is lost,
+    and every full_frame_interval frames so new lines (intersections) are picked up.
+    """
+    def __init__(self, strip_width=50, theta_margin=8*THETA_STEP,
+                 alpha=0.6, beta=0.2, rho_gate=25.0, theta_gate=0.15,
+                 min_confidence=0.6, confidence_gain=0.3, full_frame_interval=10):
+        self._STRIP_WIDTH = strip_width
+        self._THETA_MARGIN = theta_margin
+        self._ALPHA = alpha
+        self._BETA = beta
+        self._RHO_GATE = rho_gate
+        self._THETA_GATE = theta_gate
+        self._MIN_CONFIDENCE = min_confidence
+        self._CONFIDENCE_GAIN = confidence_gain
+        self._FULL_FRAME_INTERVAL = full_frame_interval
+        self.reset()
+
+    def reset(self):
+        self._rhos = np.empty(0)
+        self._thetas = np.empty(0)
+        self._rho_rates = np.empty(0)
+        self._theta_rates = np.empty(0)
+        self._confidences = np.empty(0)
+        self._frames_since_full_frame = 0
+        self._searched_full_frame = True
+
+    def copy(self, other: 'LineTracker'):
+        self._rhos = other._rhos
+        self._thetas = other._thetas
+        self._rho_rates = other._rho_rates
+        self._theta_rates = other._theta_rates
+        self._confidences = other._confidences
+        self._frames_since_full_frame = other._frames_since_full_frame
+        self._searched_full_frame = other._searched_full_frame
+
+    def get_edges_and_houghlines(self, image_processor: ImageProcessor, camera_frame,
+                                 geometry: FrameGeometry, line_lost=False, rotate_180=False):
+        """Drop-in replacement for image_processor.get_edges_and_houghlines(camera_frame, rotate_180)"""
+        search_lines = self.plan_search(line_lost)
+        self._searched_full_frame = search_lines is None
+        return self.search(image_processor, camera_frame, geometry, search_lines, rotate_180)
+
+    def plan_search(self, line_lost=False, frames_ahead=1) -> 'LineSet | None':
+        """The predicted lines to search around in the next frame, None when the whole frame has to be searched.
+
+        frames_ahead is how many frames after the last update the searched frame comes,
+        more than 1 when frames are analyzed before the ones in front of them are committed.
+        """
+        if self._needs_full_frame(line_lost):
+            self._frames_since_full_frame = 0
+            return None
+        self._frames_since_full_frame += 1
+        return LineSet(*self._get_predictions(frames_ahead))
+
+    def search(self, image_processor: ImageProcessor, camera_frame, geometry: FrameGeometry,
+               search_lines: 'LineSet | None', rotate_180=False):
+        """Edges and hough lines of the search plan_search returned, only needs the settings of the tracker"""
+        if search_lines is None:
+            return image_processor.get_edges_and_houghlines(camera_frame, rotate_180)
+        rhos, thetas = search_lines.rhos, search_lines.thetas
+        # the strips are drawn on the camera frame, the rotation does not change theta
+        camera_rhos = geometry.get_rotated_rhos(rhos, thetas) if rotate_180 else rhos
+        return image_processor.get_edges_and_houghlines_in_strips(
+            camera_frame,
+            self._get_strip_mask(camera_rhos, thetas, geometry),
+            self._get_theta_ranges(thetas),
+            rotate_180)
+
+    def update(self, merged_lines: 'LineSet', searched_full_frame=None):
+        """Corrects the tracks with the merged lines found in the latest frame.
+
+        searched_full_frame is whether plan_search returned None for it, by default
+        whether get_edges_and_houghlines searched the whole frame.
+        """
+        if searched_full_frame is None:
+            searched_full_frame = self._searched_full_frame
+        predicted_rhos, predicted_thetas = self._get_predictions()
+        track_indices, line_indices, rho_residuals, theta_residuals = self._associate(
+            predicted_rhos, predicted_thetas, merged_lines)
+
+        rhos, thetas = predicted_rhos.copy(), predicted_thetas.copy()
+        rhos[track_indices] += self._ALPHA * rho_residuals
+        thetas[track_indices] += self._ALPHA * theta_residuals
+        rho_rates, theta_rates = self._rho_rates.copy(), self._theta_rates.copy()
+        rho_rates[track_indices] += self._BETA * rho_residuals
+        theta_rates[track_indices] += self._BETA * theta_residuals
+        is_matched = np.zeros(len(rhos), dtype=bool)
+        is_matched[track_indices] = True
+        confidences = self._confidences + self._CONFIDENCE_GAIN * (is_matched - self._confidences)
+
+        if searched_full_frame:
+            # the whole frame was searched, so unmatched tracks are gone and unmatched lines are new
+            is_new = np.ones(len(merged_lines), dtype=bool)
+            is_new[line_indices] = False
+            new_count = np.count_nonzero(is_new)
+            rhos = np.concatenate((rhos[is_matched], merged_lines.rhos[is_new]))
+            thetas = np.concatenate((thetas[is_matched], merged_lines.thetas[is_new]))
+            rho_rates = np.concatenate((rho_rates[is_matched], np.zeros(new_count)))
+            theta_rates = np.concatenate((theta_rates[is_matched], np.zeros(new_count)))
+            confidences = np.concatenate((confidences[is_matched], np.ones(new_count)))
+
+        # keep the estimates in the conventional form, 0 <= theta < pi
+        wrapped = np.floor(thetas / pi)
+        is_flipped = wrapped % 2 == 1
+        thetas = thetas - wrapped * pi
+        self._rhos = np.where(is_flipped, -rhos, rhos)
+        self._rho_rates = np.where(is_flipped, -rho_rates, rho_rates)
+        self._thetas, self._theta_rates, self._confidences = thetas, theta_rates, confidences
+
+    def _needs_full_frame(self, line_lost: bool) -> bool:
+        return (line_lost
+                or len(self._rhos) == 0
+                or self._frames_since_full_frame + 1 >= self._FULL_FRAME_INTERVAL
+                or self._confidences.min() < self._MIN_CONFIDENCE)
+
+    def _get_predictions(self, frames_ahead=1) -> 'tuple[np.ndarray, np.ndarray]':
+        return self._rhos + frames_ahead*self._rho_rates, self._thetas + frames_ahead*self._theta_rates
+
+    def _associate(self, rhos, thetas, lines: 'LineSet'):
+        """Greedily matches every track with the closest line inside the gates.
+
+        Returns the matched track and line indices and the residuals of the lines
+        with respect to the tracks, with the lines in the same form as the tracks.
+        """
+        line_rhos, line_thetas = lines.rhos[np.newaxis, :], lines.thetas[np.newaxis, :]
+        theta_diffs = line_thetas - thetas[:, np.newaxis]
+        # a line on the other side of theta = 0 is compared with flipped rho
+        wraps = np.round(theta_diffs / pi)
+        theta_residuals = theta_diffs - wraps * pi
+        rho_residuals = np.where(wraps % 2 == 1, -line_rhos, line_rhos) - rhos[:, np.newaxis]
+        costs = np.abs(rho_residuals) / self._RHO_GATE + np.abs(theta_residuals) / self._THETA_GATE
+        costs[(np.abs(rho_residuals) > self._RHO_GATE)
+              | (np.abs(theta_residuals) > self._THETA_GATE)] = np.inf
+
+        track_indices, line_indices = [], []
+        used_tracks, used_lines = set(), set()
+        for flat_index in np.argsort(costs, axis=None, kind='stable'):
+            track, line = divmod(int(flat_index), costs.shape[1])
+            if costs[track, line] == np.inf:
+                break
+            if track in used_tracks or line in used_lines:
+                continue
+            used_tracks.add(track)
+            used_lines.add(line)
+            track_indices.append(track)
+            line_indices.append(line)
+        track_indices = np.array(track_indices, dtype=np.intp)
+        line_indices = np.array(line_indices, dtype=np.intp)
+        return (track_indices, line_indices,
+                rho_residuals[track_indices, line_indices],
+                theta_residuals[track_indices, line_indices])
+
+    def _get_strip_mask(self, rhos, thetas, geometry: FrameGeometry) -> 'np.ndarray':
+        strip_mask = np.zeros((geometry.height, geometry.width), dtype=np.uint8)
+        for start, end in geometry.get_frame_intersection_points(rhos, thetas):
+            if np.isnan(start).any():
+                continue # predicted outside of the frame
+            cv.line(strip_mask, (int(start[0]), int(start[1])), (int(end[0]), int(end[1])),
+                    255, self._STRIP_WIDTH)
+        return strip_mask
+
+    def _get_theta_ranges(self, thetas) -> 'list[tuple[float, float]]':
+        """Theta windows around the tracks, snapped to hough bins, wrapped and merged"""
+        margin_bins = round(self._THETA_MARGIN / THETA_STEP)
+        max_bin = round(pi / THETA_STEP)
+        centers = np.rint(thetas / THETA_STEP).astype(int)
+        ranges = []
+        for low, high in zip(centers - margin_bins, centers + margin_bins):
+            # a window crossing theta = 0 continues at pi and the other way round
+            if low < 0:
+                ranges.append((max_bin + low, max_bin))
+            if high > max_bin:
+                ranges.append((0, high - max_bin))
+            ranges.append((max(low, 0), min(high, max_bin)))
+        ranges.sort()
+        merged_ranges = [list(ranges[0])]
+        for low, high in ranges[1:]:
+            if low <= merged_ranges[-1][1] + 1:
+                merged_ranges[-1][1] = max(merged_ranges[-1][1], high)
+            else:
+                merged_ranges.append([low, high])
+        return [(low * THETA_STEP, high * THETA_STEP) for low, high in merged_ranges]
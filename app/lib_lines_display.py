@@ -1,10 +1,23 @@
-from lib_process_lines import Line, LineProcessor
+from lib_process_lines import FrameAnalysis, Line, LineSet, SegmentSet
 from lib_vector2d import Vector2D
 import cv2 as cv
 import numpy as np
 
 BOX_SIZE = 20
 
+LAYER_LINES = 'lines'
+LAYER_MERGED_LINES = 'merged_lines'
+LAYER_BOXES = 'boxes'
+LAYER_TAPE_BOUNDARIES = 'tape_boundaries'
+LAYER_CENTER_LINES = 'center_lines'
+LAYER_TAPE_PATHS = 'tape_paths'
+LAYER_VECTORS = 'vectors'
+LAYER_TEXT = 'text'
+ALL_LAYERS = frozenset((LAYER_LINES, LAYER_MERGED_LINES, LAYER_BOXES, LAYER_TAPE_BOUNDARIES,
+                        LAYER_CENTER_LINES, LAYER_TAPE_PATHS, LAYER_VECTORS, LAYER_TEXT))
+
+_SHIFT = 4 # fractional bits of the points given to OpenCV, scaled points keep sub-pixel precision
+
 
 def put_line_on_frame(frame, line: Line, color: 'tuple[int, int, int]'):
     rho, theta = line.rho, line.theta
@@ -19,78 +32,151 @@ def put_line_on_frame(frame, line: Line, color: 'tuple[int, int, int]'):
     cv.line(frame, (x1,y1), (x2,y2), color, 2)
 
 
-def display_boxes_around_merged_lines(merged_lines: 'list[Line]', frame, edges):
-    line_processor = LineProcessor()
+def render_overlay(frame, analysis: FrameAnalysis, overlay: dict, layers=ALL_LAYERS, scale=1.0):
+    """Draws the layers on a scaled copy of the camera frame and returns the copy.
+
+    The analysis is done as if the camera frame was rotated by 180 degrees, so the copy is
+    rotated as well. overlay is the 'overlay' of the processed frame info, with the vectors
+    and text of the direction calculator. The camera frame itself is not changed.
+    """
+    if scale == 1:
+        canvas = cv.flip(frame, -1)
+    else:
+        canvas = cv.resize(frame, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        cv.flip(canvas, -1, dst=canvas)
+    display_frame_analysis(analysis, canvas, layers, scale)
+    if LAYER_VECTORS in layers and overlay['direction_vector'] is not None:
+        display_displacement_and_direction_vectors(overlay['displacement_vector'], overlay['direction_vector'], canvas, scale)
+        display_direction_to_go(overlay['direction_to_go'], canvas, scale)
+    if LAYER_TEXT in layers:
+        display_text(overlay['text'], canvas, scale)
+    return canvas
+
+
+def get_overlay_telemetry(analysis: FrameAnalysis, overlay: dict, frame_shape) -> dict:
+    """The overlay as compact geometry for the browser to draw over the plain video.
+
+    Coordinates are in the analyzed frame, which is frame_shape rotated by 180 degrees.
+    """
+    tape_paths = analysis.tape_paths
+    if tape_paths is None:
+        tape_paths = SegmentSet((), ())
+    return {
+        'width': frame_shape[1],
+        'height': frame_shape[0],
+        'mergedLines': np.stack((np.round(analysis.merged_lines.rhos, 1),
+                                 np.round(analysis.merged_lines.thetas, 4)), axis=-1).tolist(),
+        'tapePaths': np.concatenate((tape_paths.start_points, tape_paths.end_points), axis=1).tolist(),
+        'displacement': _get_vector_telemetry(overlay['displacement_vector']),
+        'direction': _get_vector_telemetry(overlay['direction_vector']),
+        'directionToGo': _get_vector_telemetry(overlay['direction_to_go']),
+        'stableState': overlay['stable_state'],
+        'incomingState': overlay['incoming_state']
+    }
+
+
+def display_frame_analysis(analysis: FrameAnalysis, frame, layers=ALL_LAYERS, scale=1.0):
+    """Draws the layers of the analysis on a frame that is scale times the size of the analyzed frame"""
+    if LAYER_LINES in layers:
+        display_all_lines(analysis.lines, frame, scale)
+    if LAYER_MERGED_LINES in layers:
+        display_merged_parallel_lines(analysis.merged_lines, frame, scale)
+    if LAYER_BOXES in layers:
+        display_boxes_around_merged_lines(analysis.merged_lines, analysis.box_centers, analysis.box_line_indices, frame, scale)
+    if LAYER_TAPE_BOUNDARIES in layers:
+        display_merged_lines_segments(analysis.tape_boundaries, frame, scale)
+    if LAYER_CENTER_LINES in layers:
+        display_center_of_parallel_lines(analysis.parallel_line_centers, frame, scale)
+    if LAYER_TAPE_PATHS in layers:
+        display_tape_paths(analysis.tape_paths, frame, scale)
+
+
+def display_boxes_around_merged_lines(merged_lines: LineSet, box_centers, box_line_indices, frame, scale=1.0):
+    half_box_size = int(BOX_SIZE/2)
+    corners = np.array([(-1, -1), (1, -1), (1, 1), (-1, 1)]) * half_box_size
+    boxes = box_centers[:, np.newaxis, :] + corners
     for i in range(len(merged_lines)):
-        line = merged_lines[i]
         color = (0, 255-255/len(merged_lines)*i ,0) # same shade of green as the merged line
-        boxes = line_processor._get_box_centers(line, edges)
-        for box in boxes:
-            x, y = box
-            x = int(x)
-            y = int(y)
-            half_box_size = int(BOX_SIZE/2)
-            cv.line(frame, (x - half_box_size, y - half_box_size), (x + half_box_size, y - half_box_size), color, 1)
-            cv.line(frame, (x - half_box_size, y - half_box_size), (x - half_box_size, y + half_box_size), color, 1)
-            cv.line(frame, (x + half_box_size, y + half_box_size), (x + half_box_size, y - half_box_size), color, 1)
-            cv.line(frame, (x + half_box_size, y + half_box_size), (x - half_box_size, y + half_box_size), color, 1)
-
-
-def display_merged_lines_segments(merged_lines_segments, frame):
-    merged_lines = list(merged_lines_segments.keys())
-    for i in range(len(merged_lines)):
-        line_segments = merged_lines_segments[merged_lines[i]]
-        for j in range(len(line_segments)):
-            color = (0, (255 - 255/len(merged_lines)*i) / 2, 255-255/len(merged_lines)*i)
-            cv.line(frame, (line_segments[j].start_point[0],line_segments[j].start_point[1]), (line_segments[j].end_point[0],line_segments[j].end_point[1]), color, 2)
+        _polylines(frame, boxes[box_line_indices == i], color, 1, scale, is_closed=True)
 
 
-def display_tape_paths(tape_paths_and_lines, frame):
-    if tape_paths_and_lines is None:
+def display_merged_lines_segments(merged_lines_segments: SegmentSet, frame, scale=1.0):
+    merged_lines_count = len(merged_lines_segments.lines)
+    segments = np.stack((merged_lines_segments.start_points, merged_lines_segments.end_points), axis=1)
+    for i in range(merged_lines_count):
+        color = (0, (255 - 255/merged_lines_count*i) / 2, 255-255/merged_lines_count*i) # same shade as the merged line
+        _polylines(frame, segments[merged_lines_segments.line_indices == i], color, 2, scale)
+
+
+def display_tape_paths(tape_paths: SegmentSet, frame, scale=1.0):
+    if tape_paths is None:
         return
-    tape_paths = list(tape_paths_and_lines.keys())
+    segments = np.stack((tape_paths.start_points, tape_paths.end_points), axis=1)
     for i in range(len(tape_paths)):
-        tape_path = tape_paths[i]
         color = (255-255/len(tape_paths)*i, 0, 255-255/len(tape_paths)*i)
-        cv.line(frame, (tape_path.start_point[0], tape_path.start_point[1]), (tape_path.end_point[0], tape_path.end_point[1]), color, 2)
+        _polylines(frame, segments[i:i+1], color, 2, scale)
 
 
-def display_all_lines(lines: 'list[Line]', frame):
-    for line in lines:
-        color = (255, 0, 0) # blue (BGR)
-        put_line_on_frame(frame, line, color)
+def display_all_lines(lines: LineSet, frame, scale=1.0):
+    color = (255, 0, 0) # blue (BGR)
+    _polylines(frame, _get_line_points(lines), color, 2, scale)
 
-def display_merged_parallel_lines(merged_lines: 'list[Line]', frame):
+def display_merged_parallel_lines(merged_lines: LineSet, frame, scale=1.0):
+    points = _get_line_points(merged_lines)
     for i in range(len(merged_lines)):
-        line = merged_lines[i]
         color = (0, 255-255/len(merged_lines)*i ,0) # shade of green
-        put_line_on_frame(frame, line, color)
+        _polylines(frame, points[i:i+1], color, 2, scale)
 
-def display_center_of_parallel_lines(parallel_line_centers, frame):
+def display_center_of_parallel_lines(parallel_line_centers, frame, scale=1.0):
     if parallel_line_centers is None:
         return
+    points = _get_line_points(parallel_line_centers)
     for i in range(len(parallel_line_centers)):
-        line = parallel_line_centers[i]
         color = (0, 0, 255-255/len(parallel_line_centers)*i) # shade of red
-        put_line_on_frame(frame, line, color)
-
-def display_displacement_and_direction_vectors(displacement_vector, direction_vector, frame):
-    frame_width = frame.shape[1]
-    frame_height = frame.shape[0]
-    center_x = frame_width / 2
-    center_y = frame_height / 2
-    cv.line(frame, (int(center_x), int(center_y)), (int(displacement_vector.x) + int(center_x), int(center_y) + int(displacement_vector.y)), (255,255,0), 2)
-    cv.line(frame,
-        (int(displacement_vector.x) + int(center_x), int(center_y) + int(displacement_vector.y)),
-        (int(displacement_vector.x) + int(direction_vector.x) + int(center_x), int(center_y) + int(direction_vector.y) + int(displacement_vector.y)),
-        (0,255,255),
-        2
-    )
-
-def display_direction_to_go(direction_to_go: Vector2D, frame):
-    frame_width = frame.shape[1]
-    frame_height = frame.shape[0]
-    center_x = frame_width / 2
-    center_y = frame_height / 2
+        _polylines(frame, points[i:i+1], color, 2, scale)
+
+def display_displacement_and_direction_vectors(displacement_vector, direction_vector, frame, scale=1.0):
+    center_x = frame.shape[1] / scale / 2
+    center_y = frame.shape[0] / scale / 2
+    displacement_end = (displacement_vector.x + center_x, displacement_vector.y + center_y)
+    direction_end = (displacement_end[0] + direction_vector.x, displacement_end[1] + direction_vector.y)
+    _polylines(frame, [[(center_x, center_y), displacement_end]], (255,255,0), 2, scale)
+    _polylines(frame, [[displacement_end, direction_end]], (0,255,255), 2, scale)
+
+def display_direction_to_go(direction_to_go: Vector2D, frame, scale=1.0):
+    center_x = frame.shape[1] / scale / 2
+    center_y = frame.shape[0] / scale / 2
     direction_to_go = direction_to_go.normalize() * 50
-    cv.line(frame, (int(center_x), int(center_y)), (int(direction_to_go.x) + int(center_x), int(center_y) + int(direction_to_go.y)), (0,69,255), 2)
+    _polylines(frame, [[(center_x, center_y), (direction_to_go.x + center_x, direction_to_go.y + center_y)]], (0,69,255), 2, scale)
+
+def display_text(text: 'list[tuple[str, tuple[int, int, int]]]', frame, scale=1.0):
+    """Puts every (text, color) on its own line in the top left corner"""
+    for i, (line, color) in enumerate(text):
+        cv.putText(frame, line, (0, round((50 + 30*i) * scale)), cv.FONT_HERSHEY_SIMPLEX, scale, color,
+                   _scale_thickness(2, scale), cv.LINE_AA)
+
+
+def _get_vector_telemetry(vector: Vector2D):
+    if vector is None:
+        return None
+    return [round(float(vector.x), 1), round(float(vector.y), 1)]
+
+def _get_line_points(lines: LineSet) -> 'np.ndarray':
+    """Two points 1000 pixels away on either side of the foot of every line, an (N, 2, 2) array"""
+    a = np.cos(lines.thetas)
+    b = np.sin(lines.thetas)
+    x0 = a*lines.rhos
+    y0 = b*lines.rhos
+    starts = np.stack((x0 + 1000*(-b), y0 + 1000*(a)), axis=-1)
+    ends = np.stack((x0 - 1000*(-b), y0 - 1000*(a)), axis=-1)
+    return np.stack((starts, ends), axis=1)
+
+def _polylines(frame, polylines, color, thickness, scale, is_closed=False):
+    """Draws all the polylines, an (N, K, 2) array of points in the analyzed frame, with one cv.polylines call"""
+    if len(polylines) == 0:
+        return
+    points = np.round(np.asarray(polylines, dtype=np.float64) * (scale * (1 << _SHIFT))).astype(np.int32)
+    cv.polylines(frame, points, is_closed, color, _scale_thickness(thickness, scale), cv.LINE_8, _SHIFT)
+
+def _scale_thickness(thickness, scale) -> int:
+    return max(round(thickness * scale), 1)
@@ -0,0 +1,170 @@
+import collections
+import threading
+import time
+
+
+class StageQueue:
+    """A bounded queue between two pipeline stages that drops its oldest item when it is full.
+
+    A stage that falls behind therefore only works on the newest items and the stage
+    feeding it never waits. on_drop is called with every dropped item, e.g. to give
+    a frame slot back.
+    """
+    def __init__(self, maxsize=1, on_drop=None):
+        self._MAXSIZE = maxsize
+        self._on_drop = on_drop
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        dropped_items = []
+        with self._condition:
+            while len(self._items) >= self._MAXSIZE:
+                dropped_items.append(self._items.popleft())
+            self._items.append(item)
+            self.dropped += len(dropped_items)
+            self._condition.notify()
+        if self._on_drop is not None:
+            for dropped_item in dropped_items:
+                self._on_drop(dropped_item)
+
+    def get(self, timeout=None) -> 'tuple[bool, object]':
+        """Waits for the oldest item, returns (success, item). success is False when the queue is closed or timed out"""
+        with self._condition:
+            has_item = self._condition.wait_for(lambda: len(self._items) > 0 or self._closed, timeout)
+            if not has_item or len(self._items) == 0:
+                return False, None
+            return True, self._items.popleft()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class Stage:
+    """Calls handle on its own thread for every item of input_queue and puts the results
+    that are not None in every output queue.
+
+    Without an input queue handle is called without arguments over and over, which makes
+    the stage a source. get_depth replaces the depth of the input queue in the stats,
+    for stages whose backlog is somewhere else. An error in handle stops the stage, right
+    away on_error is called with the stage and the error, and get_stats raises it again.
+    """
+    def __init__(self, name, handle, input_queue: StageQueue = None,
+                 output_queues: 'list[StageQueue]' = (), get_depth=None, on_error=None):
+        self.name = name
+        self._handle = handle
+        self._input_queue = input_queue
+        self._output_queues = list(output_queues)
+        self._get_depth = get_depth
+        self.on_error = on_error
+        self._running = False
+        self._thread = None
+        self._handled_count = 0
+        self._stats_count = 0
+        self._stats_time = None
+        self.error = None
+
+    def start(self) -> 'Stage':
+        self._running = True
+        self._stats_time = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the stage after the item it is handling, join waits for that"""
+        self._running = False
+        if self._input_queue is not None:
+            self._input_queue.close()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def get_stats(self) -> dict:
+        """{'depth', 'throughput', 'dropped'}, throughput in items per second since the last call"""
+        if self.error is not None:
+            raise self.error
+        now = time.monotonic()
+        handled_count = self._handled_count
+        throughput = (handled_count - self._stats_count) / max(now - self._stats_time, 1e-9)
+        self._stats_count, self._stats_time = handled_count, now
+        if self._get_depth is not None:
+            depth = self._get_depth()
+        else:
+            depth = len(self._input_queue) if self._input_queue is not None else 0
+        return {
+            'depth': depth,
+            'throughput': throughput,
+            'dropped': self._input_queue.dropped if self._input_queue is not None else 0
+        }
+
+    def _run(self):
+        while self._running:
+            if self._input_queue is None:
+                args = ()
+            else:
+                ret_get, item = self._input_queue.get()
+                if not ret_get:
+                    continue
+                args = (item,)
+            try:
+                result = self._handle(*args)
+            except Exception as error:
+                self.error = error
+                self._running = False
+                if self.on_error is not None:
+                    self.on_error(self, error)
+                break
+            # a source stage returns None when it had nothing to hand on
+            if self._input_queue is not None or result is not None:
+                self._handled_count += 1
+            if result is None:
+                continue
+            for output_queue in self._output_queues:
+                output_queue.put(result)
+
+
+class Pipeline:
+    """Stages that run at the same time, connected by StageQueues.
+
+    on_error is called from the thread of a stage that fails, with the stage and the error,
+    unless the stage has its own on_error.
+    """
+    def __init__(self, stages: 'list[Stage]', on_error=None):
+        self._stages = stages
+        for stage in stages:
+            if stage.on_error is None:
+                stage.on_error = on_error
+
+    def start(self) -> 'Pipeline':
+        for stage in self._stages:
+            stage.start()
+        return self
+
+    def stop(self):
+        for stage in self._stages:
+            stage.stop()
+
+    def join(self, timeout=None):
+        for stage in self._stages:
+            stage.join(timeout)
+
+    def get_error(self) -> 'Exception | None':
+        """The error of a stage that failed, None while none has"""
+        return next((stage.error for stage in self._stages if stage.error is not None), None)
+
+    def get_stats(self) -> 'dict[str, dict]':
+        return {stage.name: stage.get_stats() for stage in self._stages}
+
+    def get_stats_string(self) -> str:
+        return ', '.join(
+            f'{name}: depth {stats["depth"]}, {stats["throughput"]:.1f}/s, dropped {stats["dropped"]}'
+            for name, stats in self.get_stats().items())
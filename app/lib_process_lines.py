@@ -1,39 +1,132 @@
-from math import cos, pi, sin, sqrt, tan
-from statistics import median
+from math import pi, sqrt
+import cv2 as cv
 import numpy as np
+from lib_frame_geometry import FrameGeometry
 from lib_vector2d import Vector2D
 
 
+class LineSet:
+    """Lines in Hesse normal form, stored as one array of rhos and one of thetas.
+
+    Indexing returns a Line view on the set, nothing is copied.
+    """
+    __slots__ = ('rhos', 'thetas')
+
+    def __init__(self, rhos, thetas) -> 'LineSet':
+        self.rhos = np.asarray(rhos, dtype=np.float64)
+        self.thetas = np.asarray(thetas, dtype=np.float64)
+
+    @classmethod
+    def from_houghlines(cls, hough_lines) -> 'LineSet':
+        if hough_lines is None:
+            return cls((), ())
+        return cls(hough_lines[:, 0, 0], hough_lines[:, 0, 1])
+
+    def __len__(self) -> int:
+        return len(self.rhos)
+
+    def __getitem__(self, index: int) -> 'Line':
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('line index out of range')
+        return Line._view(self, index)
+
+    def __iter__(self):
+        return (Line._view(self, index) for index in range(len(self)))
+
+    def __str__(self) -> str:
+        return str(list(self))
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class SegmentSet:
+    """Line segments, stored as (N, 2) arrays of start and end points.
+
+    Optionally also stores the line each segment lies on, as indices into a LineSet.
+    Indexing returns a LineSegment view on the set, nothing is copied.
+    """
+    __slots__ = ('start_points', 'end_points', 'lines', 'line_indices')
+
+    def __init__(self, start_points, end_points, lines: 'LineSet' = None, line_indices=None) -> 'SegmentSet':
+        self.start_points = np.asarray(start_points, dtype=np.intp).reshape(-1, 2)
+        self.end_points = np.asarray(end_points, dtype=np.intp).reshape(-1, 2)
+        self.lines = lines
+        self.line_indices = None if line_indices is None else np.asarray(
+            line_indices, dtype=np.intp)
+
+    def select(self, indices) -> 'SegmentSet':
+        """Returns the segments at the given indices or boolean mask"""
+        return SegmentSet(self.start_points[indices], self.end_points[indices], self.lines,
+                          None if self.line_indices is None else self.line_indices[indices])
+
+    def get_direction_vectors(self) -> 'np.ndarray':
+        return self.end_points - self.start_points
+
+    def get_direction_angles(self) -> 'np.ndarray':
+        direction_vectors = self.get_direction_vectors()
+        return np.arctan2(direction_vectors[:, 1], direction_vectors[:, 0])
+
+    def get_distinct_lines(self) -> 'list[Line]':
+        if self.line_indices is None:
+            return []
+        return [self.lines[index] for index in np.unique(self.line_indices).tolist()]
+
+    def __len__(self) -> int:
+        return len(self.start_points)
+
+    def __getitem__(self, index: int) -> 'LineSegment':
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('segment index out of range')
+        return LineSegment._view(self, index)
+
+    def __iter__(self):
+        return (LineSegment._view(self, index) for index in range(len(self)))
+
+    def __str__(self) -> str:
+        return str(list(self))
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
 class Line:
+    """A line in Hesse normal form, a view on one entry of a LineSet"""
+    __slots__ = ('_line_set', '_index')
     _rho_diff_threshold = 80.0
     _theta_diff_threshold = 0.3
     _distance_threshold = 40
 
     def __init__(self, rho: float, theta: float) -> 'Line':
-        self.rho = rho
-        self.theta = theta
-
-    def is_similar(self, to_compare: 'Line', frame) -> bool:
-        A, B = _get_line_frame_intersection_points(self, frame)
-        C, D = _get_line_frame_intersection_points(to_compare, frame)
-        AB = LineSegment(A, B)
-        CD = LineSegment(C, D)
-
-        dist_A_to_CD = self._distance_from_point_to_line_segment(A, CD)
-        dist_B_to_CD = self._distance_from_point_to_line_segment(B, CD)
-        dist_C_to_AB = self._distance_from_point_to_line_segment(C, AB)
-        dist_D_to_AB = self._distance_from_point_to_line_segment(D, AB)
-
-        return (dist_A_to_CD < self._distance_threshold
-                and dist_B_to_CD < self._distance_threshold
-                and dist_C_to_AB < self._distance_threshold
-                and dist_D_to_AB < self._distance_threshold)
-
-    def _distance_from_point_to_line_segment(self, point: 'tuple[int, int]', line_segment: 'LineSegment') -> float:
-        x0, y0 = point
-        x1, y1 = line_segment.start_point
-        x2, y2 = line_segment.end_point
-        return abs((x2-x1)*(y1-y0) - (x1-x0)*(y2-y1)) / sqrt((x2-x1)**2 + (y2-y1)**2)
+        self._line_set = LineSet((rho,), (theta,))
+        self._index = 0
+
+    @classmethod
+    def _view(cls, line_set: 'LineSet', index: int) -> 'Line':
+        line = cls.__new__(cls)
+        line._line_set = line_set
+        line._index = index
+        return line
+
+    @property
+    def rho(self) -> float:
+        return self._line_set.rhos[self._index]
+
+    @property
+    def theta(self) -> float:
+        return self._line_set.thetas[self._index]
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, Line)
+                and self._line_set is other._line_set
+                and self._index == other._index)
+
+    def __hash__(self) -> int:
+        return hash((id(self._line_set), self._index))
 
     def __str__(self) -> str:
         return f'rho: {self.rho}, theta: {self.theta}'
@@ -43,9 +136,38 @@ class Line:
 
 
 class LineSegment:
-    def __init__(self, start_point: 'tuple[int, int]', end_point: 'tuple[int, int]') -> 'LineSegment':
-        self.start_point = start_point
-        self.end_point = end_point
+    """A line segment, a view on one entry of a SegmentSet"""
+    __slots__ = ('_segment_set', '_index')
+
+    def __init__(self, start_point: 'tuple[int, int]', end_point: 'tuple[int, int]', line: 'Line' = None) -> 'LineSegment':
+        if line is None:
+            self._segment_set = SegmentSet((start_point,), (end_point,))
+        else:
+            self._segment_set = SegmentSet((start_point,), (end_point,),
+                                           line._line_set, (line._index,))
+        self._index = 0
+
+    @classmethod
+    def _view(cls, segment_set: 'SegmentSet', index: int) -> 'LineSegment':
+        line_segment = cls.__new__(cls)
+        line_segment._segment_set = segment_set
+        line_segment._index = index
+        return line_segment
+
+    @property
+    def start_point(self) -> 'tuple[int, int]':
+        return tuple(self._segment_set.start_points[self._index].tolist())
+
+    @property
+    def end_point(self) -> 'tuple[int, int]':
+        return tuple(self._segment_set.end_points[self._index].tolist())
+
+    @property
+    def line(self) -> 'Line':
+        """The line the segment lies on, None if the segment was made without one"""
+        if self._segment_set.line_indices is None:
+            return None
+        return Line._view(self._segment_set.lines, int(self._segment_set.line_indices[self._index]))
 
     def get_length(self):
         return sqrt((self.end_point[0] - self.start_point[0]) ** 2 + (self.end_point[1] - self.start_point[1]) ** 2)
@@ -54,10 +176,16 @@ class LineSegment:
         return Vector2D(self.end_point[0]-self.start_point[0], self.end_point[1]-self.start_point[1])
 
     def flip(self) -> 'LineSegment':
-        temp = self.start_point
-        self.start_point = self.end_point
-        self.end_point = temp
-        return self
+        """Returns the same segment going the other way, lying on the same line"""
+        return LineSegment(self.end_point, self.start_point, self.line)
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, LineSegment)
+                and self._segment_set is other._segment_set
+                and self._index == other._index)
+
+    def __hash__(self) -> int:
+        return hash((id(self._segment_set), self._index))
 
     def __str__(self) -> str:
         return f'start_point: {self.start_point}, end_point: {self.end_point}'
@@ -66,360 +194,467 @@ class LineSegment:
         return self.__str__()
 
 
+class MarkerRuns:
+    """Run-length encoded tape markers of the boxes along one or more lines.
+
+    Boxes of all lines are concatenated, runs never cross the end of a line.
+    starts and stops are box indices (stop exclusive), lines is the line of each run
+    and line_stops is the box index where each line ends.
+    """
+    def __init__(self, starts, stops, lines, line_stops) -> 'MarkerRuns':
+        self.starts = starts
+        self.stops = stops
+        self.lines = lines
+        self.line_stops = line_stops
+
+    @classmethod
+    def from_markers(cls, tape_markers, line_stops) -> 'MarkerRuns':
+        markers = np.asarray(tape_markers, dtype=np.int8)
+        changes = np.diff(markers, prepend=0, append=0)
+        # runs continuing from one line into the next have to be split
+        boundaries = line_stops[(line_stops > 0) & (line_stops < len(markers))]
+        splits = boundaries[(markers[boundaries - 1] & markers[boundaries]) > 0]
+        starts = np.union1d(np.flatnonzero(changes == 1), splits)
+        stops = np.union1d(np.flatnonzero(changes == -1), splits)
+        lines = np.searchsorted(line_stops, starts, side='right')
+        return cls(starts, stops, lines, line_stops)
+
+    def fill_gaps(self, max_gap_size: int) -> 'MarkerRuns':
+        """Joins runs separated by at most max_gap_size boxes.
+
+        A gap is only filled when the run after it starts before the last box of the line.
+        The same as the list based gap filling it replaced, see test_marker_runs.py.
+        """
+        if len(self.starts) == 0:
+            return self
+        if max_gap_size > 2:
+            return self._fill_gaps_after_short_segments(max_gap_size)
+        gap_sizes = self.starts[1:] - self.stops[:-1]
+        is_filled = ((self.lines[1:] == self.lines[:-1])
+                     & (gap_sizes <= max_gap_size)
+                     & (self.starts[1:] <= self.line_stops[self.lines[1:]] - 2))
+        keep_start = np.concatenate(([True], ~is_filled))
+        keep_stop = np.concatenate((~is_filled, [True]))
+        return MarkerRuns(self.starts[keep_start], self.stops[keep_stop],
+                          self.lines[keep_start], self.line_stops)
+
+    def _fill_gaps_after_short_segments(self, max_gap_size: int) -> 'MarkerRuns':
+        """fill_gaps for gaps of more than 2 boxes, which are only filled after long enough segments.
+
+        A segment, the runs since the last gap that was not filled, together with the boxes of the
+        runs ahead within max_gap_size boxes has to reach max_gap_size boxes for the gap to be
+        filled. Until it does, every box of the gap is tried as the start of the fill, so a fill
+        can leave the start of the gap empty. Runs are walked one by one in Python, but only runs
+        and the boxes of gaps that are too short, never the boxes of the runs themselves.
+        """
+        starts, stops, lines = [], [], []
+        for line in np.unique(self.lines):
+            in_line = self.lines == line
+            run_starts, run_stops = self.starts[in_line].tolist(), self.stops[in_line].tolist()
+            line_stop = int(self.line_stops[line])
+            # boxes up to the one before the last box of the line can be looked ahead at
+            last_lookahead_box = line_stop - 2
+            run = 0
+            while run < len(run_starts):
+                segment_start, segment_stop = run_starts[run], run_stops[run]
+                segment_size = segment_stop - segment_start
+                box = segment_stop # the empty box the gap is looked at from
+                while box < line_stop:
+                    lookahead_stop = min(box + max_gap_size, last_lookahead_box) + 1
+                    next_run = run + 1
+                    boxes_ahead = 0
+                    while next_run < len(run_starts) and run_starts[next_run] < lookahead_stop:
+                        boxes_ahead += min(run_stops[next_run], lookahead_stop) - run_starts[next_run]
+                        next_run += 1
+                    if boxes_ahead == 0:
+                        break
+                    if segment_size + boxes_ahead >= max_gap_size:
+                        if box != segment_stop:
+                            starts.append(segment_start)
+                            stops.append(segment_stop)
+                            segment_start = box
+                        run = next_run - 1
+                        segment_size += run_stops[run] - box
+                        box = segment_stop = run_stops[run]
+                    elif box + 1 == run_starts[run + 1]:
+                        # the gap stays empty, but the segment goes on with the next run
+                        starts.append(segment_start)
+                        stops.append(segment_stop)
+                        run += 1
+                        segment_start, segment_stop = run_starts[run], run_stops[run]
+                        segment_size += segment_stop - segment_start
+                        box = segment_stop
+                    else:
+                        box += 1
+                starts.append(segment_start)
+                stops.append(segment_stop)
+                run += 1
+                # the boxes of the gap that were looked ahead at are not looked at again,
+                # that can only skip a run on the last box of the line, which stays as it is
+                if run < len(run_starts) and run_starts[run] <= box + max_gap_size:
+                    starts.append(run_starts[run])
+                    stops.append(run_stops[run])
+                    run += 1
+            lines += [line] * (len(starts) - len(lines))
+        return MarkerRuns(np.array(starts, dtype=self.starts.dtype), np.array(stops, dtype=self.stops.dtype),
+                          np.array(lines, dtype=self.lines.dtype), self.line_stops)
+
+    def remove_small(self, min_size: int) -> 'MarkerRuns':
+        """Removes runs shorter than min_size boxes.
+
+        A run reaching the end of its line has to be one box longer to be kept,
+        lines of a single box are never filtered.
+        """
+        sizes = self.stops - self.starts
+        line_sizes = np.diff(self.line_stops, prepend=0)[self.lines]
+        is_last = self.stops == self.line_stops[self.lines]
+        keep = (line_sizes < 2) | np.where(is_last, sizes > min_size, sizes >= min_size)
+        return MarkerRuns(self.starts[keep], self.stops[keep],
+                          self.lines[keep], self.line_stops)
+
+    def get_segment_boxes(self) -> 'tuple[np.ndarray, np.ndarray]':
+        """Indices of the start and end box of every segment, a segment reaching the end of its line ends at its last box"""
+        is_last = self.stops == self.line_stops[self.lines]
+        return self.starts, np.where(is_last, self.stops - 1, self.stops)
+
+
+class FrameAnalysis:
+    """ Every intermediate product of processing a single frame """
+    def __init__(self,
+            lines: 'LineSet',
+            merged_lines: 'LineSet',
+            tape_boundaries: 'SegmentSet',
+            parallel_line_centers: 'LineSet',
+            tape_paths: 'SegmentSet',
+            box_centers: 'np.ndarray',
+            box_line_indices: 'np.ndarray'):
+        self.lines = lines
+        self.merged_lines = merged_lines
+        self.tape_boundaries = tape_boundaries
+        self.parallel_line_centers = parallel_line_centers
+        self.tape_paths = tape_paths
+        # the boxes along the merged lines the tape boundaries were searched in
+        self.box_centers = box_centers
+        self.box_line_indices = box_line_indices
+
+
 class LineProcessor:
-    def __init__(self, box_size=20, pixels_threshold=20, min_line_segment_size=3, min_line_segment_hole_size=2):
+    def __init__(self, box_size=20, pixels_threshold=20, min_line_segment_size=3, min_line_segment_hole_size=2,
+                 edge_scale=1.0):
+        """edge_scale is the scale of the ImageProcessor the edges come from, its edges are
+        1/edge_scale pixels thick, so the boxes need that many more edge pixels"""
         self._BOX_SIZE = box_size
-        self._PIXELS_THRESHOLD = pixels_threshold
+        self._PIXELS_THRESHOLD = pixels_threshold / edge_scale
         self._MIN_LINE_SEGMENT_SIZE = min_line_segment_size
         self._MIN_LINE_SEGMENT_HOLE_SIZE = min_line_segment_hole_size
 
-    def get_tape_paths(self, frame, edges, houghlines) -> 'dict[LineSegment, Line]':
-        lines = self._get_from_houghlines(houghlines)
-        merged_lines = self._merge_lines(lines, frame)
-        tape_boundaries = self._get_tape_boundaries(merged_lines, edges)
+    def get_tape_paths(self, geometry: FrameGeometry, edges, houghlines, edges_rotated_180=False) -> 'SegmentSet':
+        return self.analyze_frame(geometry, edges, houghlines, edges_rotated_180).tape_paths
+
+    def analyze_frame(self, geometry: FrameGeometry, edges, houghlines, edges_rotated_180=False) -> 'FrameAnalysis':
+        """ Runs every line processing step once and keeps the intermediate results
+
+        With edges_rotated_180 the edges are the camera's and the hough lines those of the camera
+        frame rotated by 180 degrees, as ImageProcessor.get_edges_and_houghlines(rotate_180=True)
+        returns them. The boxes are then looked up at their rotated place instead of rotating the edges.
+        """
+        lines = LineSet.from_houghlines(houghlines)
+        merged_lines = self._merge_line_set(lines, geometry)
+        box_centers, box_line_indices = self._get_all_box_centers(merged_lines, geometry)
+        tape_boundaries = self._get_tape_boundaries(merged_lines, edges, box_centers, box_line_indices,
+                                                    edges_rotated_180)
         parallel_line_centers = self._get_centers_of_parallel_line_pairs(
             merged_lines)
         tape_paths = self._get_tape_paths_and_lines(
-            parallel_line_centers, tape_boundaries, frame)
-        return tape_paths
-
-    def _get_from_houghlines(self, hough_lines) -> 'list[Line]':
-        if hough_lines is None:
-            return []
-        lines = []
-        for line in hough_lines:
-            rho, theta = line[0]
-            lines.append(Line(rho, theta))
-        return lines
-
-    def _merge_lines(self, lines: 'list[Line]', frame) -> 'list[Line]':
-        similar_lines: dict[Line, list[Line]] = {}
-        for line in lines:
-            found_similar = False
-            for group_leading_line, grouped_lines in similar_lines.items():
-                if line.is_similar(group_leading_line, frame):
-                    found_similar = True
-                    grouped_lines.append(line)
-                    break
-            if not found_similar:
-                similar_lines[line] = [line]
-
-        merged_lines = []
-        for grouped_lines in list(similar_lines.values()):
-            merged_lines.append(self._get_median_line(grouped_lines))
-        return merged_lines
-
-    def _get_tape_boundaries(self, merged_lines: 'list[Line]', edges) -> 'dict[Line, list[LineSegment]]':
-        lines_segments: dict[Line, list[LineSegment]] = {}
-        for line in merged_lines:
-            box_centers = self._get_box_centers(line, edges)
-            white_pixels_per_box = self._get_white_pixels_per_box(
-                box_centers, edges)
-            tape_markers = self._get_tape_markers(white_pixels_per_box)
-            filtered_markers = self._get_filtered_markers(tape_markers)
-            lines_segments[line] = self._get_line_segments(
-                filtered_markers, box_centers)
-        return lines_segments
-
-    def _get_box_centers(self, line: 'Line', edges) -> 'list[tuple[int,int]]':
-        box_centers = []
-        max_x = edges.shape[1]
-        max_y = edges.shape[0]
-        rho, theta = line.rho, line.theta
-        iterate_along_x_axis = self._is_line_more_horizontal(line)
-        delta_x = self._BOX_SIZE if iterate_along_x_axis else self._BOX_SIZE * \
-            1/tan(theta - pi/2)
-        delta_y = self._BOX_SIZE if not iterate_along_x_axis else self._BOX_SIZE * \
-            tan(theta - pi/2)
-        x_intercept = rho*cos(theta) - rho*sin(theta)/tan(theta - pi/2)
-        y_intercept = rho*sin(theta) - rho*cos(theta)*tan(theta - pi/2)
-
-        box_count = int(
-            max_x / self._BOX_SIZE if iterate_along_x_axis else max_y / self._BOX_SIZE)
-
-        for i in range(box_count):
-            x = i * \
-                delta_x if iterate_along_x_axis else round(
-                    x_intercept + i*delta_x)
-            y = i * \
-                delta_y if not iterate_along_x_axis else round(
-                    y_intercept + i*delta_y)
-            if y >= 0 and y < max_y and x >= 0 and x <= max_x:
-                box_centers.append((x, y))
-        return box_centers
-
-    def _is_line_more_horizontal(self, line: 'Line') -> bool:
-        return line.theta >= pi/4 and line.theta <= 3*pi/4
-
-    def _get_white_pixels_per_box(self, box_centers: 'list[tuple[int,int]]', edges) -> 'list[int]':
-        pixels_per_box = []
+            parallel_line_centers, tape_boundaries, geometry)
+        return FrameAnalysis(lines, merged_lines, tape_boundaries,
+                             parallel_line_centers, tape_paths,
+                             box_centers, box_line_indices)
+
+    def _merge_line_set(self, lines: 'LineSet', geometry: FrameGeometry) -> 'LineSet':
+        """Merges similar lines into the median line of their group.
+
+        All endpoint-to-line distances are computed in one broadcast, the greedy
+        grouping only walks the resulting similarity matrix.
+        """
+        if len(lines) == 0:
+            return LineSet((), ())
+        similar = self._get_similarity_matrix(
+            geometry.get_frame_intersection_points(lines.rhos, lines.thetas))
+        groups = self._get_greedy_groups(similar)
+        return self._get_median_lines(lines.rhos, lines.thetas, groups)
+
+    def _get_similarity_matrix(self, points):
+        # points has shape (N, 2, 2): two frame intersection points per line
+        start, end = points[:, 0, :], points[:, 1, :]
+        x1, y1 = start[:, 0], start[:, 1]
+        x2, y2 = end[:, 0], end[:, 1]
+        x0, y0 = points[:, :, 0, np.newaxis], points[:, :, 1, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # distances[i, k, j] is the distance from point k of line i to line j
+            distances = (np.abs((x2 - x1) * (y1 - y0) - (x1 - x0) * (y2 - y1))
+                         / np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2))
+            close = distances < Line._distance_threshold
+        close = close.all(axis=1)
+        return close & close.T
+
+    def _get_greedy_groups(self, similar) -> 'np.ndarray':
+        # each line joins the first group leader it is similar to, in the order of the lines
+        groups = np.empty(len(similar), dtype=np.intp)
+        leaders: list[int] = []
+        for i in range(len(similar)):
+            matches = np.flatnonzero(similar[i, leaders]) if leaders else ()
+            if len(matches) > 0:
+                groups[i] = matches[0]
+            else:
+                groups[i] = len(leaders)
+                leaders.append(i)
+        return groups
+
+    def _get_median_lines(self, rhos, thetas, groups) -> 'LineSet':
+        group_count = groups.max() + 1
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        counts = np.bincount(groups, minlength=group_count)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        # the largest difference of a theta to the smallest theta before it in its group,
+        # the running minimum is restarted for each group by shifting every group below
+        # all of the previous ones
+        group_thetas = thetas[order]
+        shift = sorted_groups * 2 * pi
+        running_min = np.minimum.accumulate(group_thetas - shift) + shift
+        previous_min = np.concatenate(([0], running_min[:-1]))
+        previous_min[starts] = group_thetas[starts]
+        max_theta_diffs = np.zeros(group_count)
+        np.maximum.at(max_theta_diffs, sorted_groups,
+                      np.abs(group_thetas - previous_min))
+
+        has_to_convert = (max_theta_diffs > 2*Line._theta_diff_threshold)[groups]
+        convert = has_to_convert & (thetas > pi - Line._theta_diff_threshold)
+        rhos, thetas = _get_comparable_form(rhos, thetas, convert)
+
+        median_rhos = self._get_group_medians(rhos, groups, counts, starts)
+        median_thetas = self._get_group_medians(thetas, groups, counts, starts)
+        return _get_conventional_form(median_rhos, median_thetas)
+
+    def _get_group_medians(self, values, groups, counts, starts) -> 'np.ndarray':
+        sorted_values = values[np.lexsort((values, groups))]
+        lower = sorted_values[starts + (counts - 1) // 2]
+        upper = sorted_values[starts + counts // 2]
+        return (lower + upper) / 2
+
+    def _get_tape_boundaries(self, merged_lines: 'LineSet', edges, box_centers, line_indices,
+                             edges_rotated_180=False) -> 'SegmentSet':
+        if len(merged_lines) == 0:
+            return SegmentSet((), (), merged_lines, ())
+        white_pixels_per_box = self._get_white_pixels_per_box(
+            box_centers, _get_edges_integral_image(edges), edges_rotated_180)
+        tape_markers = white_pixels_per_box > self._PIXELS_THRESHOLD
+        line_stops = np.cumsum(np.bincount(line_indices, minlength=len(merged_lines)))
+        runs = MarkerRuns.from_markers(tape_markers, line_stops)
+        runs = runs.fill_gaps(self._MIN_LINE_SEGMENT_HOLE_SIZE - 1)
+        runs = runs.remove_small(self._MIN_LINE_SEGMENT_SIZE)
+        start_boxes, end_boxes = runs.get_segment_boxes()
+        return SegmentSet(box_centers[start_boxes], box_centers[end_boxes],
+                          merged_lines, runs.lines)
+
+    def _get_all_box_centers(self, lines: 'LineSet', geometry: FrameGeometry) -> 'tuple[np.ndarray, np.ndarray]':
+        """Centers of the boxes every BOX_SIZE pixels along each line, for all lines at once.
+
+        A line is walked along x when it is more horizontal than vertical, otherwise along y.
+        Returns a (K, 2) array of box centers and the index of the line each box belongs to,
+        boxes of the same line are contiguous and ordered along the line.
+        """
+        if len(lines) == 0:
+            return np.empty((0, 2), dtype=np.intp), np.empty(0, dtype=np.intp)
+        max_x = geometry.width
+        max_y = geometry.height
+        rhos, thetas = lines.rhos, lines.thetas
+        cos, sin, slopes = geometry.get_trigonometry(thetas)
+        iterate_along_x_axis = (thetas >= pi/4) & (thetas <= 3*pi/4)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_intercepts = rhos*cos - rhos*sin/slopes
+            y_intercepts = rhos*sin - rhos*cos*slopes
+            box_counts = np.where(iterate_along_x_axis,
+                                  max_x // self._BOX_SIZE, max_y // self._BOX_SIZE)
+            steps = np.arange(box_counts.max())[np.newaxis, :]
+            along = steps * self._BOX_SIZE
+            across = np.round(np.where(iterate_along_x_axis,
+                                       y_intercepts, x_intercepts)[:, np.newaxis]
+                              + steps * np.where(iterate_along_x_axis,
+                                                 self._BOX_SIZE * slopes,
+                                                 self._BOX_SIZE * 1/slopes)[:, np.newaxis])
+            x = np.where(iterate_along_x_axis[:, np.newaxis], along, across)
+            y = np.where(iterate_along_x_axis[:, np.newaxis], across, along)
+            valid = ((steps < box_counts[:, np.newaxis])
+                     & (y >= 0) & (y < max_y) & (x >= 0) & (x <= max_x))
+        line_indices, _ = np.nonzero(valid)
+        box_centers = np.stack([x[valid], y[valid]], axis=-1).astype(np.intp)
+        return box_centers, line_indices
+
+    def _get_white_pixels_per_box(self, box_centers: 'np.ndarray', integral_image, edges_rotated_180=False) -> 'np.ndarray':
+        """Counts the edge pixels in every box with four lookups into the integral image.
+
+        Boxes follow the slicing edges[y-h:y+h, x-h:x+h], so they are clipped
+        at the bottom and right border and empty past the top and left border.
+        With edges_rotated_180, the same pixels are counted in the unrotated edges.
+        """
         half_box_size = int(self._BOX_SIZE / 2)
-        for (x, y) in box_centers:
-            box = edges[y-half_box_size:y+half_box_size,
-                        x-half_box_size:x+half_box_size]
-            pixels_per_box.append(np.count_nonzero(box == 255))
-        return pixels_per_box
-
-    def _get_tape_markers(self, white_pixels_per_box: 'list[int]') -> 'list[bool]':
-        return [pixel_count > self._PIXELS_THRESHOLD for pixel_count in white_pixels_per_box]
-
-    def _get_filtered_markers(self, tape_markers: 'list[bool]') -> 'list[bool]':
-        filtered_markers = self._fill_gaps(tape_markers)
-        filtered_markers = self._filter_small_segments(filtered_markers)
-        return filtered_markers
-
-    # TODO: probably don't need to fill up so aggressively, should rewrite
-    def _fill_gaps(self, tape_markers: 'list[bool]') -> 'list[bool]':
-        look_forward_amount = self._MIN_LINE_SEGMENT_HOLE_SIZE - 1
-        gap_filled_markers = tape_markers.copy()
-        recording = False
-        current_segment_size = 0
-        i = -1
-        while i < len(tape_markers) - 1:
-            i += 1
-            if tape_markers[i] is True:
-                recording = True
-                current_segment_size += 1
-            elif recording is True and tape_markers[i] is False:
-                markers_forward = 0
-                end_index = i
-                for j in range(1, look_forward_amount + 1):
-                    if (i + j < len(tape_markers) - 1
-                            and tape_markers[i + j] == True):
-                        markers_forward += 1
-                        end_index = i + j
-                if markers_forward == 0:
-                    i += look_forward_amount
-                    current_segment_size = 0
-                    recording = False
-                elif current_segment_size + markers_forward + 1 >= self._MIN_LINE_SEGMENT_HOLE_SIZE:
-                    gap_filled_markers[i: end_index+1] = [True] * (end_index - i + 1)
-                    current_segment_size += end_index - i
-                    i = end_index - 1  # -1 because incrementing is the first step of the loop
-        return gap_filled_markers
-
-    def _filter_small_segments(self, gap_filled_markers: 'list[bool]') -> 'list[bool]':
-        filtered_markers = gap_filled_markers.copy()
-        i = 0
-        while i < len(gap_filled_markers) - 1:
-            start, end = self._get_next_segments_indices(gap_filled_markers, i)
-            self._filter_segment_if_too_small(filtered_markers, start, end)
-            i = i+1 if end is None else end
-        return filtered_markers
-
-    def _get_next_segments_indices(self, markers: 'list[bool]', start_from: int) -> 'tuple[int, int]':
-        segment_started = False
-        start_index = None
-        end_index = None
-        for i in range(start_from, len(markers)):
-            if segment_started is False and markers[i] is True:
-                segment_started = True
-                start_index = i
-            if segment_started and markers[i] is False:
-                segment_started = False
-                end_index = i
-                break
-        return start_index, end_index or (None if start_index is None else len(markers) - 1)
-
-    def _filter_segment_if_too_small(self, markers: 'list[bool]', segment_start: int, segment_end: int) -> 'list[bool]':
-        if segment_start != None and segment_end - segment_start < self._MIN_LINE_SEGMENT_SIZE:
-            markers[segment_start: segment_end + 1] = [False] * \
-                (segment_end - segment_start + 1)
-
-    def _get_line_segments(self, markers: 'list[bool]', centers: 'list[tuple[int, int]]') -> 'list[LineSegment]':
-        line_segments = []
-        search_from = 0
-        while search_from is not None:
-            start, end = self._get_next_segments_indices(markers, search_from)
-            if start is not None:
-                start_x, start_y = centers[start]
-                end_x, end_y = centers[end]
-                line_segments.append(LineSegment(
-                    (start_x, start_y), (end_x, end_y)))
-            search_from = None if end is None else end + 1
-        return line_segments
-
-    def _get_tape_paths_and_lines(self, center_lines: 'list[Line]', tape_boundaries: 'dict[Line, list[LineSegment]]', frame) -> 'dict[LineSegment, Line]':
-        tape_segments = [x for l in list(tape_boundaries.values()) for x in l]
-        tape_paths_and_lines = {}
+        max_y = integral_image.shape[0] - 1
+        max_x = integral_image.shape[1] - 1
+        x, y = box_centers[:, 0], box_centers[:, 1]
+        if not edges_rotated_180:
+            top, left = y - half_box_size, x - half_box_size
+            is_empty = (top < 0) | (left < 0)
+            bottom = np.minimum(y + half_box_size, max_y)
+            right = np.minimum(x + half_box_size, max_x)
+        else:
+            # rows y-h to y+h-1 of the rotated edges are rows height-y-h to height-y+h-1 of the
+            # edges, so the box is clipped at the top and left border and empty past the bottom and right
+            bottom, right = max_y - y + half_box_size, max_x - x + half_box_size
+            top, left = bottom - 2*half_box_size, right - 2*half_box_size
+            is_empty = (bottom > max_y) | (right > max_x)
+            bottom, right = np.minimum(bottom, max_y), np.minimum(right, max_x)
+        top, left = np.maximum(top, 0), np.maximum(left, 0)
+        counts = (integral_image[bottom, right] - integral_image[top, right]
+                  - integral_image[bottom, left] + integral_image[top, left]) // 255
+        counts[is_empty] = 0
+        return counts
+
+    def _get_tape_paths_and_lines(self, center_lines: 'LineSet', tape_boundaries: 'SegmentSet', geometry: FrameGeometry) -> 'SegmentSet':
+        tape_paths = SegmentSet((), (), center_lines, ())
         if len(center_lines) == 1:
-            frame_intersection_points = _get_line_frame_intersection_points(
-                center_lines[0], frame)
-            frame_intersection_points.sort(
-                key=lambda point: point[1], reverse=True)
-            bottom_point = frame_intersection_points[0]
-            top_point = frame_intersection_points[1]
-            path = LineSegment(bottom_point, top_point)
-            tape_paths_and_lines = {path: center_lines[0]}
+            frame_intersection_points = geometry.get_frame_intersection_points(
+                center_lines.rhos, center_lines.thetas)[0]
+            if not np.isnan(frame_intersection_points).any():
+                # from the bottom of the frame to the top
+                bottom_point, top_point = frame_intersection_points[
+                    np.argsort(-frame_intersection_points[:, 1], kind='stable')]
+                tape_paths = SegmentSet((bottom_point,), (top_point,), center_lines, (0,))
         elif len(center_lines) == 2:
             intersection_point = _get_intersection_point(
                 center_lines[0], center_lines[1])
             center_line_segments = self._segment_center_lines(
-                center_lines, intersection_point, frame)
+                center_lines, intersection_point, geometry)
             tape_paths = self._get_valid_center_line_segments(
-                center_line_segments, tape_segments)
-            tape_paths_and_lines = tape_paths
-        return tape_paths_and_lines
-
-    def _segment_center_lines(self, center_lines: 'list[Line]', intersection_point: 'tuple[int, int]', frame) -> 'dict[LineSegment, Line]':
-        center_line_segments = {}
-        for center_line in center_lines:
-            frame_intersection_points = _get_line_frame_intersection_points(
-                center_line, frame)
-            for frame_intersection_point in frame_intersection_points:
-                line_segment = LineSegment(
-                    intersection_point, frame_intersection_point)
-                center_line_segments[line_segment] = center_line
-        return center_line_segments
-
-    def _get_valid_center_line_segments(self, center_line_segments: 'dict[LineSegment, Line]', tape_segments: 'list[LineSegment]') -> 'dict[LineSegment, Line]':
-        valid_center_line_segments = {}
-        for center_line_segment in list(center_line_segments.keys()):
-            valid = True
-            for tape_segment in tape_segments:
-                if self._are_segments_intersecting(center_line_segment, tape_segment):
-                    valid = False
-            if valid:
-                valid_center_line_segments[center_line_segment] = center_line_segments[center_line_segment]
-        return valid_center_line_segments
-
-    def _are_segments_intersecting(self, segment_one: 'LineSegment', segment_two: 'LineSegment') -> bool:
-        A, B = segment_one.start_point, segment_one.end_point
-        C, D = segment_two.start_point, segment_two.end_point
+                center_line_segments, tape_boundaries)
+        return tape_paths
+
+    def _segment_center_lines(self, center_lines: 'LineSet', intersection_point: 'tuple[int, int]', geometry: FrameGeometry) -> 'SegmentSet':
+        frame_intersection_points = geometry.get_frame_intersection_points(
+            center_lines.rhos, center_lines.thetas).reshape(-1, 2)
+        line_indices = np.repeat(np.arange(len(center_lines)), 2)
+        in_frame = ~np.isnan(frame_intersection_points).any(axis=1)
+        end_points = frame_intersection_points[in_frame]
+        start_points = np.broadcast_to(intersection_point, end_points.shape)
+        return SegmentSet(start_points, end_points, center_lines, line_indices[in_frame])
+
+    def _get_valid_center_line_segments(self, center_line_segments: 'SegmentSet', tape_segments: 'SegmentSet') -> 'SegmentSet':
+        is_intersecting = self._get_intersection_mask(center_line_segments, tape_segments)
+        return center_line_segments.select(~is_intersecting.any(axis=1))
+
+    def _get_intersection_mask(self, segments_one: 'SegmentSet', segments_two: 'SegmentSet') -> 'np.ndarray':
+        """NxM mask of which segments of the first set intersect which of the second"""
+        A = segments_one.start_points[:, np.newaxis, :]
+        B = segments_one.end_points[:, np.newaxis, :]
+        C = segments_two.start_points[np.newaxis, :, :]
+        D = segments_two.end_points[np.newaxis, :, :]
         return self._intersect(A, B, C, D)
 
     # https://stackoverflow.com/a/9997374
-    def _ccw(self, A, B, C) -> bool:
-        Ax, Ay = A
-        Bx, By = B
-        Cx, Cy = C
-        return (Cy-Ay) * (Bx-Ax) > (By-Ay) * (Cx-Ax)
-
-    # Return true if line segments AB and CD intersect
-    def _intersect(self, A, B, C, D) -> bool:
-        return self._ccw(A, C, D) != self._ccw(B, C, D) and self._ccw(A, B, C) != self. _ccw(A, B, D)
+    def _ccw(self, A, B, C) -> 'np.ndarray':
+        return ((C[..., 1]-A[..., 1]) * (B[..., 0]-A[..., 0])
+                > (B[..., 1]-A[..., 1]) * (C[..., 0]-A[..., 0]))
+
+    # Return true if line segments AB and CD intersect, broadcast over arrays of points
+    def _intersect(self, A, B, C, D) -> 'np.ndarray':
+        return (self._ccw(A, C, D) != self._ccw(B, C, D)) & (self._ccw(A, B, C) != self._ccw(A, B, D))
     # https://stackoverflow.com/a/9997374
 
-    def _get_median_line(self, lines: 'list[Line]') -> 'Line':
-        has_to_convert = self._max_theta_diff(
-            lines) > 2*Line._theta_diff_threshold
-        rhos = []
-        thetas = []
-        for line in lines:
-            rho = line.rho
-            theta = line.theta
-            if(has_to_convert and theta > pi - Line._theta_diff_threshold):
-                line = self._convert_to_comparable_form(line)
-                rho, theta = line.rho, line.theta
-            rhos.append(rho)
-            thetas.append(theta)
-        median_rho = median(rhos)
-        median_theta = median(thetas)
-        return self._convert_to_conventional_form(Line(median_rho, median_theta))
-
-    def _max_theta_diff(self, lines: 'list[Line]') -> float:
-        min_theta = lines[0].theta
-        max_diff = 0
-        for line in lines:
-            if (abs(line.theta - min_theta) > max_diff):
-                max_diff = abs(line.theta - min_theta)
-            if (line.theta < min_theta):
-                min_theta = line.theta
-        return max_diff
-
-    def _get_centers_of_parallel_line_pairs(self, lines: 'list[Line]') -> 'list[Line]':
-        if lines is None:
-            return []
-        parallel_lines: dict[float, list[Line]] = {}
-        for line in lines:
-            found_parallel = False
-            for parallel_line_angle, same_angle_lines in parallel_lines.items():
-                if(abs(line.theta - parallel_line_angle) < Line._theta_diff_threshold
-                        or abs(line.theta - parallel_line_angle) > pi - Line._theta_diff_threshold):
-                    same_angle_lines.append(line)
-                    found_parallel = True
-                    break
-            if not found_parallel:
-                parallel_lines[line.theta] = [line]
-
-        center_lines: list[Line] = []
-        for same_angle_lines in list(parallel_lines.values()):
-            if(len(same_angle_lines) == 2):
-                center_lines.append(self._get_center_line(
-                    same_angle_lines[0], same_angle_lines[1]))
-
-        return center_lines
-
-    def _get_center_line(self, line_one: 'Line', line_two: 'Line') -> 'Line':
-        if(abs(line_one.theta - line_two.theta) > Line._theta_diff_threshold):
-            if line_one.theta > line_two.theta:
-                line_one = self._convert_to_comparable_form(line_one)
-            else:
-                line_two = self._convert_to_comparable_form(line_two)
+    def _get_centers_of_parallel_line_pairs(self, lines: 'LineSet') -> 'LineSet':
+        """Center lines of every pair of lines that have no other line parallel to them.
+
+        The thetas are bucketed on the circle of undirected angles, where pi wraps
+        around to 0: sorted, a new bucket starts at every gap of at least the theta
+        threshold, so lines in different buckets are never parallel. Buckets of two
+        lines are pairs, the rare bigger buckets are grouped like before.
+        """
+        firsts, seconds = self._get_parallel_pairs(lines.thetas)
+        return self._get_center_lines(lines, firsts, seconds)
+
+    def _get_parallel_pairs(self, thetas) -> 'tuple[np.ndarray, np.ndarray]':
+        if len(thetas) < 2:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        order = np.argsort(thetas, kind='stable')
+        sorted_thetas = thetas[order]
+        # gap from every theta to the next one, the last one wraps around to the first
+        is_bucket_end = np.diff(sorted_thetas, append=sorted_thetas[0] + pi) \
+            >= Line._theta_diff_threshold
+        if is_bucket_end.any():
+            # rotate so the first bucket starts right after a gap
+            shift = np.flatnonzero(is_bucket_end)[-1] + 1
+            order, is_bucket_end = np.roll(order, -shift), np.roll(is_bucket_end, -shift)
+        buckets = np.concatenate(([0], np.cumsum(is_bucket_end[:-1])))
+        bucket_sizes = np.bincount(buckets)
+
+        # the two lines of a pair are next to each other in the rotated order
+        is_bucket_start = np.concatenate(([True], buckets[1:] != buckets[:-1]))
+        pair_starts = np.flatnonzero(is_bucket_start & (bucket_sizes[buckets] == 2))
+        firsts, seconds = [order[pair_starts]], [order[pair_starts + 1]]
+        for bucket in np.flatnonzero(bucket_sizes > 2):
+            bucket_firsts, bucket_seconds = self._get_greedy_parallel_pairs(
+                thetas, np.sort(order[buckets == bucket]))
+            firsts.append(bucket_firsts)
+            seconds.append(bucket_seconds)
+        firsts, seconds = np.concatenate(firsts), np.concatenate(seconds)
+        firsts, seconds = np.minimum(firsts, seconds), np.maximum(firsts, seconds)
+        in_line_order = np.argsort(firsts, kind='stable')
+        return firsts[in_line_order], seconds[in_line_order]
+
+    def _get_greedy_parallel_pairs(self, thetas, indices) -> 'tuple[np.ndarray, np.ndarray]':
+        # each line joins the first group whose leading line is parallel to it
+        theta_diffs = np.abs(thetas[indices, np.newaxis] - thetas[indices])
+        parallel = ((theta_diffs < Line._theta_diff_threshold)
+                    | (theta_diffs > pi - Line._theta_diff_threshold))
+        groups = self._get_greedy_groups(parallel)
+        pair_groups = np.flatnonzero(np.bincount(groups) == 2)
+        members = indices[np.argsort(groups, kind='stable')]
+        starts = np.searchsorted(np.sort(groups), pair_groups)
+        return members[starts], members[starts + 1]
+
+    def _get_center_lines(self, lines: 'LineSet', firsts, seconds) -> 'LineSet':
+        """Center lines of the line pairs given by two arrays of indices into lines"""
+        rhos_one, thetas_one = lines.rhos[firsts], lines.thetas[firsts]
+        rhos_two, thetas_two = lines.rhos[seconds], lines.thetas[seconds]
+        # lines on both sides of theta = 0 have to be compared in the same form
+        wraps_around = np.abs(thetas_one - thetas_two) > Line._theta_diff_threshold
+        convert_one = wraps_around & (thetas_one > thetas_two)
+        convert_two = wraps_around & ~(thetas_one > thetas_two)
+        rhos_one, thetas_one = _get_comparable_form(rhos_one, thetas_one, convert_one)
+        rhos_two, thetas_two = _get_comparable_form(rhos_two, thetas_two, convert_two)
+        return _get_conventional_form((rhos_one + rhos_two) / 2, (thetas_one + thetas_two) / 2)
 
-        rho_one, theta_one = line_one.rho, line_one.theta
-        rho_two, theta_two = line_two.rho, line_two.theta
 
-        mean_rho = (rho_one + rho_two) / 2
-        mean_theta = (theta_one + theta_two) / 2
-        center_line = Line(mean_rho, mean_theta)
-        center_line = self._convert_to_conventional_form(center_line)
+# HELPER FUNCTIONS
 
-        return center_line
+def _get_comparable_form(rhos, thetas, where) -> 'tuple[np.ndarray, np.ndarray]':
+    """Negates rho and shifts theta by -pi where the mask is set, to compare lines on both sides of theta = 0"""
+    return np.where(where, -rhos, rhos), np.where(where, thetas - pi, thetas)
 
-    def _convert_to_comparable_form(self, line: 'Line') -> 'Line':
-        rho, theta = line.rho, line.theta
-        # if(rho < 0):
-        theta -= pi
-        rho *= -1
-        return Line(rho, theta)
 
-    def _convert_to_conventional_form(self, line: 'Line') -> 'Line':
-        rho, theta = line.rho, line.theta
-        if theta < 0:
-            theta += pi
-            rho *= -1
-        return Line(rho, theta)
+def _get_conventional_form(rhos, thetas) -> 'LineSet':
+    """Lines with a negative theta back in the form with theta in [0, pi)"""
+    is_negative = thetas < 0
+    return LineSet(np.where(is_negative, -rhos, rhos), np.where(is_negative, thetas + pi, thetas))
 
 
-# HELPER FUNCTIONS
+def _get_edges_integral_image(edges) -> 'np.ndarray':
+    """Summed-area table of the edge pixels, shape (height + 1, width + 1).
 
-def _get_line_frame_intersection_points(line: 'Line', frame) -> 'list[tuple[int, int]]':
-    max_x = int(frame.shape[1] - 1)
-    max_y = int(frame.shape[0] - 1)
-    rho, theta = line.rho, line.theta
-    x_intercept = int(rho*cos(theta) - rho*sin(theta)/tan(theta - pi/2))
-    y_intercept = int(rho*sin(theta) - rho*cos(theta)*tan(theta - pi/2))
-    possible_frame_intersection_points = [
-        (0, y_intercept),  # point is somewhere on the left side of the frame
-        # point is somewhere on the right side of the frame
-        (max_x, int(tan(theta - pi/2)*max_x + y_intercept)),
-        (x_intercept, 0),  # point is somewhere on the top of the frame
-        # point is somwhere on the bottom of the frame
-        (int(1/tan(theta - pi/2)*max_y + x_intercept), max_y)
-    ]
-    possible_frame_intersection_points = _filter_out_of_frame(
-        possible_frame_intersection_points, max_x, max_y)
-    frame_intersection_points = _filter_same_points(
-        possible_frame_intersection_points)[0:2]
-    return frame_intersection_points
-
-
-def _filter_out_of_frame(possible_frame_intersection_points: 'list[tuple[int, int]]', max_x, max_y) -> 'list[tuple[int, int]]':
-    filtered_points = []
-    for possible_point in possible_frame_intersection_points:
-        if _is_within_frame(possible_point, max_x, max_y):
-            filtered_points.append(possible_point)
-    return filtered_points
-
-
-def _filter_same_points(possible_frame_intersection_points: 'list[tuple[int, int]]') -> 'list[tuple[int, int]]':
-    return list(set(possible_frame_intersection_points))
-
-
-def _is_within_frame(point: 'tuple[int, int]', max_x, max_y) -> bool:
-    x, y = point
-    return x >= 0 and x <= max_x and y >= 0 and y <= max_y
+    Canny only outputs 0 and 255, so the table counts edge pixels in units of 255.
+    """
+    return cv.integral(edges, sdepth=cv.CV_32S)
 
 
 def _get_intersection_point(line_one: 'Line', line_two: 'Line') -> 'tuple[int, int]':
@@ -0,0 +1,140 @@
+import time
+import numpy as np
+from lib_calculate_direction import DirectionCalculator
+from lib_frame_geometry import FrameGeometry
+from lib_image_processing import ImageProcessor
+from lib_line_following import decide_direction
+from lib_process_lines import LineProcessor
+
+STAGE_IMAGE = 'image'
+STAGE_LINES = 'lines'
+STAGE_DIRECTION = 'direction'
+STAGE_TOTAL = 'total'
+
+
+class SessionRecorder:
+    """Writes camera frames and their capture timestamps into a memory-mapped session file.
+
+    The file is a .npy file of max_frames records, so np.load(path, mmap_mode='r') reads it anywhere.
+    A record is a timestamp with either the frame, or with edges_only, the edges the image processor
+    found as bits, 8 pixels per byte. Records that were never written have a timestamp of 0.
+    """
+    def __init__(self, path, frame_shape, max_frames, edges_only=False):
+        frame_shape = tuple(frame_shape)
+        if edges_only:
+            if len(frame_shape) != 2 or frame_shape[1] % 8 != 0:
+                raise ValueError(f'edges have to be a single channel with a width divisible by 8, not {frame_shape}')
+            field = ('edges', np.uint8, (frame_shape[0], frame_shape[1] // 8))
+        else:
+            field = ('frame', np.uint8, frame_shape)
+        self._records = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.dtype([('timestamp', np.float64), field]), shape=(max_frames,))
+        self._EDGES_ONLY = edges_only
+        self.frame_count = 0
+
+    def record(self, frame, timestamp) -> bool:
+        """Adds the frame (or edges) captured at timestamp, returns False when the session is full"""
+        if self.frame_count == len(self._records):
+            return False
+        record = self._records[self.frame_count]
+        if self._EDGES_ONLY:
+            record['edges'] = np.packbits(frame > 0, axis=-1)
+        else:
+            record['frame'] = frame
+        # written last, a record without its timestamp is not part of the session
+        record['timestamp'] = timestamp
+        self.frame_count += 1
+        return True
+
+    def close(self):
+        self._records.flush()
+        self._records = None
+
+
+class Session:
+    """A recorded session, the frames are read from the file as they are used"""
+    def __init__(self, path):
+        records = np.load(path, mmap_mode='r')
+        self.has_edges = 'edges' in records.dtype.names
+        self.frame_count = int(np.count_nonzero(records['timestamp']))
+        self._records = records[:self.frame_count]
+        self.timestamps = self._records['timestamp']
+        if self.has_edges:
+            height, packed_width = records.dtype['edges'].shape
+            self.frame_shape = (height, packed_width * 8)
+        else:
+            self.frame_shape = records.dtype['frame'].shape
+
+    def __len__(self):
+        return self.frame_count
+
+    def get_frame(self, index: int) -> 'np.ndarray':
+        """The camera frame, or for a session of edges the edges as 0 and 255"""
+        if self.has_edges:
+            return np.unpackbits(self._records[index]['edges'], axis=-1) * np.uint8(255)
+        return self._records[index]['frame']
+
+
+def record_edges(session: Session, path, image_processor: ImageProcessor) -> SessionRecorder:
+    """Records the edges of the frames of a session of camera frames, in the orientation of the camera like the analysis gets them"""
+    recorder = SessionRecorder(path, session.frame_shape[:2], len(session), edges_only=True)
+    for i in range(len(session)):
+        edges, houghlines = image_processor.get_edges_and_houghlines(session.get_frame(i), rotate_180=True)
+        recorder.record(edges, session.timestamps[i])
+    recorder.close()
+    return recorder
+
+
+def replay_session(session: Session,
+        image_processor: ImageProcessor,
+        line_processor: LineProcessor,
+        direction_calculator: DirectionCalculator,
+        real_time=False) -> dict:
+    """Pushes the frames of a session through the image processor, the line processor and the direction calculator.
+
+    Without real_time the frames follow each other as fast as they are processed, with it a frame is
+    not processed before its time in the session. Every frame is processed either way, so the trace
+    only depends on the session and the settings. For a session of edges the image stage is only the
+    hough transform. Returns the 'latencies' in seconds of every stage and the 'trace' of the
+    direction calculator, one entry per frame.
+    """
+    latencies = {stage: np.zeros(len(session)) for stage in (STAGE_IMAGE, STAGE_LINES, STAGE_DIRECTION, STAGE_TOTAL)}
+    trace = []
+    replay_start_time = time.perf_counter()
+    for i in range(len(session)):
+        if real_time:
+            delay = replay_start_time + session.timestamps[i] - session.timestamps[0] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        frame = session.get_frame(i)
+        start_time = time.perf_counter()
+        if session.has_edges:
+            edges = frame
+            houghlines = image_processor.get_houghlines(edges, rotate_180=True)
+        else:
+            edges, houghlines = image_processor.get_edges_and_houghlines(frame, rotate_180=True)
+        image_time = time.perf_counter()
+        analysis = line_processor.analyze_frame(FrameGeometry.of(edges), edges, houghlines, edges_rotated_180=True)
+        lines_time = time.perf_counter()
+        processed_frame_info = decide_direction(edges, analysis, direction_calculator)
+        end_time = time.perf_counter()
+
+        latencies[STAGE_IMAGE][i] = image_time - start_time
+        latencies[STAGE_LINES][i] = lines_time - image_time
+        latencies[STAGE_DIRECTION][i] = end_time - lines_time
+        latencies[STAGE_TOTAL][i] = end_time - start_time
+        trace.append({
+            'timestamp': float(session.timestamps[i] - session.timestamps[0]),
+            'stableState': processed_frame_info['overlay']['stable_state'],
+            'incomingState': processed_frame_info['overlay']['incoming_state'],
+            'currentNode': processed_frame_info['current_node'],
+            'velocity': [round(float(v), 3) for v in processed_frame_info['velocity_vector']]
+        })
+    return {'latencies': latencies, 'trace': trace}
+
+
+def get_latency_percentiles(latencies: 'dict[str, np.ndarray]', percentiles=(50, 90, 99, 100)) -> 'dict[str, list[float]]':
+    """The percentiles of the latencies of every stage, in milliseconds"""
+    return {stage: (np.percentile(stage_latencies, percentiles) * 1000).tolist() if len(stage_latencies) > 0
+                   else [float('nan')] * len(percentiles)
+            for stage, stage_latencies in latencies.items()}
@@ -0,0 +1,63 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedFrameRing:
+    """Frame slots in shared memory, so frames do not have to be pickled between processes.
+
+    The process that creates the ring hands out the slots with acquire and release.
+    Pickling the ring only sends its name and shape, in another process it is attached
+    to the same memory again, which happens once per process.
+    """
+    def __init__(self, frame_shape, slot_count=4, name=None):
+        self.frame_shape = tuple(frame_shape)
+        self.slot_count = slot_count
+        frame_size = int(np.prod(self.frame_shape))
+        self._is_owner = name is None
+        if self._is_owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=frame_size * slot_count)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self._frames = np.ndarray((slot_count,) + self.frame_shape, dtype=np.uint8,
+                                  buffer=self._memory.buf)
+        self._free_slots = list(range(slot_count))
+
+    def __reduce__(self):
+        return _attach, (self.name, self.frame_shape, self.slot_count)
+
+    def get_frame(self, slot: int) -> 'np.ndarray':
+        """The frame in the slot, changes to it are seen by every process"""
+        return self._frames[slot]
+
+    def acquire(self) -> 'int | None':
+        """Reserves a free slot, None when all of them are in use"""
+        if len(self._free_slots) == 0:
+            return None
+        return self._free_slots.pop(0)
+
+    def release(self, slot: int):
+        self._free_slots.append(slot)
+
+    def put(self, frame) -> 'int | None':
+        """Copies the frame into a free slot and returns the slot, None when all of them are in use"""
+        slot = self.acquire()
+        if slot is not None:
+            self._frames[slot] = frame
+        return slot
+
+    def close(self):
+        _attached_rings.pop(self.name, None)
+        self._frames = None
+        self._memory.close()
+        if self._is_owner:
+            self._memory.unlink()
+
+
+_attached_rings: 'dict[str, SharedFrameRing]' = {}
+
+def _attach(name, frame_shape, slot_count) -> 'SharedFrameRing':
+    ring = _attached_rings.get(name)
+    if ring is None:
+        ring = _attached_rings[name] = SharedFrameRing(frame_shape, slot_count, name)
+    return ring
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+
+
+class StateStore:
+    """A JSON state that lives in memory and is written to its file behind the changes.
+
+    Reads never touch the disk. Every change increments version and schedules a write
+    write_delay seconds after the last change, but no later than max_write_delay seconds
+    after the first unwritten one. A write goes to a temporary file that is renamed over
+    the old one, so the file is never half written. flush writes right away, for shutdown.
+    """
+    def __init__(self, path, default=None, write_delay=1.0, max_write_delay=10.0):
+        self._PATH = path
+        self._WRITE_DELAY = write_delay
+        self._MAX_WRITE_DELAY = max_write_delay
+        self._state = _read_json(path, {} if default is None else default)
+        self.version = 0
+        self._written_version = 0
+        self._first_change_time = None
+        self._write_handle = None
+        self._is_writing = False
+        self._write_lock = threading.Lock()
+
+    def get(self):
+        """The current state, it must not be changed in place"""
+        return self._state
+
+    def set(self, state):
+        self._state = state
+        self._changed()
+
+    def update(self, changes):
+        """Merges the changes into the top level of the state"""
+        self._state = self._state | changes
+        self._changed()
+
+    def patch(self, operations):
+        """Applies a JSON patch, only the containers on the paths of the operations are copied"""
+        self._state = apply_json_patch(self._state, operations)
+        self._changed()
+
+    def flush(self):
+        """Writes the state now if it changed since the last write, blocks until it is written"""
+        if self._write_handle is not None:
+            self._write_handle.cancel()
+            self._write_handle = None
+        if self._written_version != self.version:
+            self._write(self.version, json.dumps(self._state))
+            self._first_change_time = None
+
+    def _changed(self):
+        self.version += 1
+        self._schedule_write()
+
+    def _schedule_write(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._first_change_time is None:
+            self._first_change_time = now
+        if self._write_handle is not None:
+            self._write_handle.cancel()
+        delay = min(self._WRITE_DELAY, self._first_change_time + self._MAX_WRITE_DELAY - now)
+        self._write_handle = loop.call_later(max(delay, 0), self._start_write)
+
+    def _start_write(self):
+        self._write_handle = None
+        if self._is_writing:
+            return # written again once the write in progress is done
+        self._is_writing = True
+        version = self.version
+        self._first_change_time = None
+        # serialized here, the state can change while the file is being written
+        text = json.dumps(self._state)
+        write = asyncio.get_running_loop().run_in_executor(None, self._write, version, text)
+        write.add_done_callback(self._write_done)
+
+    def _write(self, version, text):
+        with self._write_lock:
+            # a flush may have written a newer state in the meantime
+            if version <= self._written_version:
+                return
+            _write_json_atomically(self._PATH, text)
+            self._written_version = version
+
+    def _write_done(self, write):
+        self._is_writing = False
+        if write.exception() is not None:
+            print('writing', self._PATH, 'failed:', write.exception())
+        if self._written_version != self.version and self._write_handle is None:
+            self._schedule_write()
+
+
+def apply_json_patch(document, operations):
+    """Returns the document with the add, replace and remove operations of a JSON patch (RFC 6902) applied.
+
+    The document is not changed, only the objects and arrays that the operations go through are copied.
+    Raises ValueError when an operation does not fit the document.
+    """
+    for operation in operations:
+        if operation['op'] not in ('add', 'replace', 'remove'):
+            raise ValueError('unsupported patch operation ' + str(operation['op']))
+        keys = _parse_json_pointer(operation['path'])
+        if len(keys) == 0:
+            if operation['op'] == 'remove':
+                raise ValueError('the whole document cannot be removed')
+            document = operation['value']
+        else:
+            document = _patch_value(document, keys, operation)
+    return document
+
+
+def _patch_value(container, keys, operation):
+    container = container.copy() if isinstance(container, (dict, list)) else container
+    key = keys[0]
+    if isinstance(container, list):
+        if key == '-' and len(keys) == 1 and operation['op'] == 'add':
+            key = len(container)
+        elif not key.isdigit() or int(key) > len(container) \
+                or (int(key) == len(container) and (operation['op'] != 'add' or len(keys) > 1)):
+            raise ValueError('no array index ' + key + ' in ' + operation['path'])
+        key = int(key)
+    elif not isinstance(container, dict):
+        raise ValueError('no container at ' + operation['path'])
+    elif (len(keys) > 1 or operation['op'] != 'add') and key not in container:
+        raise ValueError('no key ' + key + ' in ' + operation['path'])
+
+    if len(keys) > 1:
+        container[key] = _patch_value(container[key], keys[1:], operation)
+    elif operation['op'] == 'remove':
+        del container[key]
+    elif operation['op'] == 'add' and isinstance(container, list):
+        container.insert(key, operation['value'])
+    else:
+        container[key] = operation['value']
+    return container
+
+
+def _parse_json_pointer(pointer):
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise ValueError('invalid JSON pointer ' + pointer)
+    return [key.replace('~1', '/').replace('~0', '~') for key in pointer[1:].split('/')]
+
+
+def _read_json(path, default):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_json_atomically(path, text):
+    # next to the file, a rename only replaces it atomically on the same file system
+    descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+    with os.fdopen(descriptor, 'w') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
@@ -0,0 +1,227 @@
+import re
+import cv2 as cv
+import numpy as np
+
+_SHIFT = 4 # fractional bits of the points given to OpenCV
+
+
+def parse_map(text: str) -> dict:
+    """Parses a map like website/assets/parse-map.js does, e.g. the ones in website/cool-maps.
+
+    Returns the same structure: 'nodes', dicts with x, y, id and isPossibleDestination,
+    and 'lineSegments', dicts with the start and end node. y grows downwards, t goes up.
+    Raises ValueError where parse-map.js throws an error.
+    """
+    nodes = [{'x': 0, 'y': 0, 'id': 0}]
+    line_segments = []
+    position = 0
+
+    def find_node(x, y):
+        return next((node for node in nodes if node['x'] == x and node['y'] == y), None)
+
+    def parse(start_x, start_y):
+        nonlocal position
+        current_x, current_y = start_x, start_y
+        while position < len(text):
+            token = text[position]
+            if token in 'trbl':
+                distance_match = re.match(r'\*|[0-9.]+', text[position + 1:])
+                if distance_match is None:
+                    raise ValueError('distance is formatted incorrectly!')
+                distance_str = distance_match.group(0)
+                distance = _parse_float(distance_str) or 1
+                step_x, step_y = {'l': (-1, 0), 'r': (1, 0), 't': (0, -1), 'b': (0, 1)}[token]
+                ray = ((current_x, current_y), (current_x + step_x*distance, current_y + step_y*distance))
+                distances = [_get_intersection_distance(ray, segment) for segment in line_segments]
+                smallest_distance = min(distances, default=float('inf'))
+
+                if distance_str == '*' and smallest_distance == float('inf'):
+                    raise ValueError('The newly created line segment would go to infinity.')
+                elif distance_str != '*' and smallest_distance < distance:
+                    raise ValueError('The newly created line segment would cross an other line segment.')
+
+                final_distance = smallest_distance if distance_str == '*' else distance
+                new_x, new_y = current_x + step_x*final_distance, current_y + step_y*final_distance
+                end_node = find_node(new_x, new_y)
+                if end_node is None:
+                    end_node = {'x': new_x, 'y': new_y, 'id': len(nodes)}
+                    nodes.append(end_node)
+                    if smallest_distance == final_distance:
+                        # the new node splits the line segment it lies on
+                        crossed_segment = line_segments[distances.index(smallest_distance)]
+                        line_segments.append({'start': end_node, 'end': crossed_segment['end']})
+                        crossed_segment['end'] = end_node
+                line_segments.append({'start': find_node(current_x, current_y), 'end': end_node})
+                current_x, current_y = new_x, new_y
+                position += 1 + len(distance_str)
+            elif token == ')':
+                position += 1
+                return
+            elif token == '(':
+                position += 1
+                parse(current_x, current_y)
+            elif token == '|':
+                position += 1
+                current_x, current_y = start_x, start_y
+            elif token.isspace():
+                position += 1
+            elif token == '#':
+                comment_end = text.find('\n', position)
+                if comment_end == -1:
+                    position = len(text)
+                    return
+                position = comment_end + 1
+            else:
+                raise ValueError('Unknown token: ' + token)
+
+    parse(0, 0)
+    # dead ends are destinations
+    for node in nodes:
+        incident_segments = [segment for segment in line_segments
+                             if segment['start']['id'] == node['id'] or segment['end']['id'] == node['id']]
+        node['isPossibleDestination'] = len(incident_segments) <= 1
+    return {'lineSegments': line_segments, 'nodes': nodes}
+
+
+class TrackRenderer:
+    """Renders camera-like frames of a map, with the tape paths in view as the ground truth.
+
+    The camera looks straight down at the pose (x, y, heading) of the map, heading is in radians,
+    clockwise from t. view_width is the width of the floor the frame shows and tape_width the
+    width of the tape, both in map units. noise is the standard deviation of the gaussian noise
+    and lighting_gradient how much brighter one side of the frame is than the center, e.g. 0.3
+    for 30%, towards lighting_angle. Like the real camera, the frames are upside down: the
+    analysis, which rotates them by 180 degrees, sees the heading pointing up.
+    """
+    def __init__(self, track_map: dict, frame_shape=(480, 640), view_width=8.0, tape_width=0.5,
+                 floor_color=(190, 200, 205), tape_color=(40, 40, 40), noise=6.0, blur=1.0,
+                 lighting_gradient=0.0, lighting_angle=0.0, seed=None):
+        self._FRAME_SHAPE = tuple(frame_shape)
+        self._PIXELS_PER_UNIT = frame_shape[1] / view_width
+        self._TAPE_THICKNESS = max(round(tape_width * self._PIXELS_PER_UNIT), 1)
+        self._FLOOR_COLOR = floor_color
+        self._TAPE_COLOR = tape_color
+        self._NOISE = noise
+        self._BLUR = blur
+        self._rng = np.random.default_rng(seed)
+        self._segments = np.array([[(segment['start']['x'], segment['start']['y']),
+                                    (segment['end']['x'], segment['end']['y'])]
+                                   for segment in track_map['lineSegments']], dtype=np.float64).reshape(-1, 2, 2)
+        height, width = self._FRAME_SHAPE
+        # the lighting only depends on the frame, so it is computed once
+        ys, xs = np.mgrid[0:height, 0:width]
+        ramp = ((xs - width/2) * np.cos(lighting_angle) + (ys - height/2) * np.sin(lighting_angle)) / (max(width, height) / 2)
+        self._lighting = (1 + lighting_gradient * ramp).astype(np.float32)[:, :, np.newaxis]
+
+    def render(self, x, y, heading) -> 'tuple[np.ndarray, np.ndarray]':
+        """Returns the BGR camera frame and the tape paths in view.
+
+        The tape paths are an (N, 2, 2) array of the start and end points of the center lines
+        of the tape, clipped to the frame, in the coordinates the analysis uses.
+        """
+        height, width = self._FRAME_SHAPE
+        segments = self._to_analysis_space(self._segments, x, y, heading)
+        # tape that can reach into the frame, the rest is not drawn
+        margin = self._TAPE_THICKNESS
+        in_view = ((segments[:, :, 0].max(axis=1) >= -margin) & (segments[:, :, 0].min(axis=1) <= width + margin)
+                   & (segments[:, :, 1].max(axis=1) >= -margin) & (segments[:, :, 1].min(axis=1) <= height + margin))
+        segments = segments[in_view]
+
+        frame = np.empty(self._FRAME_SHAPE + (3,), dtype=np.uint8)
+        frame[:] = self._FLOOR_COLOR
+        # the camera frame is the analyzed frame rotated by 180 degrees
+        camera_segments = (width - 1, height - 1) - segments
+        if len(segments) > 0:
+            cv.polylines(frame, np.round(camera_segments * (1 << _SHIFT)).astype(np.int32), False,
+                         self._TAPE_COLOR, self._TAPE_THICKNESS, cv.LINE_AA, _SHIFT)
+        if self._BLUR > 0:
+            frame = cv.GaussianBlur(frame, (0, 0), self._BLUR)
+        frame = frame * self._lighting
+        if self._NOISE > 0:
+            frame += self._rng.standard_normal(frame.shape, dtype=np.float32) * np.float32(self._NOISE)
+        frame = np.clip(frame, 0, 255).astype(np.uint8)
+        return frame, self._clip_to_frame(segments)
+
+    def get_random_poses(self, count, max_offset=0.5, max_heading_error=0.3) -> 'np.ndarray':
+        """count poses (x, y, heading) on the tape, facing along it, at most max_offset units
+        to the side of it and max_heading_error radians off its direction"""
+        segments = self._segments[self._rng.integers(len(self._segments), size=count)]
+        directions = segments[:, 1] - segments[:, 0]
+        positions = segments[:, 0] + directions * self._rng.uniform(0, 1, (count, 1))
+        lengths = np.linalg.norm(directions, axis=1, keepdims=True)
+        normals = np.stack((-directions[:, 1], directions[:, 0]), axis=1) / lengths
+        positions += normals * self._rng.uniform(-max_offset, max_offset, (count, 1))
+        # either way along the tape
+        headings = np.arctan2(directions[:, 0], -directions[:, 1]) + self._rng.integers(2, size=count) * np.pi
+        headings += self._rng.uniform(-max_heading_error, max_heading_error, count)
+        return np.column_stack((positions, headings))
+
+    def _to_analysis_space(self, points, x, y, heading):
+        """Map points to the pixels of the analyzed frame, where the heading points up"""
+        height, width = self._FRAME_SHAPE
+        cos, sin = np.cos(heading), np.sin(heading)
+        relative = points - (x, y)
+        rotated = np.stack((relative[..., 0]*cos + relative[..., 1]*sin,
+                            -relative[..., 0]*sin + relative[..., 1]*cos), axis=-1)
+        return rotated * self._PIXELS_PER_UNIT + (width / 2, height / 2)
+
+    def _clip_to_frame(self, segments):
+        height, width = self._FRAME_SHAPE
+        clipped = []
+        for start, end in segments:
+            # cv.clipLine works on integer pixels, the clipped points are moved along the segment instead
+            direction = end - start
+            length = np.hypot(*direction)
+            if length == 0:
+                continue
+            t_start, t_end = 0.0, 1.0
+            for axis, size in ((0, width - 1), (1, height - 1)):
+                if direction[axis] == 0:
+                    if not 0 <= start[axis] <= size:
+                        t_start, t_end = 1.0, 0.0
+                    continue
+                t_low = (0 - start[axis]) / direction[axis]
+                t_high = (size - start[axis]) / direction[axis]
+                t_start = max(t_start, min(t_low, t_high))
+                t_end = min(t_end, max(t_low, t_high))
+            if t_start < t_end:
+                clipped.append((start + direction*t_start, start + direction*t_end))
+        return np.array(clipped, dtype=np.float64).reshape(-1, 2, 2)
+
+
+def _parse_float(text) -> float:
+    """The number at the start of text, 0 when there is none, like parseFloat without the NaN"""
+    number = re.match(r'[0-9]*(\.[0-9]+)?', text).group(0)
+    return float(number) if number not in ('', '.') else 0.0
+
+
+def _get_intersection_distance(ray, segment) -> float:
+    """Distance from the start of the ray to where it meets the axis aligned line segment, like getIntersectionDistance of parse-map.js"""
+    (ray_x, ray_y), (ray_end_x, ray_end_y) = ray
+    start, end = segment['start'], segment['end']
+    is_ray_vertical = ray_x == ray_end_x
+    is_segment_vertical = start['x'] == end['x']
+    if is_ray_vertical != is_segment_vertical:
+        # crossing, ray and segment are perpendicular
+        along, across = (1, 0) if is_ray_vertical else (0, 1)
+        ray_start, ray_end = (ray_x, ray_y), (ray_end_x, ray_end_y)
+        segment_across = sorted((start['xy'[across]], end['xy'[across]]))
+        if segment_across[0] <= ray_start[across] <= segment_across[1]:
+            distance = (start['xy'[along]] - ray_start[along]) * np.sign(ray_end[along] - ray_start[along])
+            if distance > 0:
+                return float(distance)
+        return float('inf')
+    # parallel, only a segment on the same line can be hit
+    axis = 0 if is_ray_vertical else 1 # the coordinate that stays the same
+    other = 1 - axis
+    ray_start, ray_end = (ray_x, ray_y), (ray_end_x, ray_end_y)
+    if ray_start[axis] != start['xy'[axis]]:
+        return float('inf')
+    sign = np.sign(ray_end[other] - ray_start[other])
+    distance_1 = (start['xy'[other]] - ray_start[other]) * sign
+    distance_2 = (end['xy'[other]] - ray_start[other]) * sign
+    if distance_1 > 0 and distance_2 > 0:
+        return float(min(distance_1, distance_2))
+    elif distance_1 <= 0 and distance_2 <= 0:
+        return float('inf')
+    raise ValueError('The newly created line segment would lay on an other line segment.')
@@ -1,6 +1,8 @@
 from math import atan2, sqrt
 
 class Vector2D:
+    __slots__ = ('x', 'y')
+
     def __init__(self, x: float, y: float) -> 'Vector2D':
         self.x = x
         self.y = y
@@ -0,0 +1,231 @@
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+from lib_calculate_direction import STATE_LINE_LOST, DirectionCalculator
+from lib_image_processing import ImageProcessor
+from lib_line_following import analyze_camera_frame, analyze_planned_frame, decide_direction, process_shared_frame
+from lib_line_tracking import LineTracker
+from lib_process_lines import LineProcessor
+from lib_shared_frames import SharedFrameRing
+
+COMMAND_STOP = 'stop'
+COMMAND_PROCESS_FRAME = 'process_frame'
+COMMAND_SET_FRAME_RING = 'set_frame_ring'
+COMMAND_SET_NEW_PATH = 'set_new_path'
+COMMAND_SET_IMAGE_PROCESSOR = 'set_image_processor'
+COMMAND_SET_LINE_PROCESSOR = 'set_line_processor'
+COMMAND_COMMIT_ANALYSIS = 'commit_analysis'
+COMMAND_SET_SEND_ANALYSIS = 'set_send_analysis'
+
+
+class VisionWorker:
+    """A long-lived process that owns the processors, the line tracker and the direction calculator.
+
+    Commands are handled in the order they are sent, so a new path always applies from
+    the next frame on. For every processed frame a small result comes back:
+    {'slot', 'velocity_vector', 'current_node', 'state', 'analysis', 'overlay'}, the frame stays
+    in its slot unchanged, render_overlay draws the analysis on a copy of it. After
+    set_send_analysis(False) the 'analysis' and 'overlay' are left out, so they are not pickled
+    for every frame while nothing draws them.
+
+    With analysis_workers, the edges, hough lines and line processing of consecutive frames
+    run in that many extra processes at the same time. The direction calculator still sees
+    the frames one by one in the order they were sent, and the results come back in that order.
+    With a line tracker as well, the vision worker plans the search of every frame when it is sent,
+    from the tracks predicted past the frames still being analyzed, and updates the tracks in
+    capture order. The strips then lag the line by up to analysis_workers frames more.
+    """
+    def __init__(self,
+                 image_processor: ImageProcessor,
+                 line_processor: LineProcessor,
+                 direction_calculator: DirectionCalculator,
+                 line_tracker: LineTracker = None,
+                 analysis_workers=0):
+        self.max_frames_in_flight = max(analysis_workers, 1)
+        self._commands = mp.Queue()
+        self._results = mp.Queue()
+        # every analysis worker gets its own jobs, so changed processors reach all of them
+        self._analysis_jobs = [mp.Queue() for _ in range(analysis_workers)]
+        # the workers have to share the resource tracker of this process, their own tracker
+        # would unlink the shared frame ring when they exit
+        resource_tracker.ensure_running()
+        self._process = mp.Process(
+            target=_run_vision_worker,
+            args=(self._commands, self._results, self._analysis_jobs,
+                  image_processor, line_processor, direction_calculator, line_tracker),
+            daemon=True)
+        self._analysis_processes = [
+            mp.Process(
+                target=_run_analysis_worker,
+                args=(jobs, self._commands, image_processor, line_processor, line_tracker),
+                daemon=True)
+            for jobs in self._analysis_jobs]
+
+    def start(self) -> 'VisionWorker':
+        for process in self._analysis_processes:
+            process.start()
+        self._process.start()
+        return self
+
+    def stop(self):
+        self._commands.put((COMMAND_STOP, None))
+        self._process.join()
+        for process in self._analysis_processes:
+            process.join()
+
+    def set_frame_ring(self, frame_ring: SharedFrameRing):
+        self._commands.put((COMMAND_SET_FRAME_RING, frame_ring))
+
+    def process_frame(self, slot: int):
+        self._commands.put((COMMAND_PROCESS_FRAME, slot))
+
+    def set_new_path(self, path):
+        self._commands.put((COMMAND_SET_NEW_PATH, path))
+
+    def set_image_processor(self, image_processor: ImageProcessor):
+        self._commands.put((COMMAND_SET_IMAGE_PROCESSOR, image_processor))
+
+    def set_line_processor(self, line_processor: LineProcessor):
+        self._commands.put((COMMAND_SET_LINE_PROCESSOR, line_processor))
+
+    def set_send_analysis(self, send_analysis: bool):
+        """Whether the results sent from now on include the analysis and overlay"""
+        self._commands.put((COMMAND_SET_SEND_ANALYSIS, send_analysis))
+
+    def get_result(self) -> 'dict | None':
+        """Waits for the result of the next processed frame, errors of the worker are raised here.
+
+        Returns None once the worker has stopped.
+        """
+        result = self._results.get()
+        if result is None:
+            return None
+        if 'error' in result:
+            raise result['error']
+        return result
+
+
+def _run_vision_worker(commands, results, analysis_jobs,
+                       image_processor: ImageProcessor,
+                       line_processor: LineProcessor,
+                       direction_calculator: DirectionCalculator,
+                       line_tracker: LineTracker):
+    frame_ring = None
+    # frames handed to the analysis workers are numbered, so they can be committed in that order
+    next_sequence = 0
+    next_commit = 0
+    analyses: 'dict[int, tuple]' = {}
+    # a new path applies from the frame after the last one sent before it
+    new_paths: 'list[tuple[int, list]]' = []
+    send_analysis = True
+    while True:
+        command, argument = commands.get()
+        if command == COMMAND_STOP:
+            for jobs in analysis_jobs:
+                jobs.put((COMMAND_STOP, None))
+            results.put(None)
+            break
+        elif command == COMMAND_PROCESS_FRAME:
+            if len(analysis_jobs) > 0:
+                search_lines = None
+                if line_tracker is not None:
+                    # the tracks were last updated with the frame before next_commit
+                    search_lines = line_tracker.plan_search(
+                        direction_calculator._stable_state == STATE_LINE_LOST,
+                        frames_ahead=next_sequence - next_commit + 1)
+                analysis_jobs[next_sequence % len(analysis_jobs)].put(
+                    (COMMAND_PROCESS_FRAME, (next_sequence, argument, search_lines)))
+                next_sequence += 1
+                continue
+            try:
+                processed_frame_info = process_shared_frame(
+                    frame_ring, argument,
+                    image_processor, line_processor, direction_calculator, line_tracker)
+            except Exception as error:
+                results.put({'slot': argument, 'error': error})
+                continue
+            results.put(_get_result(argument, processed_frame_info, direction_calculator, send_analysis))
+        elif command == COMMAND_COMMIT_ANALYSIS:
+            sequence, slot, analysis, searched_full_frame, error = argument
+            analyses[sequence] = (slot, analysis, searched_full_frame, error)
+            while next_commit in analyses:
+                slot, analysis, searched_full_frame, error = analyses.pop(next_commit)
+                while len(new_paths) > 0 and new_paths[0][0] <= next_commit:
+                    direction_calculator.set_new_path(new_paths.pop(0)[1])
+                next_commit += 1
+                if error is not None:
+                    results.put({'slot': slot, 'error': error})
+                    continue
+                try:
+                    if line_tracker is not None:
+                        line_tracker.update(analysis.merged_lines, searched_full_frame)
+                    processed_frame_info = decide_direction(frame_ring.get_frame(slot), analysis, direction_calculator)
+                except Exception as error:
+                    results.put({'slot': slot, 'error': error})
+                    continue
+                results.put(_get_result(slot, processed_frame_info, direction_calculator, send_analysis))
+        elif command == COMMAND_SET_FRAME_RING:
+            frame_ring = argument
+            for jobs in analysis_jobs:
+                jobs.put((command, argument))
+        elif command == COMMAND_SET_NEW_PATH:
+            if next_commit < next_sequence:
+                new_paths.append((next_sequence, argument))
+            else:
+                direction_calculator.set_new_path(argument)
+        elif command == COMMAND_SET_IMAGE_PROCESSOR:
+            image_processor = argument
+            for jobs in analysis_jobs:
+                jobs.put((command, argument))
+        elif command == COMMAND_SET_LINE_PROCESSOR:
+            line_processor = argument
+            for jobs in analysis_jobs:
+                jobs.put((command, argument))
+        elif command == COMMAND_SET_SEND_ANALYSIS:
+            send_analysis = argument
+
+
+def _run_analysis_worker(jobs, commits,
+                         image_processor: ImageProcessor,
+                         line_processor: LineProcessor,
+                         line_tracker: LineTracker):
+    """Analyzes frames for the vision worker, the analyses go back to it as commit commands.
+
+    The line tracker is only used for its settings, the vision worker plans the searches.
+    """
+    frame_ring = None
+    while True:
+        command, argument = jobs.get()
+        if command == COMMAND_STOP:
+            break
+        elif command == COMMAND_PROCESS_FRAME:
+            sequence, slot, search_lines = argument
+            try:
+                if line_tracker is None:
+                    analysis = analyze_camera_frame(frame_ring.get_frame(slot), image_processor, line_processor)
+                else:
+                    analysis = analyze_planned_frame(frame_ring.get_frame(slot), image_processor, line_processor,
+                                                     line_tracker, search_lines)
+            except Exception as error:
+                commits.put((COMMAND_COMMIT_ANALYSIS, (sequence, slot, None, search_lines is None, error)))
+                continue
+            commits.put((COMMAND_COMMIT_ANALYSIS, (sequence, slot, analysis, search_lines is None, None)))
+        elif command == COMMAND_SET_FRAME_RING:
+            frame_ring = argument
+        elif command == COMMAND_SET_IMAGE_PROCESSOR:
+            image_processor = argument
+        elif command == COMMAND_SET_LINE_PROCESSOR:
+            line_processor = argument
+
+
+def _get_result(slot: int, processed_frame_info: dict, direction_calculator: DirectionCalculator, send_analysis: bool) -> dict:
+    result = {
+        'slot': slot,
+        'velocity_vector': processed_frame_info['velocity_vector'],
+        'current_node': processed_frame_info['current_node'],
+        'state': direction_calculator._stable_state
+    }
+    if send_analysis:
+        # for rendering the overlay, a few KB of small arrays
+        result['analysis'] = processed_frame_info['analysis']
+        result['overlay'] = processed_frame_info['overlay']
+    return result
@@ -1,50 +1,162 @@
 import aiohttp 
 from aiohttp import web
 import asyncio
-import aiofiles
+import collections
+import itertools
 import json
-from weakref import WeakKeyDictionary
+import math
+from lib_state_store import StateStore
+
+
+class VideoClient:
+    """ A viewer of a variant of the video stream, it only ever holds the newest frame it has not sent yet """
+    def __init__(self, variant, max_fps):
+        self.variant = variant
+        self._frame_encoded = None
+        self._has_frame = asyncio.Event()
+        self._min_interval = 1 / max_fps
+        self._last_get_time = None
+
+    def put(self, frame_encoded):
+        """ Replaces the frame waiting to be sent, if there is one """
+        self._frame_encoded = frame_encoded
+        self._has_frame.set()
+
+    async def get(self):
+        """ Waits for a frame newer than the last one, no sooner than 1/max_fps after the last one """
+        loop = asyncio.get_running_loop()
+        if self._last_get_time is not None:
+            delay = self._last_get_time + self._min_interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await self._has_frame.wait()
+        self._has_frame.clear()
+        self._last_get_time = loop.time()
+        return self._frame_encoded
+
+
+class WebsocketClient:
+    """
+        A websocket connection with its own bounded queue of serialized messages
+        Messages with the same coalesce key replace each other while unsent, so a slow
+        client only gets the latest state, a client whose queue is full anyway gets evicted
+    """
+    def __init__(self, ws, max_queue_size):
+        self.ws = ws
+        self.processed_ids = []
+        self._MAX_QUEUE_SIZE = max_queue_size
+        self._messages = collections.OrderedDict()
+        self._has_message = asyncio.Event()
+        self._message_numbers = itertools.count()
+
+    def put(self, message, coalesce_key=None):
+        """ Queues a serialized message, returns False when the queue is full """
+        if coalesce_key is None:
+            coalesce_key = next(self._message_numbers)
+        if coalesce_key in self._messages:
+            # the newer message is sent where the older one would have been
+            self._messages[coalesce_key] = message
+            return True
+        if len(self._messages) >= self._MAX_QUEUE_SIZE:
+            return False
+        self._messages[coalesce_key] = message
+        self._has_message.set()
+        return True
+
+    async def send_messages(self, timeout):
+        """ Sends the queued messages, with the ids of the messages of this client processed since the last one """
+        while True:
+            await self._has_message.wait()
+            while len(self._messages) > 0:
+                key, message = self._messages.popitem(last=False)
+                processed_ids, self.processed_ids = self.processed_ids, []
+                # the message ends with the closing brace of its object
+                await asyncio.wait_for(
+                    self.ws.send_str(message[:-1] + ',"processedIds":' + json.dumps(processed_ids) + '}'),
+                    timeout)
+            self._has_message.clear()
+
 
 class WebServer:
     """ Class for handling HTTP requests and the websocket """
-    def __init__(self):
+    def __init__(self, max_video_fps=30, video_write_timeout=5, video_variants=('full', 'thumbnail'),
+                 websocket_queue_size=32, websocket_write_timeout=5):
+        self._MAX_VIDEO_FPS = max_video_fps
+        self._VIDEO_WRITE_TIMEOUT = video_write_timeout
+        self._VIDEO_VARIANTS = video_variants
+        self._WEBSOCKET_QUEUE_SIZE = websocket_queue_size
+        self._WEBSOCKET_WRITE_TIMEOUT = websocket_write_timeout
         self._is_running = False
-        self._frame_encoded = None
-        self._is_frame_encoded_changed = WeakKeyDictionary()
-        self._websocket_lock = False
-        self._ws = None
-        self._processed_ids = []
+        self._frames_encoded = {}
+        self._video_clients: set[VideoClient] = set()
+        self._websocket_clients: set[WebsocketClient] = set()
+        self._server_state = StateStore('server_state.json')
+        self._client_state = StateStore('client_state.json')
 
-    def set_frame_encoded(self, frame_encoded):
-        """ Sets the frame to display on the website """
-        self._frame_encoded = frame_encoded
-        for key in self._is_frame_encoded_changed.keys():
-            self._is_frame_encoded_changed[key] = True
+    def set_frame_encoded(self, frame_encoded, variant='full'):
+        """ Sets the frame to display on the website, has to be called from the event loop """
+        self.set_frames_encoded({variant: frame_encoded})
 
-    async def send_message(self, type, data):
-        """ Sends a message along with ids of processed messages """
-        if self._ws is None or self._ws.closed:
-            return
+    def set_frames_encoded(self, frames_encoded):
+        """ Sets the frame of every variant in frames_encoded, has to be called from the event loop """
+        self._frames_encoded.update(frames_encoded)
+        for client in self._video_clients:
+            if client.variant in frames_encoded:
+                client.put(frames_encoded[client.variant])
 
-        print(type, data)
-        message = {
-            'type': type,
-            'data': data,
-            'processedIds': self._processed_ids        
-        }
+    def has_video_clients(self):
+        """ Whether anybody is watching the video stream """
+        return len(self._video_clients) > 0
 
-        await self._ws.send_str(json.dumps(message))
-        
-        self._processed_ids = []
+    def get_video_viewers(self):
+        """ The number of viewers of every variant of the video stream """
+        viewers = {variant: 0 for variant in self._VIDEO_VARIANTS}
+        for client in list(self._video_clients):
+            viewers[client.variant] += 1
+        return viewers
+
+    async def send_message(self, type, data, coalesce_key=None):
+        """
+            Sends a message to every websocket client, along with the ids of its processed messages
+            An unsent message with the same coalesce_key is replaced by this one
+        """
+        self._broadcast(self._serialize_message(type, data), coalesce_key)
+
+    def has_websocket_client(self):
+        """ Whether a client is connected to the websocket """
+        return len(self._websocket_clients) > 0
+
+    async def send_telemetry(self, telemetry):
+        """ Sends the geometry of the latest frame, only the latest one is kept for a slow client """
+        await self.send_message('telemetry', telemetry, 'telemetry')
+
+    def _serialize_message(self, type, data):
+        return json.dumps({'type': type, 'data': data}, separators=(',', ':'))
+
+    def _broadcast(self, message, coalesce_key=None, clients=None):
+        """ Queues a serialized message for the clients, by default all of them """
+        for client in list(self._websocket_clients if clients is None else clients):
+            if not client.put(message, coalesce_key):
+                self._evict(client)
+
+    def _evict(self, client):
+        """ Disconnects a client that does not keep up with its messages """
+        print('evicting slow websocket client')
+        self._websocket_clients.discard(client)
+        asyncio.ensure_future(client.ws.close())
+
+    def save_state(self):
+        """ Writes the server and client state to their files now, e.g. before shutting down """
+        self._server_state.flush()
+        self._client_state.flush()
 
     async def set_current_node(self, current_node):
         """ Sets the current node """
         if current_node is None:
             return
         print('set current node', current_node)
-        async with aiofiles.open('server_state.json', 'w') as file:
-            await file.write(json.dumps({'currentNode': current_node}))
-        await self.send_message('server-state-update', {'currentNode': current_node})
+        self._server_state.set({'currentNode': current_node})
+        await self.send_message('server-state-update', {'currentNode': current_node}, 'server-state')
 
     async def start_running(self, address, port, path_callback):
         """
@@ -62,97 +174,151 @@ class WebServer:
             return web.FileResponse('website/index.html')
 
         async def make_full_state():
-            """ Combines the server state and client state from their respective files """
-            async with aiofiles.open('server_state.json', 'r') as file:
-                server_state = json.loads(await file.read())
-            async with aiofiles.open('client_state.json', 'r') as file:
-                client_state = json.loads(await file.read())
-
+            """ Combines the server state and client state, both are kept in memory """
             full_state = { 
-                "clientState": client_state, 
-                "serverState": server_state
+                "clientState": self._client_state.get(), 
+                "clientStateVersion": self._client_state.version,
+                "serverState": self._server_state.get()
             }
 
             return full_state
 
         async def set_server_state(server_state):
-            """ Updates the file server_state.json """
-            async with aiofiles.open('server_state.json', 'w') as file:
-                await file.write(json.dumps(server_state))
+            """ Updates the server state, server_state.json is written behind it """
+            self._server_state.set(server_state)
 
         async def set_client_state(client_state):
-            """ Updates the file client_state.json """
-            async with aiofiles.open('client_state.json', 'w') as file:
-                await file.write(json.dumps({ key: client_state[key] for key in ['mapStr', 'map'] }))
+            """ Updates the client state, client_state.json is written behind it """
+            self._client_state.set({ key: client_state[key] for key in ['mapStr', 'map'] })
             path_callback(client_state['path'])
 
         async def update_client_state(client_state):
             """ Merges the current client state with the new one """
-            new_client_state = {}
-            async with aiofiles.open('client_state.json', 'r') as file:
-                old_client_state = json.loads(await file.read())
-                new_client_state = old_client_state | client_state
-            async with aiofiles.open('client_state.json', 'w') as file:
-                await file.write(json.dumps(new_client_state))
+            self._client_state.update(client_state)
             if 'path' in client_state:
                 path_callback(client_state['path'])
+
+        async def patch_client_state(patch):
+            """ Applies a JSON patch to the client state, raises ValueError when it does not fit """
+            old_path = self._client_state.get().get('path')
+            self._client_state.patch(patch)
+            # only a patch of the path replaces it
+            new_path = self._client_state.get().get('path')
+            if new_path is not old_path:
+                path_callback(new_path if new_path is not None else [])
+
+        async def send_full_state(clients):
+            contents = await make_full_state()
+            self._broadcast(self._serialize_message('full-state-update', contents), 'full-state', clients)
             
+        async def send_messages(client):
+            """ Sends the messages of a client until it disconnects, evicts it when it stops reading """
+            try:
+                await client.send_messages(self._WEBSOCKET_WRITE_TIMEOUT)
+            except (ConnectionResetError, asyncio.TimeoutError):
+                self._evict(client)
+
         async def websocket_handler(request): 
-            """ Handles messages on the websocket """  
-            if self._ws is not None:
-                raise web.HTTPConflict()
-            self._ws = web.WebSocketResponse()
-            self._processed_ids = []
-            
-            await self._ws.prepare(request)
-            #async with aiofiles.open('state.json', 'r') as file:
-            #    contents = await file.read()
-            contents = await make_full_state()
-            await self.send_message('full-state-update', contents)
+            """ Handles messages on the websocket, any number of clients can be connected """  
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            client = WebsocketClient(ws, self._WEBSOCKET_QUEUE_SIZE)
+            self._websocket_clients.add(client)
+            sender = asyncio.create_task(send_messages(client))
 
-            #testing_task = asyncio.create_task(test_sending_server_state())
-            
-            async for msg in self._ws:
+            await send_full_state([client])
+
+            async for msg in ws:
                 if msg.type == aiohttp.WSMsgType.TEXT:
                     message = json.loads(msg.data)
-                    print(message)
+                    print('websocket message', message['type'])
                     data = message['data']
-                    #print('message data', data)
                     if 'id' in message:
-                        self._processed_ids.append(message['id'])
+                        client.processed_ids.append(message['id'])
                     if message['type'] == 'server-state-update':
                         await set_server_state(data)
+                        # the other clients get the new server state, this one the id of its message
+                        await self.send_message('server-state-update', data, 'server-state')
+                    elif message['type'] == 'client-state-patch':
+                        # a patch only applies to the version it was made for, else the client resyncs
+                        base_version = self._client_state.version
+                        try:
+                            if data['baseVersion'] != base_version:
+                                raise ValueError('client state version ' + str(data['baseVersion']) + ' is not ' + str(base_version))
+                            await patch_client_state(data['patch'])
+                        except (ValueError, KeyError, TypeError) as error:
+                            print('client state patch rejected:', error)
+                            await send_full_state([client])
+                        else:
+                            # the client that sent it knows from the version that it is its own patch
+                            await self.send_message('client-state-patch', {
+                                'baseVersion': base_version,
+                                'version': self._client_state.version,
+                                'patch': data['patch']
+                            })
+                    elif message['type'] == 'full-state-request':
+                        await send_full_state([client])
                     elif message['type'] == 'client-state-update':
                         await set_client_state(data)
-                        
-            self._ws = None 
-            self._processed_ids = []
-            #testing_task.cancel()
-            await update_client_state({'targetNode': None, 'path': []})
-            return self._ws
+                        other_clients = [other for other in self._websocket_clients if other is not client]
+                        if len(other_clients) > 0:
+                            await send_full_state(other_clients)
+
+            sender.cancel()
+            self._websocket_clients.discard(client)
+            if len(self._websocket_clients) == 0:
+                # the last one watching the car is gone
+                await update_client_state({'targetNode': None, 'path': []})
+            return ws
             
         async def show_image(request):
-            """ Sends frame_encoded to the client """
+            """
+                Sends every new frame_encoded to the client, as soon as it is set
+                A client can ask for fewer frames with ?fps= and for a variant, e.g. ?variant=thumbnail
+                A variant this server does not encode falls back to the first one, 'full' by default
+            """
+            max_fps = self._MAX_VIDEO_FPS
+            if 'fps' in request.query:
+                try:
+                    requested_fps = float(request.query['fps'])
+                except ValueError:
+                    raise web.HTTPBadRequest(text=f"fps has to be a number, not {request.query['fps']!r}")
+                if not math.isfinite(requested_fps):
+                    raise web.HTTPBadRequest(text=f"fps has to be finite, not {request.query['fps']!r}")
+                max_fps = min(max(requested_fps, 0.1), max_fps)
+            variant = request.query.get('variant', self._VIDEO_VARIANTS[0])
+            if variant not in self._VIDEO_VARIANTS:
+                variant = self._VIDEO_VARIANTS[0]
+            client = VideoClient(variant, max_fps)
             resp = web.StreamResponse(status=200, 
                               reason='OK', 
                               headers={'Content-Type': 'multipart/x-mixed-replace; boundary=frame'})
     
             # The StreamResponse is a FSM. Enter it with a call to prepare.
             await resp.prepare(request)
-            self._is_frame_encoded_changed[resp] = True
-
-            await resp.write(b'--frame\r\n')
-            while True:
-                if self._is_frame_encoded_changed.get(resp, False):
-                    self._is_frame_encoded_changed[resp] = False
-                    await resp.write(
-                        b'Content-Type: image/jpeg\r\n\r\n' 
-                        + (self._frame_encoded if self._frame_encoded is not None else b'') 
-                        + b'\r\n'
-                        + b'--frame\r\n'
-                    ) 
-                    await resp.drain()
-                await asyncio.sleep(0.05)   
+            self._video_clients.add(client)
+            if variant in self._frames_encoded:
+                client.put(self._frames_encoded[variant])
+
+            try:
+                await resp.write(b'--frame\r\n')
+                while True:
+                    frame_encoded = await client.get()
+                    # a viewer that stops reading is dropped instead of holding on to its coroutine
+                    await asyncio.wait_for(
+                        resp.write(
+                            b'Content-Type: image/jpeg\r\n\r\n' 
+                            + frame_encoded
+                            + b'\r\n'
+                            + b'--frame\r\n'
+                        ),
+                        self._VIDEO_WRITE_TIMEOUT
+                    )
+            except (ConnectionResetError, asyncio.TimeoutError):
+                pass
+            finally:
+                self._video_clients.discard(client)
+            return resp
         loop = asyncio.get_event_loop()
         app = web.Application(loop=loop)
         app.router.add_route('GET', '/', index)
@@ -0,0 +1,87 @@
+import argparse
+import json
+import time
+import cv2 as cv
+from lib_calculate_direction import DirectionCalculator
+from lib_image_processing import ImageProcessor
+from lib_process_lines import LineProcessor
+from lib_session_recording import Session, SessionRecorder, get_latency_percentiles, record_edges, replay_session
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def record(args):
+    """Records frames of a camera or a video file, without the car"""
+    capture = cv.VideoCapture(int(args.source) if args.source.isdigit() else args.source)
+    recorder = None
+    while recorder is None or recorder.frame_count < args.frames:
+        ret_read, frame = capture.read()
+        if not ret_read:
+            break
+        if recorder is None:
+            recorder = SessionRecorder(args.session, frame.shape, args.frames)
+        recorder.record(frame, time.monotonic())
+    capture.release()
+    if recorder is None:
+        print(f"Can't read {args.source}")
+        return
+    recorder.close()
+    print(f'Recorded {recorder.frame_count} frames to {args.session}')
+
+def edges(args):
+    """Turns a session of camera frames into a smaller session of edges"""
+    recorder = record_edges(Session(args.session), args.edges_session, make_image_processor())
+    print(f'Recorded the edges of {recorder.frame_count} frames to {args.edges_session}')
+
+def run(args):
+    session = Session(args.session)
+    direction_calculator = DirectionCalculator(state_change_threshold=5, react_to_intersection_threshold=0.0)
+    if args.path is not None:
+        # the same part of the path test_line_following's write_path hands to the direction calculator
+        direction_calculator.set_new_path(args.path[1:])
+    result = replay_session(session, make_image_processor(), LineProcessor(), direction_calculator,
+                            real_time=args.real_time)
+
+    print(f'{len(session)} {"edge maps" if session.has_edges else "frames"} of {session.frame_shape}')
+    print('latency (ms)'.ljust(12) + ''.join(f'p{p}'.rjust(9) for p in PERCENTILES))
+    for stage, values in get_latency_percentiles(result['latencies'], PERCENTILES).items():
+        print(stage.ljust(12) + ''.join(f'{value:9.2f}' for value in values))
+    states = [(entry['stableState'], entry['currentNode']) for entry in result['trace']]
+    state_changes = sum(1 for before, after in zip(states, states[1:]) if before != after)
+    print(f'{state_changes} changes of the stable state or node')
+    if args.trace is not None:
+        with open(args.trace, 'w') as file:
+            json.dump(result['trace'], file, indent=1)
+        print(f'Trace written to {args.trace}')
+
+def make_image_processor():
+    # the same settings as test_line_following
+    return ImageProcessor(10, 5, 7, 65, reuse_buffers=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Records camera sessions and replays them through the line following')
+    commands = parser.add_subparsers(required=True)
+
+    record_parser = commands.add_parser('record', help='record a session from a camera or a video file')
+    record_parser.add_argument('session', help='the session file to write, e.g. session.npy')
+    record_parser.add_argument('--source', default='0', help='camera index or video file (default: 0)')
+    record_parser.add_argument('--frames', type=int, default=900, help='number of frames to record (default: 900)')
+    record_parser.set_defaults(command=record)
+
+    edges_parser = commands.add_parser('edges', help='store the edges of a session, 24 times smaller than the frames')
+    edges_parser.add_argument('session')
+    edges_parser.add_argument('edges_session')
+    edges_parser.set_defaults(command=edges)
+
+    run_parser = commands.add_parser('run', help='replay a session and report the latency of every stage')
+    run_parser.add_argument('session')
+    run_parser.add_argument('--real-time', action='store_true', help='process the frames at the pace they were recorded')
+    run_parser.add_argument('--path', type=json.loads,
+                            help='the path of the client state as JSON, its first entry is skipped like when driving, '
+                                 'e.g. \'[{"nodeId": 0}, {"choose": "left", "nodeId": 1}]\'')
+    run_parser.add_argument('--trace', help='write the state and velocity of every frame to this JSON file')
+    run_parser.set_defaults(command=run)
+
+    args = parser.parse_args()
+    args.command(args)
@@ -1,6 +1,4 @@
 import asyncio
-from functools import partial
-from concurrent.futures import ProcessPoolExecutor
 from math import asin, atan2, cos, pi, sin, sqrt
 import time
 from typing import Tuple
@@ -9,80 +7,193 @@ import cv2 as cv
 import numpy as np
 import signal
 import sys
+import threading
 import RPi.GPIO as GPIO
 from lib_calculate_direction import DirectionCalculator
 from lib_image_processing import ImageProcessor
 from lib_process_lines import LineProcessor
-from lib_line_following import get_processed_frame_and_direction_vector
+from lib_line_tracking import LineTracker
+from lib_lines_display import get_overlay_telemetry, render_overlay
 from lib_car import Car
+from lib_frame_encoder import FrameEncoder
+from lib_frame_source import FrameSource
 from lib_motor import Motor
+from lib_pipeline import Pipeline, Stage, StageQueue
+from lib_session_recording import SessionRecorder
+from lib_shared_frames import SharedFrameRing
+from lib_vision_worker import VisionWorker
 from lib_web_server import WebServer
 
-cap = None
+frame_source = None
 car = None
-video = WebServer()
-image_processor = None
-line_processor = None
-direction_calculator = None
+frame_encoder = FrameEncoder()
+video = WebServer(video_variants=frame_encoder.get_variants())
+vision_worker = None
+ANALYSIS_WORKERS = 3 # the pi has 4 cores, one is left for the vision worker and this process
+LINE_TRACKING = True # search only strips around the lines of the frames before
+frames_in_flight = None
+capture_times = {}
+frame_ring = None
+ENCODE_QUEUE_SIZE = 1
+loop = None
+pipeline_failed = None
+analysis_sent = True # the vision worker sends the analysis until it is told otherwise
+SESSION_PATH = None # e.g. 'session.npy' records the camera frames for replay_session.py
+SESSION_MAX_BYTES = 300 * 2**20 # the session file is allocated up front, about 340 frames (11 s) of 640x480
+session_recorder = None
 
 
 def signal_handler(sig, frame):
+    video.save_state()
     GPIO.cleanup()
     sys.exit(0)
 
 def nothing():
     pass
 
-path_plan = []
-unread_new_path = False
-
 def write_path(path):
-    global path_plan
-    path_plan = path[1:]
-    global unread_new_path
-    unread_new_path = True
+    vision_worker.set_new_path(path[1:])
+
+
+def capture_frame():
+    """Capture stage, sends the newest frame to the vision worker while fewer than max_frames_in_flight are in it"""
+    global frame_ring, session_recorder, analysis_sent
+    if not frames_in_flight.acquire(timeout=0.5):
+        return None
+    ret_read, original_frame, capture_time = frame_source.read(timeout=0.5)
+    if not ret_read:
+        frames_in_flight.release()
+        return None
+    if frame_ring is None:
+        # frames_in_flight is released before a frame goes into the encode queue, so besides the frames
+        # in flight a slot can be held by the vision stage handing it on, the encode queue and the encode stage
+        frame_ring = SharedFrameRing(original_frame.shape, vision_worker.max_frames_in_flight + 2 + ENCODE_QUEUE_SIZE)
+        vision_worker.set_frame_ring(frame_ring)
+        if SESSION_PATH is not None:
+            session_recorder = SessionRecorder(SESSION_PATH, original_frame.shape, SESSION_MAX_BYTES // original_frame.nbytes)
+    if session_recorder is not None:
+        session_recorder.record(original_frame, capture_time)
+    slot = frame_ring.put(original_frame)
+    if slot is None:
+        # every slot is in use, the frame is dropped rather than sent without a slot
+        frames_in_flight.release()
+        return None
+    capture_times[slot] = capture_time
+    # only the encode and telemetry stages use the analysis, and only while somebody is connected
+    send_analysis = video.has_video_clients() or video.has_websocket_client()
+    if send_analysis != analysis_sent:
+        vision_worker.set_send_analysis(send_analysis)
+        analysis_sent = send_analysis
+    vision_worker.process_frame(slot)
+    return slot
+
+def receive_result():
+    """Vision stage, the processed frames come back in the order they were captured"""
+    processed_frame_info = vision_worker.get_result()
+    if processed_frame_info is None:
+        return None # the vision worker stopped
+    frames_in_flight.release()
+    processed_frame_info['capture_time'] = capture_times.pop(processed_frame_info['slot'])
+    if processed_frame_info['current_node'] is not None:
+        state_queue.put(processed_frame_info['current_node'])
+    return processed_frame_info
+
+def control(processed_frame_info):
+    car.set_velocity(processed_frame_info['velocity_vector'])
+
+def encode_frame(processed_frame_info):
+    """Encode stage, the overlay is only rendered and encoded for the variants somebody watches"""
+    slot = processed_frame_info['slot']
+    if 'analysis' not in processed_frame_info:
+        # nobody was watching when the frame was processed
+        frame_ring.release(slot)
+        return None
+    viewers = video.get_video_viewers()
+    frames_encoded = frame_encoder.encode(
+        lambda scale, layers: render_overlay(frame_ring.get_frame(slot),
+                                             processed_frame_info['analysis'], processed_frame_info['overlay'],
+                                             layers, scale),
+        viewers)
+    frame_ring.release(slot)
+    return frames_encoded if len(frames_encoded) > 0 else None
+
+def stream_frame(frames_encoded):
+    loop.call_soon_threadsafe(video.set_frames_encoded, frames_encoded)
+
+def send_telemetry(processed_frame_info):
+    """Telemetry stage, the overlay geometry for the browser, only while it is connected"""
+    if not video.has_websocket_client() or 'analysis' not in processed_frame_info:
+        return
+    telemetry = get_overlay_telemetry(processed_frame_info['analysis'], processed_frame_info['overlay'],
+                                      frame_ring.frame_shape)
+    asyncio.run_coroutine_threadsafe(video.send_telemetry(telemetry), loop).result()
+
+def stream_state(current_node):
+    asyncio.run_coroutine_threadsafe(video.set_current_node(current_node), loop).result()
+
+def release_slot(processed_frame_info):
+    frame_ring.release(processed_frame_info['slot'])
+
+def stage_failed(stage, error):
+    """Stops the car as soon as a stage fails, instead of driving on with the last velocity"""
+    print(f'{stage.name} stage failed: {error!r}')
+    pipeline.stop()
+    stop_car()
+    loop.call_soon_threadsafe(pipeline_failed.set)
+
+def stop_car():
+    try:
+        car.set_velocity((0, 0))
+    except Exception as error:
+        print(f"Can't stop the car: {error!r}")
+
+# only the newest velocity, frame and node matter, older ones are dropped when a stage falls behind
+control_queue = StageQueue()
+encode_queue = StageQueue(ENCODE_QUEUE_SIZE, on_drop=release_slot)
+stream_queue = StageQueue()
+state_queue = StageQueue()
+telemetry_queue = StageQueue()
+pipeline = Pipeline([
+    Stage('capture', capture_frame),
+    Stage('vision', receive_result, output_queues=[control_queue, encode_queue, telemetry_queue],
+          get_depth=lambda: len(capture_times)),
+    Stage('control', control, control_queue),
+    Stage('encode', encode_frame, encode_queue, [stream_queue]),
+    Stage('stream', stream_frame, stream_queue),
+    Stage('state', stream_state, state_queue),
+    Stage('telemetry', send_telemetry, telemetry_queue)
+], on_error=stage_failed)
 
-def read_path():
-    global unread_new_path
-    unread_new_path = False
-    global path_plan
-    return path_plan
 
+def stop_pipeline():
+    frame_source.release()
+    pipeline.stop()
+    vision_worker.stop()
+    pipeline.join()
+    # a control stage that was still handling a velocity when the pipeline stopped may have set it
+    stop_car()
+    if frame_ring is not None:
+        frame_ring.close()
+    if session_recorder is not None:
+        session_recorder.close()
 
 async def process_video():
-    global direction_calculator_state
-    with ProcessPoolExecutor() as executor:
-        loop = asyncio.get_running_loop()
-        #executor = ProcessPoolExecutor()
-        while cap.isOpened():
-            ret_read, original_frame = cap.read() # <3ms
-            if ret_read:
-                #print(f'Before: {direction_calculator}')
-                if(unread_new_path):
-                    path = read_path()
-                    direction_calculator.set_new_path(path)
-                start_time = time.time()
-                processed_frame_info = await loop.run_in_executor(executor,
-                    partial(get_processed_frame_and_direction_vector,
-                        original_frame,
-                        image_processor,
-                        line_processor,
-                        direction_calculator))
-                print(f'Outer time: {time.time() - start_time}')
-                frame = processed_frame_info['frame']
-                velocity_vector = processed_frame_info['velocity_vector']
-                current_node = processed_frame_info['current_node']
-                direction_calculator.copy(processed_frame_info['direction_calculator'])
-                #print(f'After:  {direction_calculator}')
-                #print('\n\n')
-                ret, buffer = cv.imencode('.jpg', frame)
-                frame_encoded = buffer.tobytes()
-                video.set_frame_encoded(frame_encoded)
-                await video.set_current_node(current_node)
-                car.set_velocity(velocity_vector)
-            else:
-                cap.set(cv.CAP_PROP_POS_FRAMES, 0)
-        cap.release()
+    global loop, pipeline_failed
+    loop = asyncio.get_running_loop()
+    pipeline_failed = asyncio.Event()
+    pipeline.start()
+    try:
+        while frame_source.is_running() and not pipeline_failed.is_set():
+            try:
+                # woken up right away when a stage fails
+                await asyncio.wait_for(pipeline_failed.wait(), 5)
+            except asyncio.TimeoutError:
+                print(f'{pipeline.get_stats_string()}, jpeg quality: {frame_encoder.quality}, resolution: {frame_encoder.resolution:.2f}')
+    finally:
+        await loop.run_in_executor(None, stop_pipeline)
+        video.save_state()
+    if pipeline.get_error() is not None:
+        raise pipeline.get_error()
 
 async def start():
     await asyncio.gather(
@@ -95,15 +206,22 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
     GPIO.setmode(GPIO.BOARD)
 
-    cap = cv.VideoCapture(0)
+    frame_source = FrameSource(cv.VideoCapture(0)).start()
     car = Car(
         motor_left=Motor(speed_pin=33, direction_pin=31, encoder_interrupt_wiring_pi_pin=25),
         motor_right=Motor(speed_pin=32, direction_pin=36, encoder_interrupt_wiring_pi_pin=0),
         speed=20
     )
-    image_processor = ImageProcessor(10, 5, 7, 65)
-    line_processor = LineProcessor()
-    direction_calculator = DirectionCalculator(state_change_threshold=5, react_to_intersection_threshold=0.0)
+    vision_worker = VisionWorker(
+        image_processor=ImageProcessor(10, 5, 7, 65, reuse_buffers=True),
+        line_processor=LineProcessor(),
+        direction_calculator=DirectionCalculator(state_change_threshold=5, react_to_intersection_threshold=0.0),
+        # with analysis workers the tracks are updated in capture order, the strips lag a few frames more
+        line_tracker=LineTracker() if LINE_TRACKING else None,
+        analysis_workers=ANALYSIS_WORKERS
+    ).start()
+    print(f'Vision: {ANALYSIS_WORKERS} analysis workers, line tracking {"on" if LINE_TRACKING else "off"}')
+    frames_in_flight = threading.Semaphore(vision_worker.max_frames_in_flight)
     asyncio.run(start())
 
 
@@ -0,0 +1,139 @@
+import itertools
+import numpy as np
+from lib_process_lines import MarkerRuns
+
+MAX_BOXES = 10 # every marker list of a single line up to this many boxes
+MAX_SPLIT_BOXES = 6 # every marker list of several lines up to this many boxes in total
+MAX_LINES = 3
+HOLE_SIZES = (1, 2, 3, 4, 5, 6)
+SEGMENT_SIZES = (1, 2, 3, 4)
+
+
+# The list based marker post-processing MarkerRuns replaced, one line at a time
+
+def fill_gaps(tape_markers: 'list[bool]', hole_size: int) -> 'list[bool]':
+    look_forward_amount = hole_size - 1
+    gap_filled_markers = tape_markers.copy()
+    recording = False
+    current_segment_size = 0
+    i = -1
+    while i < len(tape_markers) - 1:
+        i += 1
+        if tape_markers[i] is True:
+            recording = True
+            current_segment_size += 1
+        elif recording is True and tape_markers[i] is False:
+            markers_forward = 0
+            end_index = i
+            for j in range(1, look_forward_amount + 1):
+                if (i + j < len(tape_markers) - 1
+                        and tape_markers[i + j] == True):
+                    markers_forward += 1
+                    end_index = i + j
+            if markers_forward == 0:
+                i += look_forward_amount
+                current_segment_size = 0
+                recording = False
+            elif current_segment_size + markers_forward + 1 >= hole_size:
+                gap_filled_markers[i: end_index+1] = [True] * (end_index - i + 1)
+                current_segment_size += end_index - i
+                i = end_index - 1  # -1 because incrementing is the first step of the loop
+    return gap_filled_markers
+
+
+def filter_small_segments(gap_filled_markers: 'list[bool]', segment_size: int) -> 'list[bool]':
+    filtered_markers = gap_filled_markers.copy()
+    i = 0
+    while i < len(gap_filled_markers) - 1:
+        start, end = get_next_segment_indices(gap_filled_markers, i)
+        if start != None and end - start < segment_size:
+            filtered_markers[start: end + 1] = [False] * (end - start + 1)
+        i = i+1 if end is None else end
+    return filtered_markers
+
+
+def get_next_segment_indices(markers: 'list[bool]', start_from: int) -> 'tuple[int, int]':
+    segment_started = False
+    start_index = None
+    end_index = None
+    for i in range(start_from, len(markers)):
+        if segment_started is False and markers[i] is True:
+            segment_started = True
+            start_index = i
+        if segment_started and markers[i] is False:
+            segment_started = False
+            end_index = i
+            break
+    return start_index, end_index or (None if start_index is None else len(markers) - 1)
+
+
+def get_segment_boxes(markers: 'list[bool]') -> 'list[tuple[int, int]]':
+    segment_boxes = []
+    search_from = 0
+    while search_from is not None:
+        start, end = get_next_segment_indices(markers, search_from)
+        if start is not None:
+            segment_boxes.append((start, end))
+        search_from = None if end is None else end + 1
+    return segment_boxes
+
+
+def get_reference_boxes(line_markers: 'list[list[bool]]', hole_size: int, segment_size: int) -> 'list[tuple[int, int, int]]':
+    """(line, start box, end box) of every segment, box indices counted over all lines"""
+    segment_boxes = []
+    offset = 0
+    for line, markers in enumerate(line_markers):
+        filtered_markers = filter_small_segments(fill_gaps(markers, hole_size), segment_size)
+        segment_boxes += [(line, offset + start, offset + end) for start, end in get_segment_boxes(filtered_markers)]
+        offset += len(markers)
+    return segment_boxes
+
+
+def get_run_boxes(line_markers: 'list[list[bool]]', hole_size: int, segment_size: int) -> 'list[tuple[int, int, int]]':
+    """The same as get_reference_boxes, the way LineProcessor._get_tape_boundaries computes it"""
+    tape_markers = np.array([marker for markers in line_markers for marker in markers], dtype=bool)
+    line_stops = np.cumsum([len(markers) for markers in line_markers])
+    runs = MarkerRuns.from_markers(tape_markers, line_stops)
+    runs = runs.fill_gaps(hole_size - 1).remove_small(segment_size)
+    start_boxes, end_boxes = runs.get_segment_boxes()
+    return list(zip(runs.lines.tolist(), start_boxes.tolist(), end_boxes.tolist()))
+
+
+def get_line_sizes():
+    """Box counts of the lines, the same total split every way, lines without boxes included"""
+    for line_count in range(1, MAX_LINES + 1):
+        for line_sizes in itertools.product(range(MAX_SPLIT_BOXES + 1), repeat=line_count):
+            if sum(line_sizes) <= MAX_SPLIT_BOXES:
+                yield line_sizes
+
+
+def assert_same_segments(line_markers: 'list[list[bool]]'):
+    """All marker lists go through MarkerRuns at once, as the lines of one frame"""
+    for hole_size in HOLE_SIZES:
+        for segment_size in SEGMENT_SIZES:
+            expected = get_reference_boxes(line_markers, hole_size, segment_size)
+            actual = get_run_boxes(line_markers, hole_size, segment_size)
+            if actual != expected:
+                line = next(line for line in range(len(line_markers))
+                            if [box for box in actual if box[0] == line] != [box for box in expected if box[0] == line])
+                assert False, f'{line_markers[line]}, hole size {hole_size}, segment size {segment_size}'
+
+
+def test_single_line():
+    assert_same_segments([list(markers) for box_count in range(MAX_BOXES + 1)
+                          for markers in itertools.product((False, True), repeat=box_count)])
+
+
+def test_split_lines():
+    line_markers = []
+    for line_sizes in get_line_sizes():
+        line_stops = np.cumsum(line_sizes)
+        for markers in itertools.product((False, True), repeat=sum(line_sizes)):
+            line_markers += [list(markers[stop - size:stop]) for size, stop in zip(line_sizes, line_stops)]
+    assert_same_segments(line_markers)
+
+
+if __name__ == "__main__":
+    test_single_line()
+    test_split_lines()
+    print('MarkerRuns matches the list based marker processing')
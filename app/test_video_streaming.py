@@ -4,10 +4,11 @@ from lib_image_processing import ImageProcessor
 from lib_process_lines import LineProcessor
 from lib_line_following import get_processed_frame_and_direction_vector
 from lib_web_server import WebServer
+from lib_frame_source import FrameSource
 import asyncio
-camera = cv.VideoCapture(0)
+frame_source = FrameSource(cv.VideoCapture(0)).start()
 video = WebServer()
-image_processor = ImageProcessor(10, 5, 7, 85)
+image_processor = ImageProcessor(10, 5, 7, 85, reuse_buffers=True)
 line_processor = LineProcessor()
 direction_calculator = DirectionCalculator()
 
@@ -30,8 +31,10 @@ def read_path():
 
 async def main():
     global direction_calculator
-    while camera.isOpened():
-        ret_read, original_frame = camera.read()
+    while frame_source.is_running():
+        ret_read, original_frame, _ = await frame_source.read_async()
+        if not ret_read:
+            continue
         if(unread_new_path):
             path = read_path()
             direction_calculator.set_new_path(path)
@@ -42,7 +45,7 @@ async def main():
         frame = buffer.tobytes()
         video.set_frame_encoded(frame)
         await asyncio.sleep(0.1)
-    camera.release()
+    frame_source.release()
 
 
 def parse_path(path):
@@ -0,0 +1,65 @@
+/**
+ * Draws the overlay of a processed camera frame on a canvas lying over the video,
+ * with the same colors the server uses for the overlay it draws into the video.
+ * The telemetry is in the coordinates of the camera frame, they are scaled to the canvas.
+ * @param {HTMLCanvasElement} canvas
+ * @param {object | null} telemetry clears the canvas when null
+ */
+export function drawOverlay(canvas, telemetry) {
+    const context = canvas.getContext('2d')
+    // keep the resolution of the canvas the same as its size on the page
+    if (canvas.width !== canvas.clientWidth || canvas.height !== canvas.clientHeight) {
+        canvas.width = canvas.clientWidth
+        canvas.height = canvas.clientHeight
+    }
+    context.setTransform(1, 0, 0, 1, 0, 0)
+    context.clearRect(0, 0, canvas.width, canvas.height)
+    if (!telemetry) return
+
+    const { width, height, mergedLines, tapePaths, displacement, direction, directionToGo } = telemetry
+    const scaleX = canvas.width / width
+    const scaleY = canvas.height / height
+    context.setTransform(scaleX, 0, 0, scaleY, 0, 0)
+    context.lineWidth = 2 / Math.min(scaleX, scaleY)
+
+    mergedLines.forEach(([rho, theta], i) => {
+        const shade = 255 - 255 / mergedLines.length * i
+        const a = Math.cos(theta)
+        const b = Math.sin(theta)
+        drawLine(context,
+            [a * rho - 1000 * b, b * rho + 1000 * a],
+            [a * rho + 1000 * b, b * rho - 1000 * a],
+            `rgb(0, ${shade}, 0)`)
+    })
+
+    tapePaths.forEach(([x1, y1, x2, y2], i) => {
+        const shade = 255 - 255 / tapePaths.length * i
+        drawLine(context, [x1, y1], [x2, y2], `rgb(${shade}, 0, ${shade})`)
+    })
+
+    if (direction) {
+        const center = [width / 2, height / 2]
+        const displacementEnd = [center[0] + displacement[0], center[1] + displacement[1]]
+        drawLine(context, center, displacementEnd, 'rgb(0, 255, 255)')
+        drawLine(context, displacementEnd, [displacementEnd[0] + direction[0], displacementEnd[1] + direction[1]], 'rgb(255, 255, 0)')
+        const length = Math.hypot(...directionToGo)
+        if (length > 0) {
+            drawLine(context, center, [center[0] + directionToGo[0] / length * 50, center[1] + directionToGo[1] / length * 50], 'rgb(255, 69, 0)')
+        }
+    }
+
+    context.setTransform(1, 0, 0, 1, 0, 0)
+    context.font = 'bold 16px sans-serif'
+    context.fillStyle = 'rgb(0, 255, 0)'
+    context.fillText(`Stable: ${telemetry.stableState}`, 4, 20)
+    context.fillStyle = 'rgb(255, 0, 0)'
+    context.fillText(`Incoming: ${telemetry.incomingState}`, 4, 40)
+}
+
+function drawLine(context, start, end, color) {
+    context.strokeStyle = color
+    context.beginPath()
+    context.moveTo(...start)
+    context.lineTo(...end)
+    context.stroke()
+}
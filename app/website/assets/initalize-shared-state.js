@@ -1,5 +1,6 @@
 import { Subject, shareReplay, concatMap, fromEvent, Observable, withLatestFrom, EMPTY, startWith, switchMap, of, tap, repeat, map, filter, merge, share, distinctUntilChanged, catchError } from 'https://cdn.skypack.dev/pin/rxjs@v7.5.7-j3yWv9lQY9gNeD9CyX5Y/mode=imports,min/optimized/rxjs.js'
 import { createCounter } from './create-counter.js';
+import { createPatch, applyPatch } from './json-patch.js';
 
 /**
  * Initalize the state which will be shared between server and client.
@@ -12,6 +13,21 @@ export function initalizeSharedState () {
      */
     const unprocessedMessageIds = new Set()
 
+    /**
+     * The client state patches sent to the server that it has not processed yet
+     * (they do not lock the server state)
+     */
+    const unprocessedPatchIds = new Set()
+
+    /**
+     * The version of the client state on the server that knownClientState is,
+     * every patch the server applies increments it.
+     * The client sends and receives patches instead of the whole client state,
+     * a patch only applies to the version it was made for.
+     */
+    let clientStateVersion = null
+    let knownClientState = null
+
     /**
      * The stream of websockets.
      * A new socket is created every time a socket closes or errors.
@@ -50,6 +66,7 @@ export function initalizeSharedState () {
         distinctUntilChanged(),
         tap(() => {
             unprocessedMessageIds.clear()
+            unprocessedPatchIds.clear()
         }),
         shareReplay(1)
     )
@@ -58,14 +75,14 @@ export function initalizeSharedState () {
 
     /**
      * Generate an unprocessed message ID
-     * and put it to the unprocessedMessageIds set.
+     * and put it to the given set, the unprocessedMessageIds set by default.
      * @returns {number}
      */
     const generateUnprocessedMessageId = (function(){
         const idIterator = createCounter()
-        return () => {
+        return (unprocessedIds = unprocessedMessageIds) => {
             const newId = idIterator.next().value
-            unprocessedMessageIds.add(newId)
+            unprocessedIds.add(newId)
             return newId
         }
     })()
@@ -90,12 +107,33 @@ export function initalizeSharedState () {
             }
             for (const processedId of msg.processedIds) {
                 unprocessedMessageIds.delete(processedId)
+                unprocessedPatchIds.delete(processedId)
             }
         }),
         share()
     )
     
-    message$.subscribe(m => console.log('message', m))
+    message$.pipe(
+        filter(({ type }) => type !== 'telemetry')
+    ).subscribe(m => console.log('message', m))
+
+    /**
+     * Stream of the geometry of the latest processed camera frame.
+     * The stream outputs for every frame, so it is not logged.
+     * Outputs null when the socket is closed.
+     */
+    const telemetry$ = merge(
+        message$.pipe(
+            filter(({ type }) => type === 'telemetry'),
+            map(message => message.data)
+        ),
+        socket$.pipe(
+            filter(socket => socket === null),
+            map(() => null)
+        )
+    ).pipe(
+        share()
+    )
 
     /**
      * Stream which includes updates coming from the sockets targeting both client and server states.
@@ -112,13 +150,29 @@ export function initalizeSharedState () {
             filter(socket => socket === null),
             map(() => ({
                 clientState: null,
+                clientStateVersion: null,
                 serverState: null
             }))
         )
     ).pipe(
+        tap(({ clientState, clientStateVersion: version }) => {
+            knownClientState = clientState
+            clientStateVersion = version ?? null
+        }),
         share()
     )
 
+    // make it possible to ask the server for the full state again
+    const fullStateRequestSubject$ = new Subject()
+    fullStateRequestSubject$.pipe(
+        withLatestFrom(socket$)
+    ).subscribe(([_, socket]) => {
+        socket?.send(JSON.stringify({
+            type: 'full-state-request',
+            data: null
+        }))
+    })
+
     // make it possible for the client to emit a new server state
     const serverStateSubject$ = new Subject()
     function updateServerState (serverState) {
@@ -153,13 +207,11 @@ export function initalizeSharedState () {
             map(data => data.serverState)
         ),
         message$.pipe(
+            filter(message => message.type === 'server-state-update'),
             tap((message) => {
                 console.log('new serverState message!', message, 'unprocessed message IDs', unprocessedMessageIds)
             }),
-            filter(message =>
-                message.type === 'server-state-update'
-                && unprocessedMessageIds.size === 0
-            ),
+            filter(() => unprocessedMessageIds.size === 0),
             map(message => message.data)
         )
     ).pipe(
@@ -172,6 +224,27 @@ export function initalizeSharedState () {
     const clientStateUpdate$ = merge(
         fullStateUpdate$.pipe(
             map(data => data.clientState)
+        ),
+        message$.pipe(
+            filter(({ type }) => type === 'client-state-patch'),
+            map(message => message.data),
+            // e.g. the patches this client sent come back as well, they are already applied
+            filter(({ version }) => clientStateVersion !== null && version > clientStateVersion),
+            concatMap(({ baseVersion, version, patch }) => {
+                if (unprocessedPatchIds.size > 0) {
+                    // the patch of another client came first, the server answers
+                    // the unprocessed patches of this client with the full state
+                    return EMPTY
+                }
+                if (baseVersion !== clientStateVersion) {
+                    console.log('missed a client state patch, resync')
+                    fullStateRequestSubject$.next()
+                    return EMPTY
+                }
+                clientStateVersion = version
+                knownClientState = applyPatch(knownClientState, patch)
+                return of(knownClientState)
+            })
         )
     ).pipe(
         share()
@@ -183,14 +256,29 @@ export function initalizeSharedState () {
         clientStateSubject$.next(clientState)
     }
 
-    // if the client emits new states, send them to the server
+    // if the client emits new states, send what changed to the server
     clientStateSubject$.pipe(
         withLatestFrom(socket$)
     ).subscribe(([clientState, socket]) => {
-        socket?.send(JSON.stringify({
-            type: 'client-state-update',
-            data: clientState
-        }))
+        if (!socket || clientStateVersion === null) {
+            return
+        }
+        const patch = createPatch(knownClientState, clientState)
+        if (patch.length === 0) {
+            return
+        }
+        const message = {
+            type: 'client-state-patch',
+            id: generateUnprocessedMessageId(unprocessedPatchIds),
+            data: {
+                baseVersion: clientStateVersion,
+                patch
+            }
+        }
+        // the server gives the patched state the next version, unless another patch came first
+        knownClientState = clientState
+        clientStateVersion += 1
+        socket.send(JSON.stringify(message))
     })
 
     /**
@@ -230,6 +318,7 @@ export function initalizeSharedState () {
         serverState$,
         clientStateUpdate$,
         clientState$,
+        telemetry$,
         socket$
     }
 }
\ No newline at end of file
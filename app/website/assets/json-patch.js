@@ -0,0 +1,74 @@
+/**
+ * Creates a JSON patch (RFC 6902) that turns one object into another.
+ * Only the top level keys are compared, and by reference, so a key whose value
+ * was carried over with the spread operator is not in the patch.
+ * @param {object | null} oldObject the whole new object replaces it when it is null
+ * @param {object} newObject
+ * @returns {object[]} the operations, empty when nothing changed
+ */
+export function createPatch(oldObject, newObject) {
+    if (!oldObject) {
+        return [{ op: 'replace', path: '', value: newObject }]
+    }
+    const patch = []
+    for (const [key, value] of Object.entries(newObject)) {
+        if (!(key in oldObject)) {
+            patch.push({ op: 'add', path: toPointer(key), value })
+        } else if (oldObject[key] !== value) {
+            patch.push({ op: 'replace', path: toPointer(key), value })
+        }
+    }
+    for (const key of Object.keys(oldObject)) {
+        if (!(key in newObject)) {
+            patch.push({ op: 'remove', path: toPointer(key) })
+        }
+    }
+    return patch
+}
+
+/**
+ * Applies the add, replace and remove operations of a JSON patch (RFC 6902),
+ * the same ones the server applies to its client state.
+ * The document is not changed, only the objects and arrays the operations go through are copied.
+ * @param {any} document
+ * @param {object[]} patch
+ * @returns {any} the patched document
+ */
+export function applyPatch(document, patch) {
+    for (const operation of patch) {
+        const keys = fromPointer(operation.path)
+        document = keys.length === 0 ? operation.value : patchValue(document, keys, operation)
+    }
+    return document
+}
+
+function patchValue(container, keys, operation) {
+    const copy = Array.isArray(container) ? [...container] : { ...container }
+    const [key, ...rest] = keys
+    if (rest.length > 0) {
+        copy[key] = patchValue(copy[key], rest, operation)
+    } else if (Array.isArray(copy)) {
+        const index = key === '-' ? copy.length : Number(key)
+        if (operation.op === 'remove') {
+            copy.splice(index, 1)
+        } else if (operation.op === 'add') {
+            copy.splice(index, 0, operation.value)
+        } else {
+            copy[index] = operation.value
+        }
+    } else if (operation.op === 'remove') {
+        delete copy[key]
+    } else {
+        copy[key] = operation.value
+    }
+    return copy
+}
+
+function toPointer(key) {
+    return '/' + key.replaceAll('~', '~0').replaceAll('/', '~1')
+}
+
+function fromPointer(pointer) {
+    if (pointer === '') return []
+    return pointer.slice(1).split('/').map(key => key.replaceAll('~1', '/').replaceAll('~0', '~'))
+}
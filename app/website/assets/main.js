@@ -3,8 +3,9 @@ import { Subject, EMPTY, share, map, of, distinctUntilChanged, pairwise, withLat
 import { initalizeSharedState } from './initalize-shared-state.js'
 import { parseMap } from './parse-map.js'
 import { findPath } from './pathfinding.js'
+import { drawOverlay } from './draw-overlay.js'
 
-const { clientState$, clientStateUpdate$, serverState$, updateClientState, updateServerState, socket$ } = initalizeSharedState()
+const { clientState$, clientStateUpdate$, serverState$, updateClientState, updateServerState, telemetry$, socket$ } = initalizeSharedState()
  
 const nodeLeftClick$ = new Subject()
 const nodeRightClick$ = new Subject()
@@ -47,6 +48,10 @@ socket$.subscribe(
     }
 )
 
+// Draw the overlay of the camera frames over the plain video
+const videoOverlayEl = document.getElementById('video-overlay')
+telemetry$.subscribe(telemetry => drawOverlay(videoOverlayEl, telemetry))
+
 // Update client state from client
 merge(
     inputtedMap$.pipe(